@@ -0,0 +1,208 @@
+"""
+Text of the pdf and docx attachments, job descriptions often come as one. The attachments are converted
+in a process pool with size and time limits, the texts are cached by the attachment hash.
+"""
+import hashlib
+import logging
+import multiprocessing
+import subprocess
+import threading
+import zipfile
+from io import BytesIO
+
+import django
+from django.conf import settings
+from lxml import etree
+
+from crm.models import AttachmentText
+
+logger = logging.getLogger('attachment_text')
+
+DOCX_TYPE = 'application/vnd.openxmlformats-officedocument.wordprocessingml.document'
+WORD_NAMESPACE = '{http://schemas.openxmlformats.org/wordprocessingml/2006/main}'
+# characters of an attachment text kept at most
+TEXT_LIMIT = 100 * 1000
+
+
+class AttachmentError(Exception):
+    """
+    The attachment can't be converted, e.g. it's broken, the error is stored along with its hash
+    """
+
+
+class ConverterError(Exception):
+    """
+    The converter didn't work this time, the attachment is converted again when it comes next time
+    """
+
+
+def attachment_kind(content_type, filename):
+    """
+    pdf or docx for the attachments the text can be extracted from, None for the rest.
+    Mail clients often send them as application/octet-stream, so the file name counts too.
+    """
+    filename = (filename or '').lower()
+    if content_type == 'application/pdf' or filename.endswith('.pdf'):
+        return 'pdf'
+    if content_type == DOCX_TYPE or filename.endswith('.docx'):
+        return 'docx'
+
+
+def find_attachments(email_message, size_limit):
+    """
+    Returns the pdf and docx attachments of the message not bigger than size_limit bytes
+    """
+    attachments = []
+    for part in email_message.walk():
+        kind = attachment_kind(part.get_content_type(), part.get_filename())
+        if not kind:
+            continue
+        data = part.get_payload(decode=True)
+        if not data or len(data) > size_limit:
+            continue
+        attachments.append({
+            'filename': part.get_filename() or '',
+            'kind': kind,
+            'sha256': hashlib.sha256(data).hexdigest(),
+            'data': data,
+        })
+    return attachments
+
+
+def pdf_to_text(data, timeout):
+    try:
+        result = subprocess.run(['pdftotext', '-enc', 'UTF-8', '-', '-'],
+                                input=data, capture_output=True, timeout=timeout)
+    except FileNotFoundError as ex:
+        raise ConverterError('pdftotext is not installed, install poppler-utils') from ex
+    except subprocess.TimeoutExpired as ex:
+        raise ConverterError(f'pdftotext took longer than {timeout}s') from ex
+    if result.returncode:
+        raise AttachmentError(f'pdftotext failed: {result.stderr.decode(errors="replace").strip()}')
+    return result.stdout.decode('utf-8', 'replace')
+
+
+def docx_to_text(data, size_limit):
+    try:
+        with zipfile.ZipFile(BytesIO(data)) as docx:
+            # the compressed document may unpack to much more than the attachment
+            if docx.getinfo('word/document.xml').file_size > size_limit * 10:
+                raise AttachmentError('Document is too big')
+            document = etree.fromstring(docx.read('word/document.xml'))
+    except (zipfile.BadZipFile, KeyError, etree.XMLSyntaxError) as ex:
+        raise AttachmentError(f'Not a docx document: {ex}') from ex
+    paragraphs = (''.join(paragraph.itertext(f'{WORD_NAMESPACE}t'))
+                  for paragraph in document.iter(f'{WORD_NAMESPACE}p'))
+    return '\n'.join(paragraph for paragraph in paragraphs if paragraph.strip())
+
+
+def to_text(kind, data, size_limit, timeout):
+    """
+    Text of the attachment, runs in the pool
+    """
+    if kind == 'pdf':
+        text = pdf_to_text(data, timeout)
+    else:
+        text = docx_to_text(data, size_limit)
+    return text.strip()[:TEXT_LIMIT]
+
+
+class AttachmentTexts:
+    """
+    Adds the texts of the attachments to the parsed messages. Attachments converted before are taken
+    from the cache, the rest is converted in a pool of GMAIL_ATTACHMENT_PROCESSES processes started on first use.
+    Can be shared by threads, the sync converts the attachments in the threads fetching the mailboxes.
+    """
+    # seconds on top of GMAIL_ATTACHMENT_TIMEOUT, pdftotext is killed after the timeout, the margin is for the pool
+    timeout_margin = 5
+
+    def __init__(self, processes=None):
+        self.processes = processes or settings.GMAIL_ATTACHMENT_PROCESSES
+        self.pool = None
+        self.lock = threading.Lock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.stop()
+
+    def get_pool(self):
+        with self.lock:
+            if not self.pool:
+                # spawned, forking copies the state of the running threads, workers need django then
+                context = multiprocessing.get_context('spawn')
+                self.pool = context.Pool(self.processes, initializer=django.setup)
+            return self.pool
+
+    def stop(self, pool=None):
+        """
+        Terminates the pool, a hung conversion would keep a graceful shutdown waiting.
+        With pool only if it's still the current one, another thread may have started over already.
+        """
+        with self.lock:
+            if not self.pool or pool not in (None, self.pool):
+                return
+            pool, self.pool = self.pool, None
+        pool.terminate()
+        pool.join()
+
+    def convert(self, attachments):
+        """
+        Returns the texts and the errors of the attachments by their hashes. Only the broken attachments
+        come with an error, the ones the conversion failed for otherwise, e.g. on a hung conversion,
+        a crashed process or a missing pdftotext, are left out.
+        """
+        pool = self.get_pool()
+        size_limit, timeout = settings.GMAIL_ATTACHMENT_SIZE_LIMIT, settings.GMAIL_ATTACHMENT_TIMEOUT
+        pending = {
+            sha256: pool.apply_async(to_text, (attachment['kind'], attachment['data'], size_limit, timeout))
+            for sha256, attachment in attachments.items()
+        }
+        results = {}
+        for sha256, result in pending.items():
+            filename = attachments[sha256]['filename']
+            if self.pool is not pool:
+                logger.warning(f"Can't extract text of {filename}: the pool was stopped")
+                continue
+            try:
+                results[sha256] = result.get(timeout=timeout + self.timeout_margin), ''
+            except multiprocessing.TimeoutError:
+                # a crashed process never returns either, the pool starts over with the next conversion
+                logger.warning(f"Can't extract text of {filename}: conversion took too long")
+                self.stop(pool)
+            except AttachmentError as ex:
+                # a broken attachment doesn't stop the sync
+                logger.warning(f"Can't extract text of {filename}: {ex}")
+                results[sha256] = '', str(ex)
+            except Exception as ex:
+                logger.warning(f"Can't extract text of {filename} this time: {ex or ex.__class__.__name__}")
+        return results
+
+    def __call__(self, messages):
+        """
+        Sets attachment_text of the messages with attachments, drops the attachment data
+        """
+        attachments = {}
+        for message in messages:
+            for attachment in message.get('attachments', []):
+                attachments[attachment['sha256']] = attachment
+        if not attachments:
+            return messages
+        texts = dict(AttachmentText.objects.filter(sha256__in=attachments).values_list('sha256', 'text'))
+        new = {sha256: attachment for sha256, attachment in attachments.items() if sha256 not in texts}
+        if new:
+            converted = self.convert(new)
+            # another sync may have converted the same attachment meanwhile
+            AttachmentText.objects.bulk_create([
+                AttachmentText(sha256=sha256, text=text, error=error) for sha256, (text, error) in converted.items()
+            ], ignore_conflicts=True)
+            texts.update({sha256: text for sha256, (text, _) in converted.items()})
+            logger.info(f'Extracted text of {len(new)} attachments, {len(attachments) - len(new)} were cached')
+        for message in messages:
+            # the ones given up on are not cached, they are converted again when they come next time
+            message['attachment_text'] = '\n\n'.join(
+                texts[attachment['sha256']] for attachment in message.pop('attachments', [])
+                if texts.get(attachment['sha256'])
+            )
+        return messages
@@ -0,0 +1,151 @@
+import json
+import logging
+import os
+import time
+import tracemalloc
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.db import connection
+from django.db.backends.base.creation import TEST_DATABASE_PREFIX
+from django.test import override_settings
+from social_django.models import UserSocialAuth
+
+from crm import gmail_utils, sync_profile
+from crm.fake_gmail import FakeGmailServer, FakeMailbox
+from crm.mail_text import extract_text
+from crm.models import Company, Employee, Project, ProjectMessage
+
+logger = logging.getLogger('benchmark')
+
+# anonymized messages of the common mail clients, expected.json tells what their text must and mustn't contain
+MAIL_CORPUS = os.path.join(os.path.dirname(__file__), 'mail_corpus')
+
+
+@contextmanager
+def test_database():
+    """
+    Runs in a throwaway test database, the benchmark creates thousands of projects
+    """
+    old_name = connection.creation.create_test_db(verbosity=0, autoclobber=True)
+    try:
+        yield
+    finally:
+        connection.creation.destroy_test_db(old_name, verbosity=0)
+
+
+def create_social_auth():
+    user, _ = get_user_model().objects.get_or_create(username='benchmark', email='me@example.com')
+    return UserSocialAuth.objects.create(user=user, provider='google-oauth2', uid='me@example.com', extra_data={
+        'access_token': 'benchmark',
+        'refresh_token': 'benchmark',
+        'expires': 24 * 60 * 60,
+    })
+
+
+def is_test_database():
+    name = str(connection.settings_dict['NAME'])
+    # sqlite test databases live in memory unless they are named
+    return os.path.basename(name).startswith(TEST_DATABASE_PREFIX) or name == ':memory:' or 'mode=memory' in name
+
+
+def clean():
+    """
+    Deletes the synced data and the accounts, refuses to do it outside of a test database
+    """
+    if not is_test_database():
+        raise RuntimeError(f'{connection.settings_dict["NAME"]} is not a test database, run the benchmark in '
+                           f'test_database()')
+    for model in (ProjectMessage, Project, Employee, Company, UserSocialAuth):
+        model.objects.all().delete()
+
+
+def measure_sync(size, mime_mix=None, attachment_size=50 * 1024, throttle=False, trace_memory=True, mode='messages'):
+    """
+    Syncs a fake mailbox of size messages from scratch, returns the throughput, the calls made and the peak memory
+    """
+    mailbox = FakeMailbox(size, mime_mix=mime_mix, attachment_size=attachment_size)
+    overrides = {
+        'GMAIL_SYNC_MODE': mode,
+        'SOCIAL_AUTH_GOOGLE_OAUTH2_KEY': 'benchmark',
+        'SOCIAL_AUTH_GOOGLE_OAUTH2_SECRET': 'benchmark',
+        'AUTHENTICATION_BACKENDS': ['social_core.backends.google.GoogleOAuth2',
+                                    'django.contrib.auth.backends.ModelBackend'],
+    }
+    if not throttle:
+        # the fake server has no quota, only the sync itself is measured
+        overrides['GMAIL_QUOTA_UNITS_PER_SECOND'] = 10 ** 9
+    with FakeGmailServer(mailbox) as server, override_settings(GMAIL_API_ROOT_URL=server.url, **overrides):
+        clean()
+        create_social_auth()
+        gmail_utils.services.clear()
+        if trace_memory:
+            tracemalloc.start()
+        phases = sync_profile.timings.stats()
+        started = time.perf_counter()
+        try:
+            project_messages = gmail_utils.sync()
+        finally:
+            duration = time.perf_counter() - started
+            peak = tracemalloc.get_traced_memory()[1] if trace_memory else None
+            tracemalloc.stop()
+        calls = dict(server.calls)
+        phases = sync_profile.report(phases, sync_profile.timings.stats())
+    return {
+        'size': size,
+        'synced': len(project_messages),
+        'seconds': round(duration, 2),
+        'messages_per_second': round(len(project_messages) / duration, 1),
+        'http_calls': calls.pop('http', 0),
+        'api_calls': calls,
+        'phase_seconds': {row['phase']: row['seconds'] for row in phases},
+        'peak_memory_mb': round(peak / 1024 / 1024, 1) if peak is not None else None,
+    }
+
+
+def benchmark_sync(sizes, **kwargs):
+    with test_database():
+        results = []
+        for size in sizes:
+            logger.info(f'Syncing {size} fake messages')
+            results.append(measure_sync(size, **kwargs))
+        return results
+
+
+def check_text(text, expected):
+    """
+    Returns what's wrong with the text extracted from a corpus message
+    """
+    failures = [f'missing {snippet!r}' for snippet in expected.get('contains', []) if snippet not in text]
+    failures += [f'contains {snippet!r}' for snippet in expected.get('excludes', []) if snippet in text]
+    return failures
+
+
+def benchmark_text(corpus=MAIL_CORPUS, rounds=100):
+    """
+    Parses every corpus message and extracts its text rounds times,
+    returns the mean times in microseconds and the failed expectations
+    """
+    with open(os.path.join(corpus, 'expected.json')) as f:
+        expectations = json.load(f)
+    parser = gmail_utils.StreamingParser
+    results = []
+    for name, expected in sorted(expectations.items()):
+        with open(os.path.join(corpus, name), 'rb') as f:
+            raw = f.read()
+        started = time.perf_counter()
+        for _ in range(rounds):
+            email_message = parser(settings.GMAIL_MESSAGE_SIZE_LIMIT).parse_bytes(raw)
+        parsed = time.perf_counter()
+        for _ in range(rounds):
+            text = extract_text(email_message)
+        extracted = time.perf_counter()
+        results.append({
+            'name': name,
+            'bytes': len(raw),
+            'parse_us': round((parsed - started) / rounds * 10 ** 6, 1),
+            'extract_us': round((extracted - parsed) / rounds * 10 ** 6, 1),
+            'failures': check_text(text, expected),
+        })
+    return results
@@ -0,0 +1,445 @@
+"""
+Local stand-in for the gmail api endpoints used by gmail_utils, serves a synthetic mailbox.
+Used for measuring the sync without a real google account, see inv benchmark-sync.
+"""
+import base64
+import json
+import logging
+import random
+import re
+import threading
+import time
+from collections import Counter
+from email.mime.application import MIMEApplication
+from email.mime.multipart import MIMEMultipart
+from email.mime.text import MIMEText
+from email.parser import Parser
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+logger = logging.getLogger('fake_gmail')
+
+LABEL_ID = 'Label_1'
+FIRST_HISTORY_ID = 1000
+PAGE_SIZE = 100
+MAX_PAGE_SIZE = 500
+# seconds gmail keeps a watch
+WATCH_DURATION = 7 * 24 * 60 * 60
+# milliseconds, messages arrive a minute after each other
+FIRST_MESSAGE_TIMESTAMP = 1625479200000
+# share of the message kinds in the mailbox
+DEFAULT_MIME_MIX = {
+    'plain': 5,
+    'alternative': 3,
+    'attachment': 2,
+}
+WORDS = ('python django developer remote project freelance contract backend api cloud aws team '
+         'months start asap rate location berlin munich hamburg requirements experience senior').split()
+
+
+def payload(part, part_id=''):
+    """
+    Mime part in gmail's full format, the attachments are left out like gmail does
+    """
+    result = {
+        'partId': part_id,
+        'mimeType': part.get_content_type(),
+        'filename': part.get_filename() or '',
+        'headers': [{'name': name, 'value': value} for name, value in part.items()],
+    }
+    if part.is_multipart():
+        result['body'] = {'size': 0}
+        result['parts'] = [payload(sub_part, f'{part_id}.{index}'.lstrip('.'))
+                           for index, sub_part in enumerate(part.get_payload())]
+        return result
+    data = part.get_payload(decode=True)
+    if part.get_filename():
+        result['body'] = {'attachmentId': f'attachment-{part_id}', 'size': len(data)}
+    else:
+        result['body'] = {'size': len(data), 'data': base64.urlsafe_b64encode(data).decode()}
+    return result
+
+
+class FakeMailbox:
+    """
+    Synthetic mailbox of size messages, all labeled with the crm label.
+    Messages are generated from their index on request, so a big mailbox doesn't take any memory.
+    """
+
+    def __init__(self, size, mime_mix=None, label=None, seed=0, attachment_size=200 * 1024):
+        from django.conf import settings
+        self.size = size
+        self.mime_mix = mime_mix or DEFAULT_MIME_MIX
+        self.label = label or settings.MAILBOX_LABEL
+        self.seed = seed
+        self.attachment_size = attachment_size
+        self.sent = []
+        self.watched_labels = None
+        self.lock = threading.Lock()
+        # roughly 20 messages per sender, so the senders repeat like in a real mailbox
+        self.senders = max(1, size // 20)
+
+    @property
+    def history_id(self):
+        return FIRST_HISTORY_ID + self.size
+
+    def add(self, count):
+        """Simulates new messages arriving"""
+        with self.lock:
+            self.size += count
+
+    def message_id(self, index):
+        return f'{self.seed:04x}{index:012x}'
+
+    def index(self, message_id):
+        index = int(message_id[4:], 16)
+        if not message_id.startswith(f'{self.seed:04x}') or index >= self.size:
+            raise KeyError(message_id)
+        return index
+
+    def kind(self, index):
+        kinds, weights = zip(*self.mime_mix.items())
+        return random.Random(f'{self.seed}-{index}').choices(kinds, weights)[0]
+
+    def thread_id(self, index):
+        # every third message is a reply in the thread of the previous one
+        return self.message_id(index - index % 3)
+
+    def thread_indexes(self, thread_id):
+        start = self.index(thread_id)
+        if start % 3:
+            raise KeyError(thread_id)
+        return range(start, min(start + 3, self.size))
+
+    def labels(self):
+        return {'labels': [
+            {'id': 'INBOX', 'name': 'INBOX', 'type': 'system'},
+            {'id': 'SENT', 'name': 'SENT', 'type': 'system'},
+            {'id': LABEL_ID, 'name': self.label, 'type': 'user'},
+        ]}
+
+    def profile(self):
+        return {
+            'emailAddress': 'me@example.com',
+            'messagesTotal': self.size,
+            'threadsTotal': self.size // 3,
+            'historyId': str(self.history_id),
+        }
+
+    def reference(self, index):
+        return {'id': self.message_id(index), 'threadId': self.thread_id(index)}
+
+    def list(self, page_token=None, max_results=PAGE_SIZE):
+        start = int(page_token or 0)
+        end = min(start + min(max_results, MAX_PAGE_SIZE), self.size)
+        result = {
+            'messages': [self.reference(index) for index in range(start, end)],
+            'resultSizeEstimate': self.size,
+        }
+        if end < self.size:
+            result['nextPageToken'] = str(end)
+        return result
+
+    def list_threads(self, page_token=None, max_results=PAGE_SIZE):
+        start = int(page_token or 0)
+        threads = range(0, self.size, 3)
+        end = min(start + min(max_results, MAX_PAGE_SIZE), len(threads))
+        result = {
+            'threads': [{'id': self.message_id(index)} for index in threads[start:end]],
+            'resultSizeEstimate': len(threads),
+        }
+        if end < len(threads):
+            result['nextPageToken'] = str(end)
+        return result
+
+    def history(self, start_history_id, page_token=None, max_results=PAGE_SIZE):
+        start = max(int(page_token or 0), int(start_history_id) - FIRST_HISTORY_ID)
+        end = min(start + min(max_results, MAX_PAGE_SIZE), self.size)
+        result = {
+            'history': [{
+                'id': str(FIRST_HISTORY_ID + index + 1),
+                'messagesAdded': [{'message': {**self.reference(index), 'labelIds': ['INBOX', LABEL_ID]}}],
+            } for index in range(start, end)],
+            'historyId': str(self.history_id),
+        }
+        if end < self.size:
+            result['nextPageToken'] = str(end)
+        return result
+
+    def get(self, message_id, message_format='raw'):
+        index = self.index(message_id)
+        mime = self.mime(index)
+        raw = mime.as_bytes()
+        result = {
+            **self.reference(index),
+            'labelIds': ['INBOX', LABEL_ID],
+            'historyId': str(FIRST_HISTORY_ID + index + 1),
+            'internalDate': str(FIRST_MESSAGE_TIMESTAMP + index * 60 * 1000),
+            'sizeEstimate': len(raw),
+        }
+        if message_format == 'raw':
+            result['raw'] = base64.urlsafe_b64encode(raw).decode()
+        else:
+            result['payload'] = payload(mime)
+        return result
+
+    def get_attachment(self, message_id, attachment_id):
+        part = self.mime(self.index(message_id))
+        for index in attachment_id.replace('attachment-', '', 1).split('.'):
+            part = part.get_payload()[int(index)]
+        data = part.get_payload(decode=True)
+        return {'size': len(data), 'data': base64.urlsafe_b64encode(data).decode()}
+
+    def get_thread(self, thread_id):
+        messages = [self.get(self.message_id(index), 'full') for index in self.thread_indexes(thread_id)]
+        return {'id': thread_id, 'historyId': messages[-1]['historyId'], 'messages': messages}
+
+    def mime(self, index):
+        rnd = random.Random(f'{self.seed}-{index}-body')
+        kind = self.kind(index)
+        sender = rnd.randrange(self.senders)
+        text = '\n\n'.join(' '.join(rnd.choices(WORDS, k=40)) for _ in range(5))
+        if kind == 'plain':
+            message = MIMEText(text)
+        else:
+            message = MIMEMultipart('alternative')
+            message.attach(MIMEText(text))
+            html = ''.join(f'<p>{paragraph}</p>' for paragraph in text.split('\n\n'))
+            message.attach(MIMEText(f'<html><body>{html}</body></html>', 'html'))
+            if kind == 'attachment':
+                alternative, message = message, MIMEMultipart('mixed')
+                message.attach(alternative)
+                attachment = MIMEApplication(rnd.randbytes(self.attachment_size), 'pdf')
+                attachment.add_header('Content-Disposition', 'attachment', filename='project.pdf')
+                message.attach(attachment)
+        message['From'] = f'Recruiter{sender} Agent{sender} <agent{sender}@agency{sender % 50}.example.com>'
+        message['To'] = 'me@example.com'
+        message['Subject'] = f'Project {index // 3}: {" ".join(rnd.choices(WORDS, k=4))}'
+        message['Date'] = 'Mon, 05 Jul 2021 10:00:00 +0000'
+        message['Message-ID'] = f'<{self.message_id(index)}@example.com>'
+        message['Reply-To'] = f'agent{sender}@agency{sender % 50}.example.com'
+        return message
+
+    def watch(self, body):
+        self.watched_labels = body['labelIds']
+        return {
+            'historyId': str(self.history_id),
+            'expiration': str(int((time.time() + WATCH_DURATION) * 1000)),
+        }
+
+    def send(self, raw):
+        with self.lock:
+            self.sent.append(raw)
+            index = len(self.sent)
+        return {'id': f'sent{index:012x}', 'threadId': f'sent{index:012x}', 'labelIds': ['SENT']}
+
+
+class FakeGmailHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    routes = (
+        ('GET', r'/gmail/v1/users/[^/]+/labels', 'labels'),
+        ('GET', r'/gmail/v1/users/[^/]+/profile', 'profile'),
+        ('GET', r'/gmail/v1/users/[^/]+/messages', 'messages.list'),
+        ('GET', r'/gmail/v1/users/[^/]+/messages/(?P<message_id>[^/]+)', 'messages.get'),
+        ('GET', r'/gmail/v1/users/[^/]+/messages/(?P<message_id>[^/]+)/attachments/(?P<attachment_id>[^/]+)',
+         'messages.attachments.get'),
+        ('GET', r'/gmail/v1/users/[^/]+/threads', 'threads.list'),
+        ('GET', r'/gmail/v1/users/[^/]+/threads/(?P<message_id>[^/]+)', 'threads.get'),
+        ('GET', r'/gmail/v1/users/[^/]+/history', 'history.list'),
+        ('POST', r'/gmail/v1/users/[^/]+/messages/send', 'messages.send'),
+        ('POST', r'/gmail/v1/users/[^/]+/watch', 'watch'),
+    )
+
+    # only resumable uploads (uploadType=resumable) are faked
+    upload_path = r'/upload/gmail/v1/users/[^/]+/messages/send'
+
+    def log_message(self, format, *args):
+        logger.debug(format % args)
+
+    def do_GET(self):
+        self.server.count('http')
+        self.respond(*self.dispatch('GET', self.path))
+
+    def do_POST(self):
+        self.server.count('http')
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        path = urlparse(self.path).path
+        if path == '/batch':
+            self.respond_batch(body)
+        elif re.fullmatch(self.upload_path, path):
+            self.start_upload()
+        else:
+            self.respond(*self.dispatch('POST', self.path, body))
+
+    def do_PUT(self):
+        self.server.count('http')
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        self.continue_upload(urlparse(self.path).path.rsplit('/', 1)[-1], body)
+
+    def start_upload(self):
+        """
+        Starts a resumable upload of a message to send, the chunks are put to the returned location
+        """
+        self.server.count('messages.send')
+        upload_id = self.server.start_upload(int(self.headers['X-Upload-Content-Length']))
+        self.respond_empty(200, Location=f'http://{self.headers["Host"]}/upload/{upload_id}')
+
+    def continue_upload(self, upload_id, body):
+        self.server.count('upload')
+        # bytes <first>-<last>/<total>, the first byte has to follow the ones uploaded before
+        first, last, total = map(int, re.fullmatch(r'bytes (\d+)-(\d+)/(\d+)', self.headers['Content-Range']).groups())
+        data = self.server.uploads[upload_id]
+        if first != len(data) or last - first + 1 != len(body) or total != self.server.upload_sizes[upload_id]:
+            self.respond(400, {'error': {'code': 400, 'message': 'Wrong Content-Range'}})
+            return
+        data += body
+        if len(data) < total:
+            self.respond_empty(308, Range=f'bytes=0-{len(data) - 1}')
+            return
+        self.respond(200, self.server.mailbox.send(base64.urlsafe_b64encode(bytes(data)).decode()))
+
+    def respond_empty(self, status, **headers):
+        self.send_response(status)
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def dispatch(self, method, path, body=b''):
+        url = urlparse(path)
+        query = {key: values[0] for key, values in parse_qs(url.query).items()}
+        for route_method, pattern, name in self.routes:
+            match = re.fullmatch(pattern, url.path)
+            if route_method == method and match:
+                self.server.count(name)
+                try:
+                    return 200, self.handle_api(name, query, body, **match.groupdict())
+                except KeyError:
+                    return 404, {'error': {'code': 404, 'message': 'Requested entity was not found.'}}
+        return 404, {'error': {'code': 404, 'message': f'{method} {url.path} is not faked'}}
+
+    def handle_api(self, name, query, body, message_id=None, attachment_id=None):
+        mailbox = self.server.mailbox
+        page = query.get('pageToken'), int(query.get('maxResults', PAGE_SIZE))
+        handlers = {
+            'labels': mailbox.labels,
+            'profile': mailbox.profile,
+            'messages.list': lambda: mailbox.list(*page),
+            'messages.get': lambda: mailbox.get(message_id, query.get('format', 'raw')),
+            'messages.attachments.get': lambda: mailbox.get_attachment(message_id, attachment_id),
+            'threads.list': lambda: mailbox.list_threads(*page),
+            'threads.get': lambda: mailbox.get_thread(message_id),
+            'history.list': lambda: mailbox.history(query['startHistoryId'], *page),
+            'messages.send': lambda: mailbox.send(json.loads(body)['raw']),
+            'watch': lambda: mailbox.watch(json.loads(body)),
+        }
+        return handlers[name]()
+
+    def respond(self, status, data):
+        content = json.dumps(data).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json; charset=UTF-8')
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def respond_batch(self, body):
+        """
+        Answers a multipart/mixed batch request, every part is an http request of its own
+        """
+        request = Parser().parsestr(f'Content-Type: {self.headers["Content-Type"]}\r\n\r\n{body.decode()}')
+        boundary = 'batch_fake_gmail'
+        parts = []
+        for part in request.get_payload():
+            request_line = part.get_payload().split('\n', 1)[0]
+            method, path, _ = request_line.split(' ', 2)
+            status, data = self.dispatch(method, path)
+            content_id = part['Content-ID'].strip('<>')
+            parts.append(
+                f'--{boundary}\r\n'
+                f'Content-Type: application/http\r\n'
+                f'Content-ID: <response-{content_id}>\r\n\r\n'
+                f'HTTP/1.1 {status} {"OK" if status == 200 else "Not Found"}\r\n'
+                f'Content-Type: application/json; charset=UTF-8\r\n\r\n'
+                f'{json.dumps(data)}\r\n'
+            )
+        content = (''.join(parts) + f'--{boundary}--\r\n').encode()
+        self.send_response(200)
+        self.send_header('Content-Type', f'multipart/mixed; boundary={boundary}')
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+
+class FakeGmailServer(ThreadingHTTPServer):
+    """
+    Serves the mailbox on a free local port in a background thread, counts the calls per endpoint.
+    Point the sync to it with GMAIL_API_ROOT_URL = server.url
+    """
+    daemon_threads = True
+
+    def __init__(self, mailbox):
+        super().__init__(('127.0.0.1', 0), FakeGmailHandler)
+        self.mailbox = mailbox
+        self.calls = Counter()
+        # resumable uploads of the messages sent, the bytes received and the size announced
+        self.uploads = {}
+        self.upload_sizes = {}
+        self.calls_lock = threading.Lock()
+        self.thread = None
+
+    @property
+    def url(self):
+        host, port = self.server_address
+        return f'http://{host}:{port}/'
+
+    def count(self, name):
+        with self.calls_lock:
+            self.calls[name] += 1
+
+    def start_upload(self, size):
+        with self.calls_lock:
+            upload_id = f'upload{len(self.uploads)}'
+            self.uploads[upload_id] = bytearray()
+            self.upload_sizes[upload_id] = size
+        return upload_id
+
+    def __enter__(self):
+        self.thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def __exit__(self, *args):
+        self.shutdown()
+        self.server_close()
+        self.thread.join()
+
+
+class FakePubSub:
+    """
+    Stand-in for the pub/sub push subscription delivering gmail notifications to the push endpoint.
+    post is a callable like django test client's post or requests.post.
+    """
+
+    def __init__(self, post, endpoint, subscription='projects/freeturn/subscriptions/gmail'):
+        self.post = post
+        self.endpoint = endpoint
+        self.subscription = subscription
+        self.published = 0
+
+    def envelope(self, email_address, history_id):
+        self.published += 1
+        data = json.dumps({'emailAddress': email_address, 'historyId': int(history_id)})
+        return {
+            'message': {
+                'data': base64.b64encode(data.encode()).decode(),
+                'messageId': str(self.published),
+                'publishTime': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+            },
+            'subscription': self.subscription,
+        }
+
+    def publish(self, email_address, history_id):
+        return self.post(self.endpoint,
+                         data=json.dumps(self.envelope(email_address, history_id)),
+                         content_type='application/json')
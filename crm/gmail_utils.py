@@ -1,112 +1,706 @@
 import base64
 import email
+import hashlib
+import io
+import json
 import logging
-from datetime import datetime
+import queue
+import random
+import tempfile
+import threading
+import time
+import uuid
+import weakref
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from datetime import datetime, timedelta
 from email.mime.application import MIMEApplication
 from email.mime.base import MIMEBase
 from email.mime.multipart import MIMEMultipart
 from email.mime.text import MIMEText
+from email.parser import BytesFeedParser
+from email.utils import parseaddr
 
 import pytz
 from django.conf import settings
-from django.contrib.auth import get_user_model
+from django.core.cache import cache
+from django.db import connections, transaction
 from django.db.models import Q
-from googleapiclient import discovery
+from django.db.models.functions import Lower
+from django.utils import timezone
+from googleapiclient import discovery, discovery_cache
+from googleapiclient.errors import HttpError
+from googleapiclient.http import MediaIoBaseUpload
+from redis.exceptions import LockError
+from social_django.models import UserSocialAuth
 
-from crm.models.company import Company
+from crm.attachment_text import AttachmentTexts, attachment_kind, find_attachments
+from crm.mail_text import extract_text
+from crm.models.company import Company, normalize_domain
+from crm.models.cv import CVRequest
 from crm.models.employee import Employee
+from crm.models.mailbox import Mailbox
 from crm.models.project import Project
 from crm.models.project_message import ProjectMessage
-from crm.utils import Credentials
+from crm.sync_profile import log_report, report, timings
+from crm.utils import Credentials, chunked
 
 logger = logging.getLogger('gmail_utils')
 
 
-def remove_quotation(text):
-    lines = text.splitlines()
-    outer_quotation_started = False
-    for i, line in enumerate(lines):
-        if line.startswith('>'):
-            if outer_quotation_started:
-                return '\n'.join(lines[:i])
-            else:
-                outer_quotation_started = True
-    return text
-
-
-def extract_text(email_message):
-    main_type = email_message.get_content_maintype()
-    if main_type == 'multipart':
-        for part in email_message.get_payload():
-            charset = part.get_content_charset()
-            if part.get_content_maintype() == 'text':
-                if part.get_content_subtype() == 'plain':
-                    return part.get_payload(decode=True).decode(charset, 'replace')
-            if part.get_content_maintype() == 'multipart':
-                return extract_text(part)
-    elif main_type == 'text':
-        charset = email_message.get_content_charset()
-        return email_message.get_payload(decode=True).decode(charset or 'utf-8', 'replace')
-    else:
-        logger.error(f'Unknown main mime type {main_type}')
-        return ''
+class PartMessage(email.message.Message):
+    """
+    Message part built by StreamingParser, keeps its payload only if the parser still needs it
+    """
+    parser = None
+
+    def set_payload(self, payload, charset=None):
+        if not self.parser.keep_payload(self, payload):
+            payload = ''
+        super().set_payload(payload, charset)
+
+
+class StreamingParser:
+    """
+    Parses raw gmail messages feeding them chunk by chunk instead of decoding them at once.
+    Payloads of the parts that can't hold the text body, like attachments, are dropped as soon as
+    the part is parsed, the same goes for all the text parts after the first text/plain one.
+    Only pdf and docx attachments up to attachment_size_limit bytes are kept for their text.
+    Messages bigger than size_limit are cut off.
+    """
+    chunk_size = 64 * 1024  # base64 characters, must be a multiple of 4
 
+    def __init__(self, size_limit, attachment_size_limit=0):
+        self.size_limit = size_limit
+        self.attachment_size_limit = attachment_size_limit
+        self.text_found = False
+        self.fed = 0
+        self.parser = BytesFeedParser(_factory=self.new_part)
 
-def parse_message(message):
-    msg_str = base64.urlsafe_b64decode(message['raw'].encode('ASCII'))
-    email_message = email.message_from_bytes(msg_str)
-    if email_message['from']:
+    def new_part(self):
+        part = PartMessage()
+        part.parser = self
+        return part
+
+    def keep_payload(self, part, payload):
+        main_type = part.get_content_maintype()
+        if main_type == 'multipart':
+            return True
+        if attachment_kind(part.get_content_type(), part.get_filename()):
+            # base64 takes a third more than the data
+            return bool(payload) and len(payload) * 3 // 4 <= self.attachment_size_limit
+        if main_type != 'text' or self.text_found or part.get_content_disposition() == 'attachment':
+            return False
+        if part.get_content_subtype() == 'plain':
+            self.text_found = True
+        return True
+
+    def feed(self, data):
+        """
+        Feeds the next part of the message, returns False once the size limit is reached
+        """
+        if self.fed + len(data) > self.size_limit:
+            self.parser.feed(data[:self.size_limit - self.fed])
+            self.fed = self.size_limit
+            logger.warning(f'Message is bigger than {self.size_limit} bytes, the rest is skipped')
+            return False
+        self.parser.feed(data)
+        self.fed += len(data)
+        return True
+
+    def parse(self, raw):
+        """
+        Parses base64url encoded raw message as returned by gmail
+        """
+        for start in range(0, len(raw), self.chunk_size):
+            chunk = raw[start:start + self.chunk_size]
+            if not self.feed(base64.urlsafe_b64decode(chunk + '=' * (-len(chunk) % 4))):
+                break
+        return self.parser.close()
+
+    def parse_bytes(self, data):
+        """
+        Parses the message as it's stored in .eml or mbox files
+        """
+        for start in range(0, len(data), self.chunk_size):
+            if not self.feed(data[start:start + self.chunk_size]):
+                break
+        return self.parser.close()
+
+
+def parse_email(email_message):
+    """
+    Fields of a parsed email message, the gmail ones are added by parse_message
+    """
+    if email_message['from'] and '<' in email_message['from']:
         from_address = email_message['from'][email_message['from'].index('<') + 1:-1]
         full_name = email_message['from'].replace(f'<{from_address}>', '').strip()
+    elif email_message['from']:
+        full_name, from_address = parseaddr(email_message['from'])
     else:
         from_address = 'unknown'
         full_name = 'unknown'
+    # long headers are folded, the archived messages get the Message-ID on a line of its own
+    message_id = email_message['message-id']
     result = {
-        'sent_at': datetime.utcfromtimestamp(int(message['internalDate']) / 1000).replace(tzinfo=pytz.utc),
         'subject': email_message['subject'],
         'from_address': from_address,
         'full_name': full_name,
-        'gmail_thread_id': message['threadId'],
-        'gmail_message_id': message['id'],
-        'message_id': email_message['message-id'],
+        'message_id': message_id.strip() if message_id else message_id,
         'reply-to': email_message['reply-to']
     }
     text = extract_text(email_message)
     if text:
-        result['text'] = remove_quotation(text)
+        result['text'] = text
+    if settings.GMAIL_ATTACHMENT_SIZE_LIMIT:
+        attachments = find_attachments(email_message, settings.GMAIL_ATTACHMENT_SIZE_LIMIT)
+        if attachments:
+            result['attachments'] = attachments
     return result
 
 
+def gmail_fields(message):
+    return {
+        'sent_at': datetime.utcfromtimestamp(int(message['internalDate']) / 1000).replace(tzinfo=pytz.utc),
+        'gmail_thread_id': message['threadId'],
+        'gmail_message_id': message['id'],
+    }
+
+
+def parse_message(message, streaming=True):
+    if streaming:
+        email_message = StreamingParser(settings.GMAIL_MESSAGE_SIZE_LIMIT,
+                                        settings.GMAIL_ATTACHMENT_SIZE_LIMIT).parse(message['raw'])
+    else:
+        msg_str = base64.urlsafe_b64decode(message['raw'].encode('ASCII'))
+        email_message = email.message_from_bytes(msg_str)
+    return {
+        **gmail_fields(message),
+        **parse_email(email_message),
+    }
+
+
+def payload_to_email(payload):
+    """
+    Email message of a message part in gmail's full format. Gmail decodes the bodies and leaves out
+    the attachments, so the parts are taken as they are.
+    """
+    part = email.message.Message()
+    for header in payload.get('headers', []):
+        # the body is decoded already
+        if header['name'].lower() != 'content-transfer-encoding':
+            part[header['name']] = header['value']
+    if payload.get('parts'):
+        part.set_payload([payload_to_email(sub_payload) for sub_payload in payload['parts']])
+    else:
+        data = payload.get('body', {}).get('data', '')
+        body = base64.urlsafe_b64decode(data + '=' * (-len(data) % 4))
+        # get_payload(decode=True) gives the bytes back
+        part.set_payload(body.decode('ascii', 'surrogateescape'))
+    return part
+
+
+def parse_thread_message(message):
+    """
+    Parses a message of a thread loaded in gmail's full format into the same dict as parse_message
+    """
+    return {
+        **gmail_fields(message),
+        **parse_email(payload_to_email(message['payload'])),
+    }
+
+
+# https://developers.google.com/gmail/api/reference/quota
+QUOTA_UNITS = {
+    'labels.list': 1,
+    'getProfile': 1,
+    'history.list': 2,
+    'messages.list': 5,
+    'messages.get': 5,
+    'messages.attachments.get': 5,
+    'threads.list': 10,
+    'threads.get': 10,
+    'messages.send': 100,
+    'watch': 100,
+}
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+# bytes sent with one request of a resumable upload, a multiple of 256 KB
+UPLOAD_CHUNK_SIZE = 1024 * 1024
+BACKOFF_BASE = 1
+BACKOFF_MAX = 32
+
+
+def is_retryable(ex):
+    if not isinstance(ex, HttpError):
+        return False
+    # gmail reports rate limits as 403 too
+    return ex.resp.status in RETRY_STATUSES or (
+        ex.resp.status == 403 and b'ratelimitexceeded' in ex.content.lower()
+    )
+
+
+class Quota:
+    """
+    Quota units budget of a gmail account, shared by all the threads using it.
+    Requests wait until there are enough units, so the account stays under the per user rate limit.
+    Also counts the requests, retries and the time spent waiting.
+    """
+
+    def __init__(self, units_per_second=None):
+        self.units_per_second = units_per_second or settings.GMAIL_QUOTA_UNITS_PER_SECOND
+        self.available = self.units_per_second
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.units = 0
+        self.retries = 0
+        self.throttled = 0.0
+
+    def spend(self, units):
+        with self.lock:
+            now = time.monotonic()
+            self.available = min(self.units_per_second,
+                                 self.available + (now - self.updated) * self.units_per_second)
+            self.updated = now
+            wait = (units - self.available) / self.units_per_second
+            if wait > 0:
+                # holding the lock, other threads of the account wait as well
+                time.sleep(wait)
+                self.throttled += wait
+                self.available = units
+                self.updated = time.monotonic()
+            self.available -= units
+            self.requests += 1
+            self.units += units
+
+    def backoff(self, attempt):
+        """
+        Sleeps exponentially longer with every attempt, randomized so the retrying threads don't collide
+        """
+        delay = random.uniform(0, min(BACKOFF_MAX, BACKOFF_BASE * 2 ** attempt))
+        with self.lock:
+            self.retries += 1
+            self.throttled += delay
+        time.sleep(delay)
+        return delay
+
+    def stats(self):
+        with self.lock:
+            return {
+                'requests': self.requests,
+                'units': self.units,
+                'retries': self.retries,
+                'throttled': round(self.throttled, 2),
+            }
+
+
+def execute(service, request, units):
+    """
+    Executes a gmail api request within the quota of the account, retries on rate limits and server errors
+    """
+    quota = services.quota(service)
+    attempt = 0
+    while True:
+        quota.spend(units)
+        try:
+            return request.execute()
+        except HttpError as ex:
+            if not is_retryable(ex) or attempt >= settings.GMAIL_MAX_RETRIES:
+                raise
+            delay = quota.backoff(attempt)
+            logger.warning(f'{ex}, retried after {delay:.2f}s')
+            attempt += 1
+
+
 def get_labels(service):
-    return service.users().labels().list(userId='me').execute()
+    return execute(service, service.users().labels().list(userId='me'), QUOTA_UNITS['labels.list'])
 
 
-def get_message_ids(service, label_id):
-    return service.users().messages().list(userId='me', labelIds=[label_id, 'INBOX']).execute()
+def get_profile(service):
+    return execute(service, service.users().getProfile(userId='me'), QUOTA_UNITS['getProfile'])
+
+
+def get_message_ids(service, label_id, page_token=None):
+    request = service.users().messages().list(userId='me',
+                                              labelIds=[label_id, 'INBOX'],
+                                              pageToken=page_token,
+                                              fields='messages(id,threadId),nextPageToken')
+    return execute(service, request, QUOTA_UNITS['messages.list'])
+
+
+def get_thread_ids(service, label_id, page_token=None):
+    request = service.users().threads().list(userId='me',
+                                             labelIds=[label_id, 'INBOX'],
+                                             pageToken=page_token,
+                                             fields='threads(id),nextPageToken')
+    return execute(service, request, QUOTA_UNITS['threads.list'])
+
+
+def get_history(service, label_id, start_history_id, page_token=None):
+    request = service.users().history().list(userId='me',
+                                             labelId=label_id,
+                                             startHistoryId=start_history_id,
+                                             historyTypes=['messageAdded', 'labelAdded'],
+                                             pageToken=page_token,
+                                             fields='history(messagesAdded/message(id,threadId,labelIds),'
+                                                    'labelsAdded/message(id,threadId,labelIds)),'
+                                                    'nextPageToken,historyId')
+    return execute(service, request, QUOTA_UNITS['history.list'])
 
 
 def get_message_raws(service, message_id):
-    return service.users().messages().get(userId='me',
-                                          id=message_id, format='raw').execute()
+    request = service.users().messages().get(userId='me', id=message_id, format='raw')
+    return execute(service, request, QUOTA_UNITS['messages.get'])
+
+
+def get_attachment(service, message_id, attachment_id):
+    request = service.users().messages().attachments().get(userId='me', messageId=message_id, id=attachment_id)
+    return execute(service, request, QUOTA_UNITS['messages.attachments.get'])
 
 
-def get_raw_messages(service):
+def load_attachments(service, message):
+    """
+    Loads the data of the pdf and docx attachments into a message in gmail's full format, gmail leaves it out
+    """
+    parts = [message['payload']]
+    while parts:
+        part = parts.pop()
+        parts += part.get('parts', [])
+        body = part.get('body', {})
+        if (body.get('attachmentId') and body.get('size', 0) <= settings.GMAIL_ATTACHMENT_SIZE_LIMIT
+                and attachment_kind(part.get('mimeType'), part.get('filename'))):
+            body['data'] = get_attachment(service, message['id'], body['attachmentId'])['data']
+    return message
+
+
+def get_thread(service, thread_id):
+    request = service.users().threads().get(userId='me', id=thread_id, format='full')
+    return execute(service, request, QUOTA_UNITS['threads.get'])
+
+
+def execute_batch(service, resource, ids, units, **params):
+    """
+    Gets the items of the resource (messages or threads) with a single gmail batch request,
+    the order of ids is kept. Items failed because of rate limits are requested again with a backoff.
+    """
+    responses = {}
+    failed = {}
+
+    def callback(request_id, response, exception):
+        if exception:
+            failed[request_id] = exception
+        else:
+            responses[request_id] = response
+
+    pending = list(ids)
+    attempt = 0
+    while pending:
+        failed.clear()
+        batch = service.new_batch_http_request(callback=callback)
+        # building a resource parses its part of the discovery document, so it's done once per batch
+        items = getattr(service.users(), resource)()
+        for item_id in pending:
+            batch.add(items.get(userId='me', id=item_id, **params), request_id=item_id)
+        execute(service, batch, units * len(pending))
+        for exception in failed.values():
+            if not is_retryable(exception) or attempt >= settings.GMAIL_MAX_RETRIES:
+                raise exception
+        pending = [item_id for item_id in pending if item_id in failed]
+        if pending:
+            delay = services.quota(service).backoff(attempt)
+            logger.warning(f'{len(pending)} {resource} of the batch failed, retried after {delay:.2f}s')
+            attempt += 1
+    return [responses[item_id] for item_id in ids]
+
+
+def get_message_raws_batch(service, message_ids):
+    """
+    Loads raw messages with a single gmail batch request, the order of message_ids is kept
+    """
+    return execute_batch(service, 'messages', message_ids, QUOTA_UNITS['messages.get'], format='raw')
+
+
+def get_threads_batch(service, thread_ids):
+    """
+    Loads the threads with all their messages with a single gmail batch request, the order of thread_ids is kept
+    """
+    return execute_batch(service, 'threads', thread_ids, QUOTA_UNITS['threads.get'], format='full')
+
+
+class HistoryExpired(Exception):
+    pass
+
+
+def get_new_message_pages(service, label_id, history_id, page_token=None, threads=False):
+    """
+    Yields (message ids, next page token) page by page for the messages labeled with label_id and
+    lying in the inbox since history_id, the ids of their threads with threads.
+    Raises HistoryExpired if gmail doesn't keep the history that far back.
+    """
+    key = 'threadId' if threads else 'id'
+    seen = set()
+    while True:
+        try:
+            history = get_history(service, label_id, history_id, page_token)
+        except HttpError as ex:
+            if ex.resp.status == 404:
+                raise HistoryExpired(f'History {history_id} is not available anymore') from ex
+            raise
+        message_ids = []
+        for record in history.get('history', []):
+            for change in record.get('messagesAdded', []) + record.get('labelsAdded', []):
+                message = change['message']
+                # INBOX means a message is not archived
+                if {label_id, 'INBOX'}.issubset(message.get('labelIds', [])) and message[key] not in seen:
+                    seen.add(message[key])
+                    message_ids.append(message[key])
+        page_token = history.get('nextPageToken')
+        yield message_ids, page_token
+        if not page_token:
+            return
+
+
+def get_all_message_pages(service, label_id, page_token=None, threads=False):
+    """
+    Yields (message ids, next page token) page by page for all the messages labeled with label_id
+    and lying in the inbox, the ids of their threads with threads
+    """
+    while True:
+        # INBOX means a message is not archived
+        if threads:
+            mail = get_thread_ids(service, label_id, page_token)
+            ids = [thread['id'] for thread in mail.get('threads', [])]
+        else:
+            mail = get_message_ids(service, label_id, page_token)
+            ids = [message['id'] for message in mail.get('messages', [])]
+        page_token = mail.get('nextPageToken')
+        yield ids, page_token
+        if not page_token:
+            return
+
+
+def iter_message_pages(service, label_id, history_id=None, cursor=None, threads=False):
+    """
+    Yields (message ids, cursor) page by page, the messages added after history_id if it's given,
+    all of them if not or if the history is expired. With threads the ids of their threads are listed.
+    The cursor continues the listing after the page, it's None after the last one.
+    A listing interrupted before can be resumed with its cursor.
+    """
+    cursor = cursor or {}
+    full = cursor.get('full') or not history_id
+    page_token = cursor.get('page_token')
+    try:
+        if not full:
+            try:
+                for message_ids, page_token in get_new_message_pages(service, label_id, history_id, page_token,
+                                                                     threads):
+                    yield message_ids, page_token and {'full': False, 'page_token': page_token}
+                return
+            except HistoryExpired as ex:
+                logger.warning(f'{ex}, falling back to full sync')
+                page_token = None
+        for message_ids, page_token in get_all_message_pages(service, label_id, page_token, threads):
+            yield message_ids, page_token and {'full': True, 'page_token': page_token}
+    except HttpError as ex:
+        # page tokens don't live forever, the listing of an interrupted sync starts over then
+        if ex.resp.status != 400 or not cursor:
+            raise
+        logger.warning(f"Can't resume the listing: {ex}, starting over")
+        yield from iter_message_pages(service, label_id, history_id, threads=threads)
+
+
+class ServicePool:
+    """
+    Keeps built gmail services per account for the life of the process, building one parses the whole
+    discovery document. A service is used by one thread at a time, the http client isn't thread safe.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.idle = defaultdict(list)
+        self.account_quotas = {}
+        self.service_quotas = weakref.WeakKeyDictionary()
+
+    @staticmethod
+    def key(usa):
+        # a new refresh token means the account was connected again, the old service is useless
+        return usa.pk, usa.extra_data.get('refresh_token')
+
+    @staticmethod
+    def build(usa):
+        if settings.GMAIL_API_ROOT_URL:
+            # batch requests go to the root url as well, so it's replaced in the document itself
+            document = json.loads(discovery_cache.get_static_doc('gmail', 'v1'))
+            document['rootUrl'] = settings.GMAIL_API_ROOT_URL
+            return discovery.build_from_document(document, credentials=Credentials(usa))
+        # the discovery document bundled with google-api-python-client, no request to google for it
+        return discovery.build('gmail', 'v1',
+                               credentials=Credentials(usa),
+                               static_discovery=True,
+                               cache_discovery=False)
+
+    @contextmanager
+    def get(self, usa):
+        key = self.key(usa)
+        with self.lock:
+            service = self.idle[key].pop() if self.idle[key] else None
+        if service is None:
+            service = self.build(usa)
+            with self.lock:
+                self.service_quotas[service] = self.account_quotas.setdefault(usa.pk, Quota())
+        try:
+            yield service
+        finally:
+            with self.lock:
+                self.idle[key].append(service)
+
+    def quota(self, service):
+        """
+        Quota of the account the service belongs to, services built elsewhere get their own
+        """
+        with self.lock:
+            quota = self.service_quotas.get(service)
+            if quota is None:
+                quota = self.service_quotas[service] = Quota()
+            return quota
+
+    def clear(self):
+        with self.lock:
+            self.idle.clear()
+            self.account_quotas.clear()
+            self.service_quotas.clear()
+
+
+services = ServicePool()
+
+
+def get_label_id(service):
     labels = get_labels(service)
     try:
-        label_id = next(
+        return next(
             label_info['id'] for label_info in labels['labels'] if label_info['name'] == settings.MAILBOX_LABEL
         )
     except StopIteration:
         logger.error(f"Can't find label with {settings.MAILBOX_LABEL}")
-        return []
 
-    # INBOX means a message is not archived
-    mail = get_message_ids(service, label_id)
-    message_ids = [message['id'] for message in mail.get('messages', [])]
-    return [
-        get_message_raws(service, message_id)
-        for message_id in message_ids
-    ]
+
+def get_cached_label_id(service, usa):
+    """
+    Label id of the account, cached for GMAIL_LABEL_CACHE_TTL seconds, labels are hardly ever changed
+    """
+    key = f'gmail-label-id-{usa.pk}-{settings.MAILBOX_LABEL}'
+    label_id = cache.get(key)
+    if not label_id:
+        label_id = get_label_id(service)
+        if label_id:
+            cache.set(key, label_id, settings.GMAIL_LABEL_CACHE_TTL)
+    return label_id
+
+
+def get_known_ids(message_ids):
+    """
+    Ids of the page already stored, a lookup of the unique index instead of loading all the ids
+    """
+    known = ProjectMessage.objects.filter(gmail_message_id__in=message_ids)
+    return set(known.values_list('gmail_message_id', flat=True))
+
+
+def skip_known(message_ids):
+    known_ids = get_known_ids(message_ids)
+    if known_ids:
+        logger.info(f'Skipped {len(known_ids)} already stored messages')
+    return [message_id for message_id in message_ids if message_id not in known_ids]
+
+
+def download(service, ids, get_one, get_batch):
+    """
+    Yields the items (messages or threads) of ids, loaded with batch requests of GMAIL_BATCH_SIZE
+    """
+    batch_size = settings.GMAIL_BATCH_SIZE
+    if batch_size <= 1:
+        for item_id in ids:
+            yield get_one(service, item_id)
+        return
+
+    for batch_ids in chunked(ids, batch_size):
+        started = time.monotonic()
+        yield from get_batch(service, batch_ids)
+        logger.info(f'Loaded batch of {len(batch_ids)} in {time.monotonic() - started:.2f}s')
+
+
+def download_messages(service, message_ids):
+    return download(service, message_ids, get_message_raws, get_message_raws_batch)
+
+
+def download_threads(service, thread_ids):
+    return download(service, thread_ids, get_thread, get_threads_batch)
+
+
+def list_pages(service, label_id, history_id, cursor, threads=False):
+    return timings.iterate('list', iter_message_pages(service, label_id, history_id, cursor, threads),
+                           count=lambda page: len(page[0]))
+
+
+def add_attachment_texts(messages, attachment_texts):
+    # per downloaded batch, the attachment data is dropped before the messages of a page pile up
+    if attachment_texts:
+        with timings.phase('attachments', count=len(messages)):
+            attachment_texts(messages)
+    return messages
+
+
+def get_message_pages(service, history_id=None, label_id=None, cursor=None, attachment_texts=None):
+    """
+    Yields (parsed messages, cursor) page by page, see iter_message_pages for the cursor.
+    The messages already stored are skipped.
+    With attachment_texts the messages come with the texts of their attachments.
+    """
+    for message_ids, page_cursor in list_pages(service, label_id, history_id, cursor):
+        messages = []
+        raw_messages = timings.iterate('download', download_messages(service, skip_known(message_ids)))
+        for batch in chunked(raw_messages, max(settings.GMAIL_BATCH_SIZE, 1)):
+            with timings.phase('parse', count=len(batch)):
+                batch = [parse_message(raw_message) for raw_message in batch]
+            messages += add_attachment_texts(batch, attachment_texts)
+        yield messages, page_cursor
+
+
+def get_thread_pages(service, history_id=None, label_id=None, cursor=None, attachment_texts=None):
+    """
+    Yields (parsed messages, cursor) page by page like get_message_pages, but loads every changed thread
+    once with all its messages, so the messages of a thread are associated together.
+    Only the labeled inbox messages of the threads are parsed, the ones already stored are skipped.
+    """
+    for thread_ids, page_cursor in list_pages(service, label_id, history_id, cursor, threads=True):
+        messages = []
+        threads = timings.iterate('download', download_threads(service, thread_ids))
+        for batch in chunked(threads, max(settings.GMAIL_BATCH_SIZE, 1)):
+            batch_messages = []
+            inbox_messages = [
+                message for thread in batch for message in thread.get('messages', [])
+                if {label_id, 'INBOX'}.issubset(message.get('labelIds', []))
+            ]
+            new_ids = set(skip_known([message['id'] for message in inbox_messages]))
+            for message in (message for message in inbox_messages if message['id'] in new_ids):
+                with timings.phase('download', count=0):
+                    load_attachments(service, message)
+                with timings.phase('parse'):
+                    batch_messages.append(parse_thread_message(message))
+            messages += add_attachment_texts(batch_messages, attachment_texts)
+        yield messages, page_cursor
+
+
+def ensure_company(email_address):
+    sender_domain = email_address.split('@')[-1].lower()
+    domain = normalize_domain(sender_domain) or sender_domain
+    company = Company.objects.filter(domain=domain).first()
+    if not company:
+        company, _ = Company.objects.get_or_create(
+            name=domain.split('.')[0].capitalize(),
+            defaults={'url': f'http://{domain}'}
+        )
+    return company
 
 
 def ensure_manager(message):
@@ -114,17 +708,13 @@ def ensure_manager(message):
         first_name, last_name = message['full_name'].split(' ')
     except ValueError:
         first_name, last_name = '', message.get('last_name', '')
-    manager = Employee.objects.filter(email__iexact=message['from_address'],
-                                      first_name__iexact=first_name,
-                                      last_name__iexact=last_name).first()
+    manager = Employee.objects.annotate(
+        email_lower=Lower('email')
+    ).filter(email_lower=message['from_address'].lower(),
+             first_name__iexact=first_name,
+             last_name__iexact=last_name).first()
     if not manager:
-        domain = message['from_address'].split('@')[-1]
-        name = domain.split('.')[0].capitalize()
-        company = Company.objects.filter(Q(url__icontains=domain) or Q(name__icontains=name)).first()
-        company = company or Company.objects.create(
-            name=name,
-            url=f'http://{domain}'
-        )
+        company = ensure_company(message['from_address'])
 
         manager, _ = Employee.objects.get_or_create(
             email=message['from_address'],
@@ -137,77 +727,465 @@ def ensure_manager(message):
     return manager
 
 
-def ensure_project(message, manager):
-    existing_messages = ProjectMessage.objects.filter(gmail_thread_id=message['gmail_thread_id'])
+def project_description(message):
+    return '\n\n'.join(text for text in (message.get('text', ''), message.get('attachment_text', '')) if text)
 
-    if existing_messages:
-        project = existing_messages.first().project
-    else:
-        project = Project.objects.exclude(
-            state='stopped'
-        ).filter(manager=manager).order_by('-modified').first()
-        if not project:
-            project, project_created = Project.objects.get_or_create(
-                name=message['subject'],
-                manager=manager,
-                defaults={
-                    'location': manager.company.location,
-                    'original_description': message['text']
-                }
-            )
+
+def manager_key(message):
+    try:
+        first_name, last_name = message['full_name'].split(' ')
+    except ValueError:
+        first_name, last_name = '', message.get('last_name', '')
+    return message['from_address'].lower(), first_name.lower(), last_name.lower()
+
+
+class SenderCache:
+    """
+    Identity map of the managers resolved during one sync, keyed by case folded email and name,
+    repeated mails of the same sender are resolved without queries
+    """
+
+    def __init__(self):
+        self.managers = {}
+
+    def prefetch(self, messages):
+        """Loads the managers of all the not yet cached senders with one query"""
+        emails = {message['from_address'].lower() for message in messages
+                  if manager_key(message) not in self.managers}
+        if not emails:
+            return
+        employees = Employee.objects.annotate(
+            email_lower=Lower('email')
+        ).filter(email_lower__in=emails).select_related('company').order_by('-created')
+        found = {}
+        for employee in employees:
+            found.setdefault((employee.email_lower, employee.first_name.lower(), employee.last_name.lower()), employee)
+        self.managers = {**found, **self.managers}
+
+    def get(self, message):
+        key = manager_key(message)
+        if key not in self.managers:
+            self.managers[key] = ensure_manager(message)
+        return self.managers[key]
+
+
+def prefetch_thread_projects(messages):
+    thread_ids = {message['gmail_thread_id'] for message in messages}
+    thread_messages = ProjectMessage.objects.filter(
+        gmail_thread_id__in=thread_ids
+    ).select_related('project').order_by('pk')
+    thread_projects = {}
+    for project_message in thread_messages:
+        thread_projects.setdefault(project_message.gmail_thread_id, project_message.project)
+    return thread_projects
+
+
+def prefetch_manager_projects(managers):
+    projects = Project.objects.exclude(
+        state='stopped'
+    ).filter(manager__in=managers).order_by('-modified')
+    manager_projects = {}
+    for project in projects:
+        manager_projects.setdefault(project.manager_id, project)
+    return manager_projects
+
+
+def resolve_project(message, manager, thread_projects, manager_projects):
+    thread_id = message['gmail_thread_id']
+    if thread_id in thread_projects:
+        return thread_projects[thread_id]
+    project = manager_projects.get(manager.pk)
+    if not project:
+        project, _ = Project.objects.get_or_create(
+            name=message['subject'],
+            manager=manager,
+            defaults={
+                'location': manager.company.location,
+                'original_description': project_description(message)
+            }
+        )
+        manager_projects[manager.pk] = project
+    thread_projects[thread_id] = project
     return project
 
 
-def associate(message):
+def short_id(value):
+    # gmail ids are 16 hex digits, the hashed ones are longer, so they never clash
+    return hashlib.sha1(value.encode(errors='replace')).hexdigest()
+
+
+@transaction.atomic
+def associate_bulk(messages, senders=None):
     """
-    Associates message with projects and people
+    Associates a batch of parsed messages with projects and people.
+    Known messages, threads and managers are loaded with a few queries up front and resolved in memory,
+    the new project messages are written with one insert, returns them.
+    Pass the same senders cache for all the batches of a sync to reuse the managers found before.
     """
-    already_processed = ProjectMessage.objects.filter(gmail_message_id=message['gmail_message_id']).first()
-    if already_processed:
-        return already_processed, False
+    message_ids = {message['gmail_message_id'] for message in messages}
+    # the archive import hashes the Message-ID header for the gmail id, the synced message takes over the row
+    imported_ids = {short_id(message['message_id']): message for message in messages
+                    if message['message_id'] and short_id(message['message_id']) not in message_ids}
+    known_ids = set()
+    imported = []
+    for project_message in ProjectMessage.objects.filter(gmail_message_id__in=message_ids | set(imported_ids)):
+        message = imported_ids.get(project_message.gmail_message_id)
+        if message:
+            project_message.gmail_message_id = message['gmail_message_id']
+            project_message.gmail_thread_id = message['gmail_thread_id']
+            imported.append(project_message)
+        known_ids.add(project_message.gmail_message_id)
+    ProjectMessage.objects.bulk_update(imported, ['gmail_message_id', 'gmail_thread_id'])
+    new_messages = []
+    for message in messages:
+        if message['gmail_message_id'] not in known_ids:
+            known_ids.add(message['gmail_message_id'])
+            new_messages.append(message)
+    if not new_messages:
+        return []
+
+    senders = senders or SenderCache()
+    senders.prefetch(new_messages)
+    thread_projects = prefetch_thread_projects(new_messages)
+    manager_projects = prefetch_manager_projects(senders.managers.values())
+
+    project_messages = []
+    for message in new_messages:
+        manager = senders.get(message)
+        project_messages.append(ProjectMessage(
+            text=message.get('text', ''),
+            author=manager,
+            project=resolve_project(message, manager, thread_projects, manager_projects),
+            subject=message['subject'],
+            sent_at=message['sent_at'],
+            gmail_message_id=message['gmail_message_id'],
+            gmail_thread_id=message['gmail_thread_id'],
+            message_id=message['message_id'],
+            reply_to=message['reply-to']
+        ))
+    # unique gmail_message_id makes a concurrent insert of the same message a no-op
+    ProjectMessage.objects.bulk_create(project_messages, ignore_conflicts=True)
+    return list(ProjectMessage.objects.filter(
+        gmail_message_id__in=[message['gmail_message_id'] for message in new_messages]
+    ).select_related('project').order_by('pk'))
+
+
+def queue_missing_cvs(project_messages, user):
+    """
+    Queues CV creation for the projects without CVs, the worker creates them
+    """
+    project_ids = {message.project_id for message in project_messages if message.project_id}
+    CVRequest.objects.bulk_create([
+        CVRequest(project=project, user=user)
+        for project in Project.objects.filter(pk__in=project_ids, cvs=None)
+    ], ignore_conflicts=True)
+
+
+def fetch_mailbox(mailbox, attachment_texts=None):
+    """
+    Yields (mailbox, parsed messages, cursor) page by page for the new messages of the mailbox,
+    store the cursor along with the messages with Mailbox.checkpoint. The last cursor has no page to continue
+    with, it comes once and brings the history id the mailbox is synced up to. A sync interrupted before is resumed.
+    The texts of the attachments are added with attachment_texts.
+    Can be run in a thread.
+    """
+    cursor = mailbox.sync_cursor or {}
+    with services.get(mailbox.social_auth) as service:
+        quota = services.quota(service)
+        started = quota.stats()
+        # taken before listing, so nothing arriving in between is skipped next time,
+        # a resumed sync keeps the one it started with
+        history_id = cursor.get('history_id') or get_profile(service)['historyId']
+        label_id = get_cached_label_id(service, mailbox.social_auth)
+        if cursor:
+            logger.info(f'Resuming the sync of {mailbox}')
+        get_pages = get_thread_pages if settings.GMAIL_SYNC_MODE == 'threads' else get_message_pages
+        if label_id:
+            for messages, page_cursor in get_pages(service, mailbox.history_id, label_id, cursor, attachment_texts):
+                yield mailbox, messages, {**(page_cursor or {}), 'history_id': history_id}
+        stats = {key: round(value - started[key], 2) for key, value in quota.stats().items()}
+        logger.info(f'Synced {mailbox}: {stats["requests"]} requests, {stats["units"]} quota units, '
+                    f'{stats["retries"]} retries, {stats["throttled"]}s throttled')
+    if not label_id:
+        yield mailbox, [], {'history_id': history_id}
+
+
+class ParallelFetch:
+    """
+    Runs fetch_mailbox for many mailboxes at once in a thread pool of concurrency threads.
+    Batches of all the mailboxes are merged in the order they arrive, a failed mailbox doesn't stop
+    the others, its error is raised once all of them are done.
+    """
+    _done = object()
+
+    def __init__(self, concurrency, attachment_texts=None):
+        self.concurrency = concurrency
+        self.attachment_texts = attachment_texts
+        # bounded, so the threads don't outrun the consumer
+        self.results = queue.Queue(maxsize=concurrency * 2)
+        self.cancelled = threading.Event()
+
+    def put(self, item):
+        while not self.cancelled.is_set():
+            try:
+                self.results.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def fetch_into_queue(self, mailbox):
+        try:
+            for item in fetch_mailbox(mailbox, self.attachment_texts):
+                if not self.put(item):
+                    return
+        except Exception as ex:
+            self.put(ex)
+        finally:
+            self.put(self._done)
+            connections.close_all()
+
+    def collect(self, mailbox_count):
+        error = None
+        done = 0
+        while done < mailbox_count:
+            item = self.results.get()
+            if item is self._done:
+                done += 1
+            elif isinstance(item, Exception):
+                logger.error(f"Can't sync mailbox: {item}")
+                error = error or item
+            else:
+                yield item
+        if error:
+            raise error
 
-    manager = ensure_manager(message)
-    project = ensure_project(message, manager)
+    def __call__(self, mailboxes):
+        with ThreadPoolExecutor(max_workers=self.concurrency, thread_name_prefix='gmail-sync') as executor:
+            try:
+                for mailbox in mailboxes:
+                    executor.submit(self.fetch_into_queue, mailbox)
+                yield from self.collect(len(mailboxes))
+            finally:
+                # releases the threads blocked on the full queue before the pool is joined
+                self.cancelled.set()
 
-    return ProjectMessage.objects.create(
-        text=message['text'],
-        author=manager,
-        project=project,
-        subject=message['subject'],
-        sent_at=message['sent_at'],
-        gmail_message_id=message['gmail_message_id'],
-        gmail_thread_id=message['gmail_thread_id'],
-        message_id=message['message_id'],
-        reply_to=message['reply-to']
-    ), True
 
+def fetch_mailboxes(mailboxes, attachment_texts=None):
+    concurrency = settings.GMAIL_SYNC_CONCURRENCY
+    if concurrency > 1 and len(mailboxes) > 1:
+        yield from ParallelFetch(concurrency, attachment_texts)(mailboxes)
+        return
+    for mailbox in mailboxes:
+        yield from fetch_mailbox(mailbox, attachment_texts)
 
-def sync():
+
+class LockLost(Exception):
+    pass
+
+
+class LocalLease:
+    """
+    Lease in the local memory cache without redis, the cache belongs to the process,
+    so a thread lock makes checking the holder and changing the lease atomic
+    """
+    guard = threading.Lock()
+
+    def __init__(self, key, timeout):
+        self.key = key
+        self.timeout = timeout
+        self.token = uuid.uuid4().hex
+
+    def acquire(self, blocking=False):
+        return cache.add(self.key, self.token, self.timeout)
+
+    def locked(self):
+        return cache.get(self.key) is not None
+
+    def reacquire(self):
+        with self.guard:
+            if cache.get(self.key) != self.token:
+                raise LockError('Lease expired')
+            cache.touch(self.key, self.timeout)
+
+    def release(self):
+        with self.guard:
+            if cache.get(self.key) != self.token:
+                raise LockError('Lease expired')
+            cache.delete(self.key)
+
+
+class SyncLock:
+    """
+    Lease lock in the shared cache, so an account is synced by one process at a time.
+    The lease expires on its own if the holder dies, the holder extends it while syncing.
+    With redis the holder is checked and the lease changed in one step by the redis lock.
+    """
+    poll_interval = 1
+
+    def __init__(self, mailbox, lease=None):
+        self.mailbox = mailbox
+        self.lease = lease or settings.GMAIL_SYNC_LOCK_LEASE
+        key = f'gmail-sync-lock-{mailbox.social_auth_id}'
+        if hasattr(cache, 'lock'):
+            # the fetching threads may use it too
+            self.lock = cache.lock(key, timeout=self.lease, thread_local=False)
+        else:
+            self.lock = LocalLease(key, self.lease)
+
+    def acquire(self):
+        # redis being down raises instead of looking like a lock held by someone else
+        return self.lock.acquire(blocking=False)
+
+    def extend(self):
+        """
+        Renews the lease, raises LockLost if it expired, someone else may be syncing the account by now
+        """
+        try:
+            self.lock.reacquire()
+        except LockError as ex:
+            raise LockLost(f'Sync lock of {self.mailbox} expired, the sync is stopped') from ex
+
+    def release(self):
+        try:
+            self.lock.release()
+        except LockError:
+            logger.warning(f'Sync lock of {self.mailbox} expired before it was released')
+
+    def wait(self, timeout):
+        """
+        Waits until the lock is released, returns False if it's still held after timeout seconds
+        """
+        deadline = time.monotonic() + timeout
+        while self.lock.locked():
+            if time.monotonic() >= deadline:
+                return False
+            time.sleep(self.poll_interval)
+        return True
+
+
+def lock_mailboxes(mailboxes, wait=0):
+    """
+    Returns the locks for the mailboxes not synced by someone else at the moment.
+    With wait the mailboxes being synced are waited for, their sync then only loads what's left.
+    """
+    locks = {}
+    for mailbox in mailboxes:
+        lock = SyncLock(mailbox)
+        if not lock.acquire() and not (wait and lock.wait(wait) and lock.acquire()):
+            logger.info(f'{mailbox} is being synced by another process, skipping')
+            continue
+        locks[mailbox] = lock
+    return locks
+
+
+def store_page(mailbox, messages, cursor, senders):
+    """
+    Stores a page of the fetched messages with the cursor, an interrupted sync continues after them
+    """
+    with transaction.atomic():
+        with timings.phase('associate', count=len(messages)):
+            created_messages = associate_bulk(messages, senders) if messages else []
+        with timings.phase('queue_cvs', count=len(created_messages)):
+            queue_missing_cvs(created_messages, mailbox.social_auth.user)
+        with timings.phase('checkpoint'):
+            mailbox.checkpoint(cursor)
+    return created_messages
+
+
+def get_mailboxes(social_auth=None, due_at=None):
+    """
+    Mailboxes of all the google accounts or only the one of social_auth,
+    with due_at only the ones the scheduler should poll by then
+    """
+    usas = UserSocialAuth.objects.filter(provider='google-oauth2').select_related('user')
+    if social_auth:
+        usas = usas.filter(pk=social_auth.pk)
+    if due_at:
+        usas = usas.filter(Q(mailbox=None) | Q(mailbox__next_poll_at=None) | Q(mailbox__next_poll_at__lte=due_at))
+    return [Mailbox.objects.get_or_create(social_auth=usa)[0] for usa in usas]
+
+
+def sync(wait=0, social_auth=None, due=False):
+    """
+    Syncs the mailboxes of all the google accounts or only the one of social_auth,
+    with due only the ones the scheduler should poll by now
+    """
     if not settings.SOCIAL_AUTH_GOOGLE_OAUTH2_KEY:
         return []
     project_messages = []
-    parsed_messages = []
-    for user in get_user_model().objects.exclude(social_auth=None):
-        usas = user.social_auth.filter(provider='google-oauth2')
-        for usa in usas:
-            creds = Credentials(usa)
-            service = discovery.build('gmail', 'v1', credentials=creds)
-            raw_messages = get_raw_messages(service)
-            parsed_messages += [
-                parse_message(raw_message) for raw_message in raw_messages
-            ]
+    now = timezone.now()
+    mailboxes = get_mailboxes(social_auth, now if due else None)
+    locks = lock_mailboxes(mailboxes, wait)
+    if due:
+        # a failing mailbox is retried after its interval, not on every round of the scheduler,
+        # a skipped one gets the next poll from the sync holding its lock
+        for mailbox in mailboxes:
+            mailbox.next_poll_at = now + timedelta(seconds=mailbox.poll_interval or settings.GMAIL_POLL_MIN_INTERVAL)
+            mailbox.save(update_fields=['next_poll_at'])
+    if not locks:
+        return project_messages
+    started = timings.stats()
+    try:
+        senders = SenderCache()
+        # the first sync loads the whole label, it doesn't tell how busy the mailbox is
+        arrived = {mailbox: 0 if mailbox.history_id else None for mailbox in locks}
 
-    for message in parsed_messages:
-        project_message, created = associate(message)
-        if created:
-            project_messages.append(project_message)
-            if not project_message.project.cvs.exists():
-                project_message.project.create_cv(user)
+        # pdf and docx attachments are converted in a process pool started on the first one
+        with AttachmentTexts() as attachment_texts:
+            for mailbox, messages, cursor in fetch_mailboxes(list(locks), attachment_texts):
+                # all of them, the mailboxes fetched one after another wait for their turn holding the lock
+                for lock in locks.values():
+                    lock.extend()
+                project_messages += store_page(mailbox, messages, cursor, senders)
+                if arrived[mailbox] is not None:
+                    arrived[mailbox] += len(messages)
+                if not cursor.get('page_token'):
+                    mailbox.schedule_poll(arrived[mailbox] or 0)
+    finally:
+        for lock in locks.values():
+            lock.release()
+    log_report(report(started, timings.stats()), mailboxes=len(locks), messages=len(project_messages))
     return project_messages
 
 
-def create_message_with_attachment(sender, to, message_text_html,
-                                   **kwargs):
+def watch(service, label_id):
+    """
+    Asks gmail to notify GMAIL_PUSH_TOPIC about the changes of the labeled messages
+    """
+    request = service.users().watch(userId='me', body={
+        'topicName': settings.GMAIL_PUSH_TOPIC,
+        'labelIds': [label_id],
+        'labelFilterBehavior': 'include',
+    })
+    return execute(service, request, QUOTA_UNITS['watch'])
+
+
+def watch_mailboxes(renew_before=None):
+    """
+    Registers the push notification watches for the mailboxes, renews the ones expiring within renew_before.
+    Gmail stops the watches after 7 days, returns the watched mailboxes.
+    """
+    renew_before = renew_before or timedelta(seconds=settings.GMAIL_WATCH_RENEW_BEFORE)
+    watched = []
+    for usa in UserSocialAuth.objects.filter(provider='google-oauth2'):
+        mailbox, _ = Mailbox.objects.get_or_create(social_auth=usa)
+        if mailbox.watch_expiration and mailbox.watch_expiration > timezone.now() + renew_before:
+            continue
+        with services.get(usa) as service:
+            label_id = get_cached_label_id(service, usa)
+            if not label_id:
+                continue
+            # history id of the response is not stored, the mailbox is synced from where it was
+            response = watch(service, label_id)
+        mailbox.watch_expiration = datetime.fromtimestamp(int(response['expiration']) / 1000, tz=pytz.utc)
+        mailbox.save()
+        logger.info(f'Watching {mailbox} until {mailbox.watch_expiration}')
+        watched.append(mailbox)
+    return watched
+
+
+def create_mime_message(sender, to, message_text_html, **kwargs):
     message = MIMEMultipart()
     message['to'] = to
     message['from'] = sender
@@ -217,6 +1195,12 @@ def create_message_with_attachment(sender, to, message_text_html,
     message['references'] = kwargs.get('message_id')
 
     message.attach(MIMEText(message_text_html, 'html'))
+    return message
+
+
+def create_message_with_attachment(sender, to, message_text_html,
+                                   **kwargs):
+    message = create_mime_message(sender, to, message_text_html, **kwargs)
 
     main_type, sub_type = kwargs.get('content_type').split('/', 1)
     file = kwargs.get('file')
@@ -234,6 +1218,51 @@ def create_message_with_attachment(sender, to, message_text_html,
             'threadId': kwargs.get('thread_id')}
 
 
+def write_message_with_attachment(out, sender, to, message_text_html, **kwargs):
+    """
+    Writes the message like create_message_with_attachment does into the binary file out, the attachment is read
+    and base64 encoded chunk by chunk, so it's never held in memory as a whole
+    """
+    message = create_mime_message(sender, to, message_text_html, **kwargs)
+    main_type, sub_type = kwargs.get('content_type').split('/', 1)
+    attachment = MIMEBase(main_type, sub_type)
+    attachment['Content-Transfer-Encoding'] = 'base64'
+    attachment.add_header('Content-Disposition', 'attachment', filename=kwargs.get('filename'))
+    # the message is written around the placeholder, the attachment goes in its place
+    placeholder = f'attachment-{uuid.uuid4().hex}'
+    attachment.set_payload(placeholder)
+    message.attach(attachment)
+    head, tail = message.as_bytes().split(placeholder.encode())
+    out.write(head)
+    file = kwargs['file']
+    # 57 bytes make a base64 line of 76 characters
+    for chunk in iter(lambda: file.read(57 * 1024), b''):
+        out.write(base64.encodebytes(chunk))
+    file.close()
+    out.write(tail)
+    out.seek(0)
+    return out
+
+
+def file_size(file):
+    size = file.seek(0, io.SEEK_END)
+    file.seek(0)
+    return size
+
+
+def upload_email(service, user_id, thread_id, **kwargs):
+    """
+    Sends the message with a resumable media upload in chunks of UPLOAD_CHUNK_SIZE, the message is written
+    to a temporary file, it's kept in memory only while it's small
+    """
+    with tempfile.SpooledTemporaryFile(max_size=UPLOAD_CHUNK_SIZE) as out:
+        write_message_with_attachment(out, **kwargs)
+        body = {'threadId': thread_id} if thread_id else {}
+        media = MediaIoBaseUpload(out, mimetype='message/rfc822', chunksize=UPLOAD_CHUNK_SIZE, resumable=True)
+        request = service.users().messages().send(userId=user_id, body=body, media_body=media)
+        return execute(service, request, QUOTA_UNITS['messages.send']), body
+
+
 class NoSocialAuth(Exception):
     pass
 
@@ -255,18 +1284,21 @@ def send_email(from_user, to_email, rich_text: str, **kwargs):
     usa = from_user.social_auth.filter(provider='google-oauth2').first()
     if not usa:
         raise NoSocialAuth('Google auth not configured')
-    creds = Credentials(usa)
-    service = discovery.build('gmail', 'v1', credentials=creds)
-
-    message = create_message_with_attachment(
+    file = cv.get_file() if cv else None
+    message_kwargs = dict(
         sender=f"{from_user.first_name + ' ' + from_user.last_name} <{from_user.email}>",
         to=to_email,
         message_id=message_id,
-        thread_id=thread_id,
         message_text_html=rich_text,
-        file=cv.get_file() if cv else None,
+        file=file,
         subject=subject,
         filename=cv.get_filename() if cv else None,
         content_type='application/pdf'
     )
-    return service.users().messages().send(userId=from_user.email, body=message).execute(), message
+    if file and file_size(file) > settings.GMAIL_UPLOAD_THRESHOLD:
+        with services.get(usa) as service:
+            return upload_email(service, from_user.email, thread_id, **message_kwargs)
+    message = create_message_with_attachment(thread_id=thread_id, **message_kwargs)
+    with services.get(usa) as service:
+        request = service.users().messages().send(userId=from_user.email, body=message)
+        return execute(service, request, QUOTA_UNITS['messages.send']), message
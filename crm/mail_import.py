@@ -0,0 +1,123 @@
+"""
+Imports archived mail, an mbox file (e.g. from google takeout) or a directory of .eml files, without the gmail api
+"""
+import hashlib
+import logging
+import mailbox
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from email.utils import parsedate_to_datetime
+from functools import partial
+
+import django
+from django.conf import settings
+from django.utils import timezone
+
+from crm.attachment_text import AttachmentTexts
+from crm.gmail_utils import SenderCache, StreamingParser, associate_bulk, parse_email, short_id
+from crm.models import ProjectMessage
+from crm.utils import chunked
+
+logger = logging.getLogger('mail_import')
+
+
+def thread_id(email_message, message_id):
+    # google takeout keeps the gmail thread id, the api returns it in hex
+    gmail_thread_id = email_message['x-gm-thrid']
+    if gmail_thread_id and gmail_thread_id.strip().isdigit():
+        return format(int(gmail_thread_id), 'x')
+    references = (email_message['references'] or '').split() or (email_message['in-reply-to'] or '').split()
+    return short_id(references[0] if references else message_id)
+
+
+def sent_at(email_message):
+    try:
+        date = parsedate_to_datetime(email_message['date'])
+    except (TypeError, ValueError, IndexError):
+        return timezone.now()
+    return date if timezone.is_aware(date) else timezone.make_aware(date, timezone.utc)
+
+
+def parse_raw(raw, size_limit):
+    """
+    Parses an archived message into the same dict parse_message returns for the gmail ones,
+    returns None for the messages that can't be parsed
+    """
+    try:
+        return parse_archived(raw, size_limit)
+    except Exception as ex:
+        logger.exception(f"Can't parse archived message: {ex}")
+
+
+def parse_archived(raw, size_limit):
+    email_message = StreamingParser(size_limit, settings.GMAIL_ATTACHMENT_SIZE_LIMIT).parse_bytes(raw)
+    message = parse_email(email_message)
+    # messages without Message-ID are told apart by their content
+    message_id = message['message_id'] or f'<{hashlib.sha1(raw).hexdigest()}@freeturn>'
+    message['message_id'] = message_id
+    message['gmail_message_id'] = short_id(message_id)
+    message['gmail_thread_id'] = thread_id(email_message, message_id)
+    message['sent_at'] = sent_at(email_message)
+    return message
+
+
+def iter_raws(path):
+    """
+    Yields raw messages of an mbox file or all the .eml files in a directory
+    """
+    if os.path.isdir(path):
+        for root, _, files in os.walk(path):
+            for name in sorted(files):
+                if name.lower().endswith('.eml'):
+                    with open(os.path.join(root, name), 'rb') as f:
+                        yield f.read()
+        return
+    archive = mailbox.mbox(path, create=False)
+    try:
+        for key in archive.iterkeys():
+            yield archive.get_bytes(key)
+    finally:
+        archive.close()
+
+
+def parse_in_pool(raws, processes=None, batch_size=500):
+    """
+    Yields the parsed messages batch by batch, the next batch is parsed by the pool while the current one is stored
+    """
+    parse = partial(parse_raw, size_limit=settings.GMAIL_MESSAGE_SIZE_LIMIT)
+    processes = processes or os.cpu_count()
+    chunksize = max(1, batch_size // (processes * 4))
+    # workers need django when they are spawned instead of forked
+    with ProcessPoolExecutor(processes, initializer=django.setup) as pool:
+        pending = None
+        for batch in chunked(raws, batch_size):
+            parsed = pool.map(parse, batch, chunksize=chunksize)
+            if pending is not None:
+                yield [message for message in pending if message]
+            pending = parsed
+        if pending is not None:
+            yield [message for message in pending if message]
+
+
+def import_mail(path, processes=None, batch_size=500):
+    """
+    Imports the archived messages, every batch is associated in a transaction of its own.
+    Messages imported or synced before are skipped, returns the created project messages count.
+    """
+    started = time.monotonic()
+    senders = SenderCache()
+    created = skipped = 0
+    with AttachmentTexts() as attachment_texts:
+        for messages in parse_in_pool(iter_raws(path), processes, batch_size):
+            # synced from gmail before, their gmail ids differ from the imported ones
+            known = set(ProjectMessage.objects.filter(
+                message_id__in=[message['message_id'] for message in messages]
+            ).values_list('message_id', flat=True))
+            new_messages = attachment_texts([message for message in messages if message['message_id'] not in known])
+            project_messages = associate_bulk(new_messages, senders) if new_messages else []
+            created += len(project_messages)
+            skipped += len(messages) - len(project_messages)
+            logger.info(f'Imported {created} messages, skipped {skipped} known ones')
+    logger.info(f'Import of {path} took {time.monotonic() - started:.1f}s')
+    return created
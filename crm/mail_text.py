@@ -0,0 +1,136 @@
+"""
+Text of the mail messages: the body picked in one walk over the mime parts, html converted to text,
+quoted replies stripped
+"""
+import logging
+import re
+
+import lxml.html
+from lxml.etree import ParserError
+
+logger = logging.getLogger('mail_text')
+
+# replies quoted by the common mail clients, dropped with the html
+HTML_QUOTES = (
+    # gmail, the "On ... wrote:" line comes first
+    "//*[contains(@class, 'gmail_attr')][following-sibling::blockquote]",
+    "//blockquote[contains(@class, 'gmail_quote')]",
+    # apple mail and thunderbird
+    "//*[contains(@class, 'moz-cite-prefix')]",
+    "//blockquote[@type='cite']",
+    # outlook puts the quoted headers and the reply after the separator
+    "//*[@id='divRplyFwdMsg' or @id='appendonsend']/following-sibling::*",
+    "//*[@id='divRplyFwdMsg' or @id='appendonsend']",
+    "//*[contains(@class, 'yahoo_quoted')]",
+    '//head', '//script', '//style',
+)
+HTML_QUOTES_XPATH = ' | '.join(HTML_QUOTES)
+HTML_BLOCKS = ('p', 'div', 'tr', 'li', 'h1', 'h2', 'h3', 'h4', 'h5', 'h6', 'table', 'ul', 'ol', 'hr', 'pre',
+               'blockquote')
+# blocks break the line once however deeply they're nested, only <br> adds a blank line
+SOFT_BREAK = '\ue000'
+SPACES = re.compile('[ \t\r\f\v\xa0\u200b]+')
+LINE_BREAKS = re.compile(f' ?[\n{SOFT_BREAK}][\n{SOFT_BREAK} ]*')
+# replies separated from the quoted message instead of quoting it with >
+QUOTE_SEPARATOR = re.compile(
+    r'^[ \t]*(?:-{2,}[ \t]*(?:Original Message|Ursprüngliche Nachricht|Message d\'origine)[ \t]*-{2,}'
+    r'|_{10,}[ \t]*\n(?:From|Von|De):)',
+    re.MULTILINE | re.IGNORECASE,
+)
+ATTRIBUTION = re.compile(r'(?:wrote|schrieb|a écrit|escribió)[^\n]{0,40}:[ \t]*$', re.IGNORECASE)
+
+
+def decode_payload(part):
+    payload = part.get_payload(decode=True) or b''
+    charset = part.get_content_charset() or 'utf-8'
+    try:
+        return payload.decode(charset, 'replace')
+    except LookupError:
+        logger.warning(f'Unknown charset {charset}, decoding as utf-8')
+        return payload.decode('utf-8', 'replace')
+
+
+def html_to_text(html):
+    """
+    Text of an html body, quoted replies are dropped together with the markup
+    """
+    try:
+        root = lxml.html.fromstring(html)
+    except (ParserError, ValueError):
+        return ''
+    for element in root.xpath(HTML_QUOTES_XPATH):
+        if element.getparent() is not None:
+            element.drop_tree()
+    for element in root.iter('br'):
+        if not ends_line(element):
+            element.tail = '\n' + (element.tail or '')
+    for element in root.iter(*HTML_BLOCKS):
+        element.text = SOFT_BREAK + (element.text or '')
+        element.tail = SOFT_BREAK + (element.tail or '')
+    text = SPACES.sub(' ', root.text_content())
+    return LINE_BREAKS.sub(line_break, text).strip()
+
+
+def ends_line(br):
+    """
+    A line break at the end of a block with some text doesn't break the line once more, an empty block
+    holding only a line break is a blank line
+    """
+    parent = br.getparent()
+    return (parent.tag in HTML_BLOCKS and br.getnext() is None and not (br.tail or '').strip()
+            and (br.getprevious() is not None or bool((parent.text or '').strip())))
+
+
+def line_break(match):
+    breaks = match.group()
+    return '\n' * min(breaks.count('\n') + (SOFT_BREAK in breaks), 2)
+
+
+def trailing_quote_start(text):
+    """
+    Position of the quoted block the text ends with, including the "On ... wrote:" line before it
+    """
+    start = None
+    end = len(text)
+    while end > 0:
+        line_start = text.rfind('\n', 0, end) + 1
+        line = text[line_start:end]
+        if line.startswith('>'):
+            start = line_start
+        elif line.strip():
+            if start is not None and ATTRIBUTION.search(line):
+                start = line_start
+            break
+        end = line_start - 1
+    return start
+
+
+def remove_quotation(text):
+    """
+    Cuts off the quoted message a reply ends with, quotes answered inline are kept
+    """
+    start = trailing_quote_start(text)
+    separator = QUOTE_SEPARATOR.search(text)
+    if separator and (start is None or separator.start() < start):
+        start = separator.start()
+    return text if start is None else text[:start].rstrip()
+
+
+def extract_text(email_message):
+    """
+    Text of the message without the quoted replies: the first text/plain part, the first text/html one
+    converted if there is no plain text. Attachments are skipped.
+    """
+    html_part = None
+    for part in email_message.walk():
+        if part.get_content_maintype() != 'text' or part.get_content_disposition() == 'attachment':
+            continue
+        subtype = part.get_content_subtype()
+        if subtype == 'plain':
+            return remove_quotation(decode_payload(part))
+        if subtype == 'html' and html_part is None:
+            html_part = part
+    if html_part is not None:
+        return remove_quotation(html_to_text(decode_payload(html_part)))
+    logger.warning(f'No text in message {email_message["message-id"]}')
+    return ''
@@ -0,0 +1,30 @@
+# Generated by Django 3.2.10 on 2026-10-18 07:10
+
+from django.db import migrations, models
+import django.db.models.deletion
+import django_extensions.db.fields
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('social_django', '0010_uid_db_index'),
+        ('crm', '0033_alter_project_name'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Mailbox',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('created', django_extensions.db.fields.CreationDateTimeField(auto_now_add=True, verbose_name='created')),
+                ('modified', django_extensions.db.fields.ModificationDateTimeField(auto_now=True, verbose_name='modified')),
+                ('history_id', models.CharField(blank=True, help_text='Gmail history id the mailbox was synced up to', max_length=50, null=True)),
+                ('social_auth', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name='mailbox', to='social_django.usersocialauth')),
+            ],
+            options={
+                'get_latest_by': 'modified',
+                'abstract': False,
+            },
+        ),
+    ]
@@ -0,0 +1,31 @@
+# Generated by Django 3.2.10 on 2026-10-18 07:19
+
+from django.db import migrations, models
+from django.db.models import Count, Min
+
+
+def remove_duplicated_messages(apps, schema_editor):
+    ProjectMessage = apps.get_model('crm', 'ProjectMessage')
+    duplicates = ProjectMessage.objects.values('gmail_message_id').annotate(
+        count=Count('pk'), first_pk=Min('pk')
+    ).filter(count__gt=1)
+    for duplicate in duplicates:
+        ProjectMessage.objects.filter(
+            gmail_message_id=duplicate['gmail_message_id']
+        ).exclude(pk=duplicate['first_pk']).delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('crm', '0035_syncjob'),
+    ]
+
+    operations = [
+        migrations.RunPython(remove_duplicated_messages, migrations.RunPython.noop),
+        migrations.AlterField(
+            model_name='projectmessage',
+            name='gmail_message_id',
+            field=models.CharField(max_length=50, unique=True),
+        ),
+    ]
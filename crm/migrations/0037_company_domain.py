@@ -0,0 +1,30 @@
+# Generated by Django 3.2.10 on 2026-10-18 07:31
+
+from django.db import migrations, models
+from tld import get_fld
+
+
+def fill_domains(apps, schema_editor):
+    Company = apps.get_model('crm', 'Company')
+    companies = []
+    for company in Company.objects.exclude(url=None).exclude(url=''):
+        url = company.url if '://' in company.url else f'http://{company.url}'
+        company.domain = (get_fld(url, fail_silently=True) or '').lower()
+        companies.append(company)
+    Company.objects.bulk_update(companies, ['domain'], batch_size=500)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('crm', '0036_projectmessage_unique_gmail_message_id'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='company',
+            name='domain',
+            field=models.CharField(blank=True, db_index=True, editable=False, help_text='Normalized domain of the url, used for matching the senders', max_length=253),
+        ),
+        migrations.RunPython(fill_domains, migrations.RunPython.noop),
+    ]
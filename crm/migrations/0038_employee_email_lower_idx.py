@@ -0,0 +1,18 @@
+# Generated by Django 3.2.10 on 2026-10-18 07:24
+
+from django.db import migrations, models
+import django.db.models.functions.text
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('crm', '0037_company_domain'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='employee',
+            index=models.Index(django.db.models.functions.text.Lower('email'), name='crm_employee_email_lower_idx'),
+        ),
+    ]
@@ -0,0 +1,25 @@
+# Generated by Django 3.2.10 on 2026-10-18 07:44
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('social_django', '0010_uid_db_index'),
+        ('crm', '0039_cvrequest'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='mailbox',
+            name='watch_expiration',
+            field=models.DateTimeField(blank=True, help_text='Gmail push notifications are sent until then', null=True),
+        ),
+        migrations.AddField(
+            model_name='syncjob',
+            name='social_auth',
+            field=models.ForeignKey(blank=True, help_text='Account to sync, all the accounts if empty', null=True, on_delete=django.db.models.deletion.CASCADE, related_name='+', to='social_django.usersocialauth'),
+        ),
+    ]
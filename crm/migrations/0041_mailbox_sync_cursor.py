@@ -0,0 +1,18 @@
+# Generated by Django 3.2.10 on 2026-10-18 07:51
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('crm', '0040_mailbox_watch'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='mailbox',
+            name='sync_cursor',
+            field=models.JSONField(blank=True, help_text='Progress of the sync, an interrupted one continues from there', null=True),
+        ),
+    ]
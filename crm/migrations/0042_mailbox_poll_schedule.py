@@ -0,0 +1,33 @@
+# Generated by Django 3.2.10 on 2026-10-18 07:54
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('crm', '0041_mailbox_sync_cursor'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='mailbox',
+            name='arrival_rate',
+            field=models.FloatField(default=0, help_text='Recently arriving labeled messages per hour'),
+        ),
+        migrations.AddField(
+            model_name='mailbox',
+            name='next_poll_at',
+            field=models.DateTimeField(blank=True, help_text='The scheduler syncs the mailbox then, at once if empty', null=True),
+        ),
+        migrations.AddField(
+            model_name='mailbox',
+            name='poll_interval',
+            field=models.PositiveIntegerField(blank=True, help_text='Seconds between the polls of the scheduler', null=True),
+        ),
+        migrations.AddField(
+            model_name='mailbox',
+            name='polled_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+    ]
@@ -0,0 +1,29 @@
+# Generated by Django 3.2.10 on 2026-10-18 08:07
+
+from django.db import migrations, models
+import django_extensions.db.fields
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('crm', '0042_mailbox_poll_schedule'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='AttachmentText',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('created', django_extensions.db.fields.CreationDateTimeField(auto_now_add=True, verbose_name='created')),
+                ('modified', django_extensions.db.fields.ModificationDateTimeField(auto_now=True, verbose_name='modified')),
+                ('sha256', models.CharField(help_text='Hash of the attachment content', max_length=64, unique=True)),
+                ('text', models.TextField(blank=True)),
+                ('error', models.TextField(blank=True, help_text='Why the text could not be extracted')),
+            ],
+            options={
+                'get_latest_by': 'modified',
+                'abstract': False,
+            },
+        ),
+    ]
@@ -0,0 +1,41 @@
+# Generated by Django 3.2.10 on 2026-10-18 08:17
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+import django.utils.timezone
+import django_extensions.db.fields
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('crm', '0043_attachmenttext'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='OutboundMessage',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('created', django_extensions.db.fields.CreationDateTimeField(auto_now_add=True, verbose_name='created')),
+                ('modified', django_extensions.db.fields.ModificationDateTimeField(auto_now=True, verbose_name='modified')),
+                ('to_email', models.EmailField(max_length=254)),
+                ('text', models.TextField()),
+                ('state', models.CharField(choices=[('queued', 'Queued'), ('sending', 'Sending'), ('sent', 'Sent'), ('failed', 'Failed')], default='queued', max_length=20)),
+                ('attempts', models.PositiveIntegerField(default=0)),
+                ('next_attempt_at', models.DateTimeField(default=django.utils.timezone.now)),
+                ('sent_at', models.DateTimeField(blank=True, null=True)),
+                ('gmail_message_id', models.CharField(blank=True, max_length=50)),
+                ('error', models.TextField(blank=True)),
+                ('cv', models.ForeignKey(blank=True, help_text='CV attached as pdf', null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to='crm.cv')),
+                ('project', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='outbound_messages', to='crm.project')),
+                ('project_message', models.ForeignKey(blank=True, help_text='Message answered, the reply goes to its thread', null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to='crm.projectmessage')),
+                ('sender', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'ordering': ['-created'],
+            },
+        ),
+    ]
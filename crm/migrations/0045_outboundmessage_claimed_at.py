@@ -0,0 +1,18 @@
+# Generated by Django 3.2.10 on 2026-10-18 08:41
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('crm', '0044_outboundmessage'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='outboundmessage',
+            name='claimed_at',
+            field=models.DateTimeField(blank=True, help_text='When a worker started sending the message', null=True),
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 3.2.10 on 2026-10-18 08:45
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('crm', '0045_outboundmessage_claimed_at'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='cvrequest',
+            name='attempts',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='cvrequest',
+            name='claimed_at',
+            field=models.DateTimeField(blank=True, help_text='When a worker started creating the CV', null=True),
+        ),
+    ]
@@ -0,0 +1,22 @@
+from django.db import migrations
+from django.db.models import Q
+
+
+def forget_converter_errors(apps, schema_editor):
+    # the attachments failed for a missing pdftotext or a timeout are converted again when they come next time
+    AttachmentText = apps.get_model('crm', 'AttachmentText')
+    AttachmentText.objects.filter(
+        Q(error__startswith='pdftotext is not installed')
+        | Q(error__startswith='pdftotext took longer than')
+        | Q(error='Conversion took too long')
+    ).delete()
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ('crm', '0046_cvrequest_attempts'),
+    ]
+
+    operations = [
+        migrations.RunPython(forget_converter_errors, migrations.RunPython.noop),
+    ]
@@ -7,3 +7,5 @@ from crm.models.invoice import *
 from crm.models.project import *
 from crm.models.project_message import *
 from crm.models.message_templates import *
+from crm.models.mailbox import *
+from crm.models.attachment import *
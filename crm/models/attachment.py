@@ -0,0 +1,14 @@
+from django.db import models
+from django_extensions.db.models import TimeStampedModel
+
+
+class AttachmentText(TimeStampedModel):
+    """
+    Text extracted from a mail attachment, the same attachment is converted once
+    """
+    sha256 = models.CharField(max_length=64, unique=True, help_text='Hash of the attachment content')
+    text = models.TextField(blank=True)
+    error = models.TextField(blank=True, help_text='Why the text could not be extracted')
+
+    def __str__(self):
+        return self.sha256
@@ -8,6 +8,17 @@ from wagtail.core.fields import RichTextField
 from wagtail.images.edit_handlers import ImageChooserPanel
 
 
+def normalize_domain(url):
+    """
+    First level domain of the url, lowercased, empty if the url can't be parsed
+    """
+    if not url:
+        return ''
+    if '://' not in url:
+        url = f'http://{url}'
+    return (get_fld(url, fail_silently=True) or '').lower()
+
+
 class Company(TimeStampedModel):
     name = models.CharField(max_length=200,
                             unique=True)
@@ -17,6 +28,11 @@ class Company(TimeStampedModel):
                                  null=True)
     url = models.URLField(blank=True,
                           null=True)
+    domain = models.CharField(max_length=253,
+                              blank=True,
+                              db_index=True,
+                              editable=False,
+                              help_text='Normalized domain of the url, used for matching the senders')
     notes = RichTextField(default='', blank=True)
     logo = models.ForeignKey('wagtailimages.Image', on_delete=models.SET_NULL,
                              null=True, blank=True)
@@ -54,9 +70,23 @@ class Company(TimeStampedModel):
     def __str__(self):
         return self.name
 
-    @property
-    def domain(self):
-        return get_fld(self.url, fail_silently=True)
+    def save(self, *args, **kwargs):
+        self.domain = normalize_domain(self.url)
+        super().save(*args, **kwargs)
+
+    @classmethod
+    def backfill_domains(cls):
+        """
+        Recalculates stored domains from the urls, returns the amount of companies updated
+        """
+        companies = []
+        for company in cls.objects.only('url', 'domain').iterator():
+            domain = normalize_domain(company.url)
+            if company.domain != domain:
+                company.domain = domain
+                companies.append(company)
+        cls.objects.bulk_update(companies, ['domain'], batch_size=500)
+        return len(companies)
 
     class Meta:
         verbose_name_plural = 'companies'
@@ -1,6 +1,8 @@
 import logging
+from datetime import timedelta
 from io import BytesIO
 
+from django.conf import settings
 from django.db import models
 from django.db.models import CASCADE, Count
 from django.urls import reverse
@@ -195,3 +197,54 @@ class CV(TimeStampedModel):
 
     class Meta:
         verbose_name = 'CV'
+
+
+class CVRequest(TimeStampedModel):
+    """
+    CV to be created for a project in the background by the worker, matching the skills takes a while
+    """
+    STATES = (
+        ('queued', 'Queued'),
+        ('running', 'Running'),
+        ('failed', 'Failed'),
+    )
+    project = models.OneToOneField('Project',
+                                   on_delete=CASCADE,
+                                   related_name='cv_request')
+    user = models.ForeignKey(settings.AUTH_USER_MODEL,
+                             on_delete=CASCADE,
+                             related_name='+',
+                             help_text='User the CV is created for')
+    state = models.CharField(max_length=20, choices=STATES, default='queued')
+    attempts = models.PositiveIntegerField(default=0)
+    claimed_at = models.DateTimeField(null=True,
+                                      blank=True,
+                                      help_text='When a worker started creating the CV')
+    error = models.TextField(blank=True)
+
+    def __str__(self):
+        return f'CV for {self.project} [{self.state}]'
+
+    def retry_later(self, error):
+        """
+        Records a failed attempt, the request is queued again until CV_REQUEST_MAX_ATTEMPTS fail
+        """
+        self.error = error
+        self.state = 'failed' if self.attempts >= settings.CV_REQUEST_MAX_ATTEMPTS else 'queued'
+        self.save()
+
+    @classmethod
+    def release_stale(cls, now=None):
+        """
+        Queues the requests again a worker died running longer than CV_REQUEST_TIMEOUT seconds ago,
+        the ones out of attempts fail. Returns the amount of the released requests.
+        """
+        now = now or timezone.now()
+        stale = cls.objects.filter(state='running',
+                                   claimed_at__lt=now - timedelta(seconds=settings.CV_REQUEST_TIMEOUT))
+        error = 'Worker stopped while creating the CV'
+        failed = stale.filter(attempts__gte=settings.CV_REQUEST_MAX_ATTEMPTS).update(state='failed', error=error)
+        return failed + stale.update(state='queued', error=error)
+
+    class Meta:
+        verbose_name = 'CV request'
@@ -1,4 +1,5 @@
 from django.db import models
+from django.db.models.functions import Lower
 from django_extensions.db.models import TimeStampedModel
 from instance_selector.edit_handlers import InstanceSelectorPanel
 from wagtail.admin.edit_handlers import FieldRowPanel, MultiFieldPanel, FieldPanel
@@ -57,3 +58,7 @@ class Employee(TimeStampedModel):
     class Meta:
         verbose_name_plural = 'people'
         ordering = ['-created']
+        indexes = [
+            # case insensitive lookups of mail senders
+            models.Index(Lower('email'), name='crm_employee_email_lower_idx'),
+        ]
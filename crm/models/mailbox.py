@@ -0,0 +1,123 @@
+import math
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import models
+from django.utils import timezone
+from django_extensions.db.models import TimeStampedModel
+
+
+class Mailbox(TimeStampedModel):
+    social_auth = models.OneToOneField('social_django.UserSocialAuth',
+                                       on_delete=models.CASCADE,
+                                       related_name='mailbox')
+    history_id = models.CharField(max_length=50,
+                                  null=True,
+                                  blank=True,
+                                  help_text='Gmail history id the mailbox was synced up to')
+    watch_expiration = models.DateTimeField(null=True,
+                                            blank=True,
+                                            help_text='Gmail push notifications are sent until then')
+    sync_cursor = models.JSONField(null=True,
+                                   blank=True,
+                                   help_text='Progress of the sync, an interrupted one continues from there')
+    arrival_rate = models.FloatField(default=0,
+                                     help_text='Recently arriving labeled messages per hour')
+    poll_interval = models.PositiveIntegerField(null=True,
+                                                blank=True,
+                                                help_text='Seconds between the polls of the scheduler')
+    polled_at = models.DateTimeField(null=True, blank=True)
+    next_poll_at = models.DateTimeField(null=True,
+                                        blank=True,
+                                        help_text='The scheduler syncs the mailbox then, at once if empty')
+
+    def __str__(self):
+        return str(self.social_auth.uid)
+
+    def checkpoint(self, cursor):
+        """
+        Stores the progress of a sync, it's finished once there's no page left to continue with
+        """
+        if cursor.get('page_token'):
+            self.sync_cursor = cursor
+        else:
+            self.history_id = cursor['history_id']
+            self.sync_cursor = None
+        self.save(update_fields=['history_id', 'sync_cursor', 'modified'])
+
+    def schedule_poll(self, arrived, now=None):
+        """
+        Plans the next poll after a finished sync, arrived is the amount of new messages it found.
+        The mailbox is polled about as often as the messages arrive, every poll finding nothing
+        doubles the interval up to GMAIL_POLL_MAX_INTERVAL.
+        """
+        now = now or timezone.now()
+        shortest, longest = settings.GMAIL_POLL_MIN_INTERVAL, settings.GMAIL_POLL_MAX_INTERVAL
+        if self.polled_at:
+            elapsed = max((now - self.polled_at).total_seconds(), 1)
+            # the arrivals of the last GMAIL_POLL_RATE_WINDOW weigh the most
+            weight = 1 - math.exp(-elapsed / settings.GMAIL_POLL_RATE_WINDOW)
+            self.arrival_rate = weight * arrived * 3600 / elapsed + (1 - weight) * self.arrival_rate
+        if arrived:
+            interval = 3600 / self.arrival_rate if self.arrival_rate else shortest
+            interval = min(interval, self.poll_interval or longest)
+        else:
+            interval = (self.poll_interval or shortest) * 2
+        self.poll_interval = int(min(max(interval, shortest), longest))
+        self.polled_at = now
+        self.next_poll_at = now + timedelta(seconds=self.poll_interval)
+        self.save(update_fields=['arrival_rate', 'poll_interval', 'polled_at', 'next_poll_at', 'modified'])
+
+
+class SyncJob(TimeStampedModel):
+    STATES = (
+        ('queued', 'Queued'),
+        ('running', 'Running'),
+        ('finished', 'Finished'),
+        ('failed', 'Failed'),
+    )
+    state = models.CharField(max_length=20, choices=STATES, default='queued')
+    social_auth = models.ForeignKey('social_django.UserSocialAuth',
+                                    null=True,
+                                    blank=True,
+                                    on_delete=models.CASCADE,
+                                    related_name='+',
+                                    help_text='Account to sync, all the accounts if empty')
+    requested_by = models.ForeignKey(settings.AUTH_USER_MODEL,
+                                     null=True,
+                                     blank=True,
+                                     on_delete=models.SET_NULL,
+                                     related_name='+')
+    started_at = models.DateTimeField(null=True, blank=True)
+    finished_at = models.DateTimeField(null=True, blank=True)
+    project_messages = models.ManyToManyField('ProjectMessage',
+                                              blank=True,
+                                              related_name='+',
+                                              help_text='Messages created by this sync')
+    error = models.TextField(blank=True)
+
+    def __str__(self):
+        return f'Sync {self.created:%Y-%m-%d %H:%M} [{self.state}]'
+
+    stale_error = 'Worker stopped during the sync'
+
+    @classmethod
+    def stale(cls, now=None):
+        """
+        The jobs running longer than GMAIL_SYNC_JOB_TIMEOUT seconds, their worker is gone
+        """
+        now = now or timezone.now()
+        return cls.objects.filter(
+            state='running', started_at__lt=now - timedelta(seconds=settings.GMAIL_SYNC_JOB_TIMEOUT)
+        )
+
+    @classmethod
+    def release_stale(cls, now=None):
+        """
+        Fails the stale jobs, returns the amount of the failed jobs
+        """
+        now = now or timezone.now()
+        return cls.stale(now).update(state='failed', error=cls.stale_error, finished_at=now)
+
+    class Meta:
+        ordering = ['-created']
@@ -1,3 +1,6 @@
+from datetime import timedelta
+
+from django.conf import settings
 from django.db import models
 from django.utils import timezone
 from django_extensions.db.models import TimeStampedModel
@@ -21,7 +24,7 @@ class ProjectMessage(TimeStampedModel):
                                null=True)
     text = models.TextField()
 
-    gmail_message_id = models.CharField(max_length=50)
+    gmail_message_id = models.CharField(max_length=50, unique=True)
     gmail_thread_id = models.CharField(max_length=50)
     message_id = models.CharField(max_length=300, help_text='Message-id header of the original message')
     reply_to = models.EmailField(help_text='Reply-to header of the original message', null=True, blank=True)
@@ -50,3 +53,76 @@ class ProjectMessage(TimeStampedModel):
 
     def __str__(self):
         return str(self.subject)
+
+
+class OutboundMessage(TimeStampedModel):
+    """
+    Message to a project manager waiting to be sent by the worker, failed attempts are retried
+    """
+    STATES = (
+        ('queued', 'Queued'),
+        ('sending', 'Sending'),
+        ('sent', 'Sent'),
+        ('failed', 'Failed'),
+    )
+    project = models.ForeignKey('Project',
+                                on_delete=models.CASCADE,
+                                related_name='outbound_messages')
+    project_message = models.ForeignKey('ProjectMessage',
+                                        null=True,
+                                        blank=True,
+                                        on_delete=models.SET_NULL,
+                                        related_name='+',
+                                        help_text='Message answered, the reply goes to its thread')
+    sender = models.ForeignKey(settings.AUTH_USER_MODEL,
+                               on_delete=models.CASCADE,
+                               related_name='+')
+    to_email = models.EmailField()
+    text = models.TextField()
+    cv = models.ForeignKey('CV',
+                           null=True,
+                           blank=True,
+                           on_delete=models.SET_NULL,
+                           related_name='+',
+                           help_text='CV attached as pdf')
+    state = models.CharField(max_length=20, choices=STATES, default='queued')
+    attempts = models.PositiveIntegerField(default=0)
+    next_attempt_at = models.DateTimeField(default=timezone.now)
+    claimed_at = models.DateTimeField(null=True,
+                                      blank=True,
+                                      help_text='When a worker started sending the message')
+    sent_at = models.DateTimeField(null=True, blank=True)
+    gmail_message_id = models.CharField(max_length=50, blank=True)
+    error = models.TextField(blank=True)
+
+    def __str__(self):
+        return f'Message to {self.to_email} [{self.state}]'
+
+    def retry_later(self, error):
+        """
+        Records a failed attempt, the delay doubles with every attempt until GMAIL_SEND_MAX_ATTEMPTS fail
+        """
+        self.error = error
+        if self.attempts >= settings.GMAIL_SEND_MAX_ATTEMPTS:
+            self.state = 'failed'
+        else:
+            self.state = 'queued'
+            delay = settings.GMAIL_SEND_RETRY_DELAY * 2 ** (self.attempts - 1)
+            self.next_attempt_at = timezone.now() + timedelta(seconds=delay)
+        self.save()
+
+    @classmethod
+    def release_stale(cls, now=None):
+        """
+        Queues the messages again a worker died sending longer than GMAIL_SEND_TIMEOUT seconds ago,
+        the ones out of attempts fail. Returns the amount of the released messages.
+        """
+        now = now or timezone.now()
+        stale = cls.objects.filter(state='sending',
+                                   claimed_at__lt=now - timedelta(seconds=settings.GMAIL_SEND_TIMEOUT))
+        error = 'Worker stopped while sending the message'
+        failed = stale.filter(attempts__gte=settings.GMAIL_SEND_MAX_ATTEMPTS).update(state='failed', error=error)
+        return failed + stale.update(state='queued', next_attempt_at=now, error=error)
+
+    class Meta:
+        ordering = ['-created']
@@ -0,0 +1,85 @@
+"""
+Time spent in the phases of the mailbox sync. The timings add up for the whole process like the quota stats,
+a sync takes the difference between its start and its end. Phases running in parallel threads add up too,
+so their sum may be more than the time the sync took.
+"""
+import logging
+import threading
+import time
+from contextlib import contextmanager
+
+logger = logging.getLogger('sync_profile')
+
+# in the order they run: listing the ids, loading the messages, parsing them, attachment texts,
+# matching the projects and writing the messages, queueing the cvs, storing the cursor
+PHASES = ('list', 'download', 'parse', 'attachments', 'associate', 'queue_cvs', 'checkpoint', 'create_cv')
+
+
+class PhaseTimings:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counts = dict.fromkeys(PHASES, 0)
+        self.seconds = dict.fromkeys(PHASES, 0.0)
+
+    def add(self, phase, seconds, count=1):
+        with self.lock:
+            self.counts[phase] += count
+            self.seconds[phase] += seconds
+
+    @contextmanager
+    def phase(self, phase, count=1):
+        started = time.monotonic()
+        try:
+            yield
+        finally:
+            self.add(phase, time.monotonic() - started, count)
+
+    def iterate(self, phase, items, count=None):
+        """
+        Yields the items, the time spent producing them counts for phase.
+        count tells how many things an item stands for, e.g. the ids of a page, 1 by default.
+        """
+        items = iter(items)
+        while True:
+            started = time.monotonic()
+            try:
+                item = next(items)
+            except StopIteration:
+                self.add(phase, time.monotonic() - started, 0)
+                return
+            self.add(phase, time.monotonic() - started, count(item) if count else 1)
+            yield item
+
+    def stats(self):
+        with self.lock:
+            return {phase: (self.counts[phase], self.seconds[phase]) for phase in PHASES}
+
+
+timings = PhaseTimings()
+
+
+def report(started, finished):
+    """
+    Counts and durations of the phases between two PhaseTimings.stats, the ones that didn't run are left out
+    """
+    rows = []
+    for phase in PHASES:
+        count = finished[phase][0] - started[phase][0]
+        seconds = finished[phase][1] - started[phase][1]
+        if count or seconds:
+            rows.append({
+                'phase': phase,
+                'count': count,
+                'seconds': round(seconds, 3),
+                'ms_per_item': round(seconds * 1000 / count, 2) if count else None,
+            })
+    return rows
+
+
+def log_report(rows, **fields):
+    """
+    One key=value line per phase, easy to grep and graph
+    """
+    for row in rows:
+        values = {**fields, 'phase': row['phase'], 'count': row['count'], 'seconds': row['seconds']}
+        logger.info(' '.join(['sync_phase'] + [f'{key}={value}' for key, value in values.items()]))
@@ -1,5 +1,6 @@
 from datetime import datetime
 from datetime import timedelta
+from itertools import islice
 
 import holidays
 from google.auth.exceptions import RefreshError
@@ -24,6 +25,16 @@ def get_working_days(start_date, end_date):
     return working_days
 
 
+def chunked(iterable, size):
+    """Splits iterable lazily into lists of size items, the last one can be shorter"""
+    iterator = iter(iterable)
+    while True:
+        chunk = list(islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+
 # https://github.com/python-social-auth/social-core/issues/125#issuecomment-389070863
 class Credentials(GoogleCredentials):
     """Google auth credentials using python social auth under the hood"""
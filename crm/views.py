@@ -0,0 +1,54 @@
+import base64
+import binascii
+import json
+import logging
+
+from django.conf import settings
+from django.http import HttpResponse, HttpResponseBadRequest, HttpResponseForbidden, HttpResponseNotFound
+from django.utils.crypto import constant_time_compare
+from django.views.decorators.csrf import csrf_exempt
+from django.views.decorators.http import require_POST
+from social_django.models import UserSocialAuth
+
+from crm import worker
+from crm.models import Mailbox
+
+logger = logging.getLogger('views')
+
+
+def parse_notification(body):
+    """
+    Returns the gmail notification (email address and history id) from a pub/sub push request body,
+    see https://developers.google.com/gmail/api/guides/push#receiving_notifications
+    """
+    envelope = json.loads(body)
+    data = json.loads(base64.b64decode(envelope['message']['data']))
+    return data['emailAddress'], str(data['historyId'])
+
+
+@csrf_exempt
+@require_POST
+def gmail_push(request):
+    """
+    Pub/sub push endpoint, queues the sync of the mailbox gmail notified about
+    """
+    if not settings.GMAIL_PUSH_TOKEN:
+        return HttpResponseNotFound()
+    if not constant_time_compare(request.GET.get('token', ''), settings.GMAIL_PUSH_TOKEN):
+        return HttpResponseForbidden()
+    try:
+        email_address, history_id = parse_notification(request.body)
+    except (ValueError, KeyError, TypeError, binascii.Error) as ex:
+        logger.warning(f"Can't parse gmail notification: {ex}")
+        return HttpResponseBadRequest()
+
+    # pub/sub retries anything but a success, so the notifications not for us are acknowledged too
+    usa = UserSocialAuth.objects.filter(provider='google-oauth2', uid=email_address).first()
+    if not usa:
+        logger.warning(f'Gmail notification for unknown account {email_address}')
+        return HttpResponse(status=204)
+    mailbox = Mailbox.objects.filter(social_auth=usa).first()
+    if mailbox and mailbox.history_id and int(mailbox.history_id) >= int(history_id):
+        return HttpResponse(status=204)
+    worker.queue_sync(social_auth=usa)
+    return HttpResponse(status=204)
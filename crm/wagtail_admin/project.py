@@ -2,6 +2,7 @@ import logging
 from datetime import timedelta
 
 from django.conf.urls import url
+from django.db import transaction
 from django.contrib.admin.utils import quote
 from django.forms import CharField, HiddenInput
 from django.shortcuts import redirect, get_object_or_404
@@ -11,7 +12,6 @@ from django.urls import reverse
 from django.utils import timezone
 from django_filters.fields import ModelChoiceField
 from django_fsm import TransitionNotAllowed
-from google.api_core.exceptions import GoogleAPIError
 from instance_selector.widgets import InstanceSelectorWidget
 from wagtail.admin import messages
 from wagtail.admin.forms import WagtailAdminModelForm
@@ -24,8 +24,7 @@ from wagtail.contrib.modeladmin.views import CreateView, InspectView, ModelFormV
     InstanceSpecificView
 from wagtail.tests.utils.form_data import rich_text
 
-from crm import gmail_utils
-from crm.models import City, CV, MessageTemplate
+from crm.models import City, CV, MessageTemplate, OutboundMessage
 from crm.models.project import Project
 
 logger = logging.getLogger(__file__)
@@ -125,28 +124,24 @@ class StateTransitionView(ModelFormView, InstanceSpecificView):
         )
 
     def send_mail(self, data):
+        """
+        Queues the message, the worker sends it, rendering the CV and talking to gmail take a while
+        """
         from_user = self.request.user
+        if not from_user.social_auth.filter(provider='google-oauth2').exists():
+            return
         project_message = self.instance.messages.first()
         to_email = (project_message.reply_to if project_message else None) or self.instance.manager.email
-        text = data['text']
-        cv = data['cv']
-
-        try:
-            gmail_utils.send_email(
-                from_user=from_user,
-                to_email=to_email,
-                rich_text=text,
-                cv=cv,
-                project_message=project_message
-            )
-        except GoogleAPIError as ex:
-            logger.error(f"Can't send messages: {ex}")
-            messages.error(self.request, f"Can't send messages: {ex}")
-            return
-        except gmail_utils.NoSocialAuth:
-            return
+        OutboundMessage.objects.create(
+            project=self.instance,
+            project_message=project_message,
+            sender=from_user,
+            to_email=to_email,
+            text=data['text'],
+            cv=data['cv'],
+        )
         messages.success(self.request,
-                         f'Message sent to {to_email}')
+                         f'Message to {to_email} queued, see its status on the project page')
 
     def post(self, request, *args, **kwargs):
         form = self.get_form()
@@ -161,12 +156,14 @@ class StateTransitionView(ModelFormView, InstanceSpecificView):
         method = getattr(form.instance, self.action)
 
         try:
-            method()
-            if self.request.POST.get('change_state') != 'change_state':
-                self.send_mail(data=form.cleaned_data)
+            # the message is queued only if the transition is stored
+            with transaction.atomic():
+                method()
+                if self.request.POST.get('change_state') != 'change_state':
+                    self.send_mail(data=form.cleaned_data)
+                return super().form_valid(form)
         except TransitionNotAllowed:
             return self.form_invalid(form)
-        return super().form_valid(form)
 
 
 class ProjectButtonHelper(ButtonHelper):
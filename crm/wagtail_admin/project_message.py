@@ -1,13 +1,18 @@
+import logging
+
+from django.conf.urls import url
+from django.shortcuts import redirect
 from django.urls import reverse
-from google.auth.exceptions import GoogleAuthError
+from django.utils.decorators import method_decorator
+from django.utils.timesince import timesince
+from django.views.decorators.http import require_POST
 from wagtail.admin import messages
-from wagtail.contrib.modeladmin.helpers import PermissionHelper
+from wagtail.contrib.modeladmin.helpers import AdminURLHelper, PermissionHelper
 from wagtail.contrib.modeladmin.options import ModelAdmin
 from wagtail.contrib.modeladmin.views import IndexView
 
-from crm import gmail_utils
-from crm.models import ProjectMessage
-import logging
+from crm import worker
+from crm.models import ProjectMessage, SyncJob
 
 logger = logging.getLogger(__file__)
 
@@ -17,31 +22,77 @@ class MessagePermissionHelper(PermissionHelper):
         return False
 
 
+class MessageURLHelper(AdminURLHelper):
+    def get_action_url_pattern(self, action):
+        if action == 'sync':
+            return self._get_action_url_pattern(action)
+        return super().get_action_url_pattern(action)
+
+    def get_action_url(self, action, *args, **kwargs):
+        if action == 'sync':
+            return reverse(self.get_action_url_name(action))
+        return super().get_action_url(action, *args, **kwargs)
+
+
 class ProjectMessageIndexView(IndexView):
-    def get_context_data(self, **kwargs):
-        try:
-            created_messages = gmail_utils.sync()
-        except GoogleAuthError as ex:
-            logger.error(f"Can't update messages: {ex}")
-            messages.error(self.request, f"Can't update messages: {ex}")
-            created_messages = []
-
-        if created_messages:
-            messages.info(
-                self.request,
-                buttons=[
-                    messages.button(
-                        text=str(message.project),
-                        url=reverse(
-                            'crm_project_modeladmin_edit',
-                            kwargs={'instance_pk': message.project.pk}
-                        )
-                    )
-                    for message in created_messages
-                ],
-                message=f'{len(created_messages)} new projects'
+    @staticmethod
+    def last_error(last_job):
+        """
+        Error of the last sync, a stale job counts as failed before the worker gets to fail it,
+        the page only reads the jobs
+        """
+        stale_job = SyncJob.stale().order_by('-started_at').first()
+        if stale_job and (not last_job or stale_job.started_at > last_job.finished_at):
+            return SyncJob.stale_error
+        if last_job and last_job.state == 'failed':
+            return last_job.error
+
+    def sync_status(self):
+        """
+        Tells how the last sync went, returns whether a new one can be started
+        """
+        pending_job = SyncJob.objects.filter(state__in=['queued', 'running']).exclude(
+            pk__in=SyncJob.stale().values('pk')
+        ).first()
+        if pending_job:
+            messages.info(self.request, f'Mailbox sync is {pending_job.state}')
+
+        last_job = SyncJob.objects.filter(state__in=['finished', 'failed']).order_by('-finished_at').first()
+        error = self.last_error(last_job)
+        if error:
+            messages.error(self.request, f"Can't update messages: {error}")
+            return not pending_job
+
+        if not last_job:
+            if not pending_job:
+                messages.info(self.request, 'Mailbox was never synced')
+            return not pending_job
+
+        created_messages = last_job.project_messages.select_related('project').exclude(project=None)
+        buttons = [
+            messages.button(
+                text=str(message.project),
+                url=reverse(
+                    'crm_project_modeladmin_edit',
+                    kwargs={'instance_pk': message.project.pk}
+                )
             )
-        return super().get_context_data(**kwargs)
+            for message in created_messages
+        ]
+        messages.info(
+            self.request,
+            buttons=buttons,
+            message=f'Last synced {timesince(last_job.finished_at)} ago, '
+                    f'{len(created_messages)} new projects'
+        )
+        return not pending_job
+
+    def get_context_data(self, **kwargs):
+        can_sync = self.sync_status()
+        return {
+            **super().get_context_data(**kwargs),
+            'sync_url': self.url_helper.get_action_url('sync') if can_sync else None,
+        }
 
 
 class MessageAdmin(ModelAdmin):
@@ -55,9 +106,24 @@ class MessageAdmin(ModelAdmin):
     inspect_view_enabled = True
     inspect_view_fields = ['project', 'subject', 'author', 'text']
     inspect_template_name = 'message_inspect.html'
+    index_template_name = 'message_index.html'
     permission_helper_class = MessagePermissionHelper
+    url_helper_class = MessageURLHelper
     search_fields = ['subject',
                      'author__first_name',
                      'author__last_name',
                      'project__name',
                      'project__company__name']
+
+    @method_decorator(require_POST)
+    def sync_view(self, request):
+        worker.queue_sync(request.user)
+        messages.success(request, 'Mailbox sync queued')
+        return redirect(self.url_helper.index_url)
+
+    def get_admin_urls_for_registration(self):
+        urls = super().get_admin_urls_for_registration()
+        route = url(self.url_helper.get_action_url_pattern('sync'),
+                    self.sync_view,
+                    name=self.url_helper.get_action_url_name('sync'))
+        return urls + (route,)
@@ -0,0 +1,185 @@
+import logging
+import time
+
+from django.conf import settings
+from django.db.models import Min, Q
+from django.utils import timezone
+
+from crm import gmail_utils
+from crm.models import CVRequest, Mailbox, OutboundMessage, SyncJob
+from crm.sync_profile import log_report, report, timings
+
+logger = logging.getLogger('worker')
+
+
+def queue_sync(user=None, social_auth=None):
+    """
+    Queues a sync of all the mailboxes or only the one of social_auth,
+    returns already queued one covering it if any
+    """
+    jobs = SyncJob.objects.filter(state='queued')
+    if social_auth:
+        jobs = jobs.filter(Q(social_auth=None) | Q(social_auth=social_auth))
+    else:
+        jobs = jobs.filter(social_auth=None)
+    return jobs.first() or SyncJob.objects.create(requested_by=user, social_auth=social_auth)
+
+
+def run_sync_job(job, wait=0):
+    # claimed with a conditional update, so two workers never run the same job
+    claimed = SyncJob.objects.filter(pk=job.pk, state='queued').update(
+        state='running', started_at=timezone.now()
+    )
+    if not claimed:
+        return
+    job.refresh_from_db()
+    run_sync(job, social_auth=job.social_auth, wait=wait)
+    return job
+
+
+def run_sync(job, **kwargs):
+    """
+    Syncs the mailboxes storing the outcome in the running job, returns the created messages
+    """
+    project_messages = []
+    try:
+        project_messages = gmail_utils.sync(**kwargs)
+    except Exception as ex:
+        logger.exception(f"Can't sync mailboxes: {ex}")
+        job.state = 'failed'
+        job.error = str(ex) or ex.__class__.__name__
+    else:
+        job.state = 'finished'
+        job.project_messages.set(project_messages)
+    job.finished_at = timezone.now()
+    job.save()
+    return project_messages
+
+
+def release_stale_jobs():
+    released = SyncJob.release_stale()
+    if released:
+        logger.warning(f'Failed {released} sync jobs left running by a stopped worker')
+
+
+def run_queued_jobs():
+    release_stale_jobs()
+    for job in SyncJob.objects.filter(state='queued').order_by('created'):
+        run_sync_job(job)
+
+
+def run_cv_request(cv_request):
+    claimed = CVRequest.objects.filter(pk=cv_request.pk, state='queued').update(
+        state='running', attempts=cv_request.attempts + 1, claimed_at=timezone.now()
+    )
+    if not claimed:
+        return
+    cv_request.refresh_from_db()
+    project = cv_request.project
+    try:
+        with timings.phase('create_cv'):
+            cv = None if project.cvs.exists() else project.create_cv(cv_request.user)
+    except Exception as ex:
+        logger.exception(f"Can't create CV for {project}, attempt {cv_request.attempts}: {ex}")
+        cv_request.retry_later(str(ex) or ex.__class__.__name__)
+        return
+    cv_request.delete()
+    return cv
+
+
+def run_cv_requests():
+    released = CVRequest.release_stale()
+    if released:
+        logger.warning(f'Released {released} CV requests left running by a stopped worker')
+    started = timings.stats()
+    cv_requests = CVRequest.objects.filter(state='queued').select_related('project', 'user').order_by('created')
+    for cv_request in cv_requests:
+        run_cv_request(cv_request)
+    log_report(report(started, timings.stats()))
+
+
+def send_outbound_message(message):
+    # claimed like the sync jobs, a message is sent by one worker only
+    claimed = OutboundMessage.objects.filter(pk=message.pk, state='queued').update(
+        state='sending', attempts=message.attempts + 1, claimed_at=timezone.now()
+    )
+    if not claimed:
+        return
+    message.refresh_from_db()
+    try:
+        response, _ = gmail_utils.send_email(
+            from_user=message.sender,
+            to_email=message.to_email,
+            rich_text=message.text,
+            cv=message.cv,
+            project_message=message.project_message,
+        )
+    except gmail_utils.NoSocialAuth as ex:
+        # nothing to retry with until the sender connects a google account
+        logger.error(f"Can't send {message}: {ex}")
+        message.state = 'failed'
+        message.error = str(ex)
+        message.save()
+        return
+    except Exception as ex:
+        logger.exception(f"Can't send {message}, attempt {message.attempts}: {ex}")
+        message.retry_later(str(ex) or ex.__class__.__name__)
+        return
+    message.state = 'sent'
+    message.sent_at = timezone.now()
+    message.gmail_message_id = response.get('id', '')
+    message.error = ''
+    message.save()
+    return message
+
+
+def send_outbound_messages():
+    released = OutboundMessage.release_stale()
+    if released:
+        logger.warning(f'Released {released} messages left sending by a stopped worker')
+    outbound_messages = OutboundMessage.objects.filter(
+        state='queued', next_attempt_at__lte=timezone.now()
+    ).select_related('sender', 'cv', 'project_message').order_by('next_attempt_at')
+    for message in outbound_messages:
+        send_outbound_message(message)
+
+
+def run_pending():
+    run_queued_jobs()
+    send_outbound_messages()
+    run_cv_requests()
+
+
+def run(interval):
+    logger.info(f'Worker started, polling every {interval}s')
+    while True:
+        run_pending()
+        time.sleep(interval)
+
+
+def seconds_to_next_poll():
+    # new accounts have no mailbox yet, they are picked up within the shortest interval
+    next_poll_at = Mailbox.objects.aggregate(next_poll_at=Min('next_poll_at'))['next_poll_at']
+    seconds = (next_poll_at - timezone.now()).total_seconds() if next_poll_at else 0
+    return min(max(seconds, 1), settings.GMAIL_POLL_MIN_INTERVAL)
+
+
+def poll_due_mailboxes():
+    # recorded as a sync job like the queued ones, the messages index tells how the last poll went
+    if not settings.SOCIAL_AUTH_GOOGLE_OAUTH2_KEY or not gmail_utils.get_mailboxes(due_at=timezone.now()):
+        return []
+    job = SyncJob.objects.create(state='running', started_at=timezone.now())
+    return run_sync(job, due=True)
+
+
+def run_scheduler():
+    """
+    Polls every mailbox when it's due, see Mailbox.schedule_poll
+    """
+    logger.info('Scheduler started')
+    while True:
+        release_stale_jobs()
+        project_messages = poll_due_mailboxes()
+        if project_messages:
+            logger.info(f'Polled {len(project_messages)} new messages')
+        time.sleep(seconds_to_next_poll())
@@ -233,6 +233,56 @@ SOCIAL_AUTH_GOOGLE_OAUTH2_AUTH_EXTRA_ARGUMENTS = {
 
 GOOGLE_ANALYTICS_JS_PROPERTY_ID = env.str('GOOGLE_ANALYTICS_ID', default='UA-123456-7')
 MAILBOX_LABEL = 'CRM'
+# amount of messages loaded with one gmail batch request, 1 disables batching
+GMAIL_BATCH_SIZE = env.int('GMAIL_BATCH_SIZE', 50)
+# messages loads every new message on its own, threads loads every changed thread with all its messages at once
+GMAIL_SYNC_MODE = env.str('GMAIL_SYNC_MODE', 'messages')
+# amount of google accounts synced in parallel, 1 syncs them one after another
+GMAIL_SYNC_CONCURRENCY = env.int('GMAIL_SYNC_CONCURRENCY', 4)
+# bytes of a message parsed at most, the rest (usually attachments) is skipped
+GMAIL_MESSAGE_SIZE_LIMIT = env.int('GMAIL_MESSAGE_SIZE_LIMIT', 5 * 1024 * 1024)
+# bytes of a pdf or docx attachment the text is extracted from at most, 0 skips the attachments
+GMAIL_ATTACHMENT_SIZE_LIMIT = env.int('GMAIL_ATTACHMENT_SIZE_LIMIT', 2 * 1024 * 1024)
+# seconds the text extraction of an attachment may take
+GMAIL_ATTACHMENT_TIMEOUT = env.int('GMAIL_ATTACHMENT_TIMEOUT', 30)
+# processes extracting the attachment texts
+GMAIL_ATTACHMENT_PROCESSES = env.int('GMAIL_ATTACHMENT_PROCESSES', 2)
+# seconds an account sync lock is held without being extended, the lock is dropped if the sync process dies
+GMAIL_SYNC_LOCK_LEASE = env.int('GMAIL_SYNC_LOCK_LEASE', 600)
+# seconds a queued sync may run before it is considered lost with its worker and marked failed
+GMAIL_SYNC_JOB_TIMEOUT = env.int('GMAIL_SYNC_JOB_TIMEOUT', 3 * 60 * 60)
+# seconds the id of MAILBOX_LABEL is cached for
+GMAIL_LABEL_CACHE_TTL = env.int('GMAIL_LABEL_CACHE_TTL', 60 * 60)
+# gmail api quota units an account spends per second at most, gmail allows 250
+GMAIL_QUOTA_UNITS_PER_SECOND = env.int('GMAIL_QUOTA_UNITS_PER_SECOND', 250)
+# times a gmail request is retried on rate limits and server errors
+GMAIL_MAX_RETRIES = env.int('GMAIL_MAX_RETRIES', 5)
+# gmail api server other than google's, e.g. crm.fake_gmail for benchmarks
+GMAIL_API_ROOT_URL = env.str('GMAIL_API_ROOT_URL', default=None)
+# pub/sub topic gmail sends the push notifications to, projects/<project>/topics/<topic>
+GMAIL_PUSH_TOPIC = env.str('GMAIL_PUSH_TOPIC', default=None)
+# secret the pub/sub push subscription sends as ?token=, the push endpoint is disabled without it
+GMAIL_PUSH_TOKEN = env.str('GMAIL_PUSH_TOKEN', default=None)
+# seconds before the expiration a gmail watch is renewed by inv watch-mailboxes
+GMAIL_WATCH_RENEW_BEFORE = env.int('GMAIL_WATCH_RENEW_BEFORE', 24 * 60 * 60)
+# seconds between the polls of the busiest mailboxes by inv scheduler
+GMAIL_POLL_MIN_INTERVAL = env.int('GMAIL_POLL_MIN_INTERVAL', 60)
+# seconds between the polls of the quiet mailboxes at most
+GMAIL_POLL_MAX_INTERVAL = env.int('GMAIL_POLL_MAX_INTERVAL', 60 * 60)
+# seconds the arrival rate of a mailbox mostly depends on, older arrivals fade out
+GMAIL_POLL_RATE_WINDOW = env.int('GMAIL_POLL_RATE_WINDOW', 60 * 60)
+# times the worker tries to send a message before giving up
+GMAIL_SEND_MAX_ATTEMPTS = env.int('GMAIL_SEND_MAX_ATTEMPTS', 5)
+# seconds before a failed message is sent again, doubled after every attempt
+GMAIL_SEND_RETRY_DELAY = env.int('GMAIL_SEND_RETRY_DELAY', 60)
+# seconds after which a message still being sent is considered lost with its worker and queued again
+GMAIL_SEND_TIMEOUT = env.int('GMAIL_SEND_TIMEOUT', 10 * 60)
+# bytes of an attachment from which on a message is sent with a resumable upload instead of a single request
+GMAIL_UPLOAD_THRESHOLD = env.int('GMAIL_UPLOAD_THRESHOLD', 2 * 1024 * 1024)
+# times the worker tries to create the CV of a synced project before giving up
+CV_REQUEST_MAX_ATTEMPTS = env.int('CV_REQUEST_MAX_ATTEMPTS', 3)
+# seconds after which a CV still being created is considered lost with its worker and queued again
+CV_REQUEST_TIMEOUT = env.int('CV_REQUEST_TIMEOUT', 10 * 60)
 DEFAULT_VAT = 19
 
 AWS_STORAGE_BUCKET_NAME = env.str('AWS_STORAGE_BUCKET_NAME', None)
@@ -7,12 +7,15 @@ from wagtail.core import urls as wagtail_urls
 from wagtail.documents import urls as wagtaildocs_urls
 from wagtailautocomplete.urls.admin import urlpatterns as autocomplete_admin_urls
 
+from crm import views as crm_views
+
 urlpatterns = [
     url(r'^django-admin/', admin.site.urls),
     url(r'^admin/autocomplete/', include(autocomplete_admin_urls)),
     url(r'^admin/', include(wagtailadmin_urls)),
     url(r'^documents/', include(wagtaildocs_urls)),
     url(r'^social/', include('social_django.urls', namespace='social')),
+    url(r'^gmail/push/$', crm_views.gmail_push, name='gmail_push'),
 
     # For anything not caught by a more specific rule above, hand over to
     # Wagtail's page serving mechanism. This should be the last pattern in
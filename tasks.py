@@ -47,12 +47,125 @@ def deploy(context, repo=True, db_backup=True):
         context.run('git push heroku develop:master')
 
 
+@invoke.task(
+    help={
+        'profile': 'Print the time spent in every phase of the sync',
+        'wait': 'Seconds to wait for a sync of an account already running elsewhere, the account is skipped after',
+    }
+)
+def mail(context, profile=False, wait=60):
+    """Simple mail check task, use in cron"""
+    configure_django()
+    from crm import sync_profile, worker
+    started = sync_profile.timings.stats()
+    worker.run_sync_job(worker.queue_sync(), wait=wait)
+    if profile:
+        print(f'{"phase":<12} {"count":>8} {"seconds":>10} {"ms/item":>10}')
+        for row in sync_profile.report(started, sync_profile.timings.stats()):
+            print(f'{row["phase"]:<12} {row["count"]:>8} {row["seconds"]:>10} {row["ms_per_item"] or "":>10}')
+
+
+@invoke.task(
+    help={
+        'interval': 'Seconds to wait between checking the queue'
+    }
+)
+def worker(context, interval=10):
+    """Background worker running the queued mailbox syncs"""
+    configure_django()
+    from crm import worker
+    worker.run(interval)
+
+
+@invoke.task
+def scheduler(context):
+    """Polls the mailboxes, the busy ones often and the quiet ones seldom, replaces inv mail in cron"""
+    configure_django()
+    from crm import worker
+    worker.run_scheduler()
+
+
 @invoke.task
 @with_django
-def mail(context):
-    """Simple mail check task, use in cron"""
-    from crm.gmail_utils import sync
-    sync()
+def watch_mailboxes(context):
+    """Registers or renews gmail push notification watches, run daily"""
+    from django.conf import settings
+    from crm import gmail_utils
+    if not settings.GMAIL_PUSH_TOPIC:
+        raise Exit("Can't watch the mailboxes, GMAIL_PUSH_TOPIC is not set")
+    for mailbox in gmail_utils.watch_mailboxes():
+        print(f'Watching {mailbox} until {mailbox.watch_expiration}')
+
+
+@invoke.task(
+    help={
+        'path': 'mbox file (e.g. google takeout) or directory with .eml files',
+        'processes': 'Processes parsing the messages, all cpus by default',
+        'batch_size': 'Messages stored in one transaction',
+    }
+)
+def import_mail(context, path, processes=None, batch_size=500):
+    """Imports archived mail into the CRM like the mail sync does, without the gmail api"""
+    configure_django()
+    from crm import mail_import
+    created = mail_import.import_mail(path, int(processes) if processes else None, int(batch_size))
+    print(f'Imported {created} messages')
+
+
+@invoke.task
+@with_django
+def backfill_company_domains(context):
+    """Recalculates the stored company domains used for matching the mail senders"""
+    from crm.models import Company
+    print(f'Updated {Company.backfill_domains()} companies')
+
+
+@invoke.task(
+    help={
+        'sizes': 'Comma separated amounts of messages in the fake mailbox',
+        'mix': 'Shares of the message kinds, e.g. plain=5,alternative=3,attachment=2',
+        'attachment_size': 'Bytes of every attachment',
+        'throttle': 'Keep the per account gmail quota budget, the real gmail enforces it',
+        'mode': 'GMAIL_SYNC_MODE to measure, messages or threads',
+    }
+)
+def benchmark_sync(context, sizes='1000,10000,50000', mix='', attachment_size=50 * 1024, throttle=False,
+                   mode='messages'):
+    """Measures the mailbox sync against a local fake gmail api in a throwaway database"""
+    configure_django()
+    from crm import benchmark
+    mime_mix = dict((kind, int(share)) for kind, share in (item.split('=') for item in mix.split(',') if item))
+    results = benchmark.benchmark_sync([int(size) for size in sizes.split(',')],
+                                       mime_mix=mime_mix or None,
+                                       attachment_size=int(attachment_size),
+                                       throttle=throttle,
+                                       mode=mode)
+    print(f'{"messages":>10} {"seconds":>10} {"msg/s":>10} {"http calls":>10} {"peak MB":>10}')
+    for result in results:
+        print(f'{result["size"]:>10} {result["seconds"]:>10} {result["messages_per_second"]:>10} '
+              f'{result["http_calls"]:>10} {result["peak_memory_mb"]:>10}')
+        print(f'{"":>10} api calls: {result["api_calls"]}')
+        print(f'{"":>10} phase seconds: {result["phase_seconds"]}')
+
+
+@invoke.task(
+    help={
+        'corpus': 'Directory with .eml files and expected.json, crm/mail_corpus by default',
+        'rounds': 'Times every message is parsed and its text extracted',
+    }
+)
+def benchmark_text(context, corpus=None, rounds=100):
+    """Measures the text extraction on a corpus of messages and checks the extracted texts"""
+    configure_django()
+    from crm import benchmark
+    results = benchmark.benchmark_text(corpus or benchmark.MAIL_CORPUS, int(rounds))
+    print(f'{"message":<30} {"bytes":>8} {"parse us":>10} {"extract us":>10}  result')
+    for result in results:
+        print(f'{result["name"]:<30} {result["bytes"]:>8} {result["parse_us"]:>10} {result["extract_us"]:>10}  '
+              f'{"; ".join(result["failures"]) or "ok"}')
+    failed = sum(1 for result in results if result['failures'])
+    if failed:
+        raise Exit(f'{failed} of {len(results)} messages have wrong text')
 
 
 @invoke.task
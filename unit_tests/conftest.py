@@ -1,4 +1,5 @@
 import pytest
+from django.core.cache import cache
 from pytest_socket import disable_socket
 from wagtail.core.models import Locale
 
@@ -7,6 +8,12 @@ def pytest_runtest_setup():
     disable_socket()
 
 
+@pytest.fixture(autouse=True)
+def clear_cache():
+    yield
+    cache.clear()
+
+
 @pytest.fixture
 def default_locale(db):
     return Locale.objects.create(language_code='en')
@@ -4,8 +4,10 @@ import os
 import pytest
 import wagtail_factories
 from pytest_factoryboy import register
+from pytest_socket import enable_socket
 
-from crm import factories
+from crm import factories, gmail_utils
+from crm.fake_gmail import FakeGmailServer, FakeMailbox
 from home.factories import SiteFactory, HomePageFactory, ProjectPageFactory
 
 register(factories.CityFactory)
@@ -63,8 +65,33 @@ def gmail_service(mocker, gmail_api_response_factory, monkeypatch, settings):
     service = mocker.Mock()
     mocker.patch('googleapiclient.discovery.build', return_value=service)
     mocker.patch('crm.gmail_utils.get_labels', lambda s: gmail_api_response_factory('gmapi_labels_response.json'))
+    mocker.patch('crm.gmail_utils.get_profile', lambda s: {'historyId': '5347681'})
     mocker.patch('crm.gmail_utils.get_message_ids',
-                 lambda s, l: {'messages': [gmail_api_response_factory('gmail_api_message.json')]})
+                 lambda s, label_id, page_token=None: {
+                     'messages': [gmail_api_response_factory('gmail_api_message.json')]
+                 })
     mocker.patch('crm.gmail_utils.get_message_raws',
                  lambda s, l: gmail_api_response_factory('gmail_api_message.json'))
-    return service
+    mocker.patch('crm.gmail_utils.get_message_raws_batch',
+                 lambda s, ids: [gmail_api_response_factory('gmail_api_message.json') for _ in ids])
+    yield service
+    gmail_utils.services.clear()
+
+
+@pytest.fixture
+def fake_gmail(settings, user_social_auth):
+    """Fake gmail api server with a mailbox of 30 messages, user_social_auth syncs it"""
+    enable_socket()
+    settings.AUTHENTICATION_BACKENDS = (
+        'social_core.backends.google.GoogleOAuth2',
+        'django.contrib.auth.backends.ModelBackend',
+    )
+    settings.SOCIAL_AUTH_GOOGLE_OAUTH2_KEY = '111'
+    settings.SOCIAL_AUTH_GOOGLE_OAUTH2_SECRET = '111'
+    # the factory token is about to expire, refreshing it would go to google
+    user_social_auth.extra_data['expires'] = 24 * 60 * 60
+    user_social_auth.save()
+    with FakeGmailServer(FakeMailbox(30)) as server:
+        settings.GMAIL_API_ROOT_URL = server.url
+        yield server
+    gmail_utils.services.clear()
@@ -0,0 +1,151 @@
+import subprocess
+import time
+import zipfile
+from email.mime.application import MIMEApplication
+from email.mime.multipart import MIMEMultipart
+from email.mime.text import MIMEText
+from io import BytesIO
+
+import pytest
+
+from crm.attachment_text import AttachmentError, AttachmentTexts, ConverterError, docx_to_text, pdf_to_text
+from crm.gmail_utils import StreamingParser, associate_bulk, parse_email, parse_message
+from crm.models import AttachmentText
+
+
+def hang(*args):
+    time.sleep(60)
+
+
+def missing_converter(*args):
+    raise ConverterError('pdftotext is not installed, install poppler-utils')
+
+
+def make_docx(*paragraphs):
+    body = ''.join(f'<w:p><w:r><w:t>{paragraph}</w:t></w:r></w:p>' for paragraph in paragraphs)
+    document = ('<w:document xmlns:w="http://schemas.openxmlformats.org/wordprocessingml/2006/main">'
+                f'<w:body>{body}</w:body></w:document>')
+    data = BytesIO()
+    with zipfile.ZipFile(data, 'w') as docx:
+        docx.writestr('word/document.xml', document)
+    return data.getvalue()
+
+
+@pytest.fixture
+def message_with_docx():
+    message = MIMEMultipart()
+    message['From'] = 'Mark Twain <mark@twain.com>'
+    message['Subject'] = 'Project'
+    message.attach(MIMEText('see the attachment', 'plain'))
+    attachment = MIMEApplication(make_docx('Python developer', 'Start: May'), 'octet-stream')
+    attachment.add_header('Content-Disposition', 'attachment', filename='Project.DOCX')
+    message.attach(attachment)
+    return message
+
+
+def test_docx_to_text():
+    assert docx_to_text(make_docx('first', 'second'), 1024) == 'first\nsecond'
+    with pytest.raises(AttachmentError):
+        docx_to_text(b'not a zip', 1024)
+
+
+def test_pdf_to_text(mocker):
+    run = mocker.patch('subprocess.run', return_value=subprocess.CompletedProcess([], 0, b'pdf text', b''))
+    assert pdf_to_text(b'%PDF', 10) == 'pdf text'
+    assert run.call_args[1]['timeout'] == 10
+    run.return_value = subprocess.CompletedProcess([], 1, b'', b'Syntax Error')
+    with pytest.raises(AttachmentError):
+        pdf_to_text(b'%PDF', 10)
+    run.side_effect = subprocess.TimeoutExpired('pdftotext', 10)
+    with pytest.raises(ConverterError):
+        pdf_to_text(b'%PDF', 10)
+    run.side_effect = FileNotFoundError
+    with pytest.raises(ConverterError):
+        pdf_to_text(b'%PDF', 10)
+
+
+def test_streaming_parser_keeps_small_documents(message_with_docx):
+    big = MIMEApplication(b'x' * 4096, 'pdf')
+    message_with_docx.attach(big)
+    email_message = StreamingParser(10 * 1024, attachment_size_limit=2048).parse_bytes(message_with_docx.as_bytes())
+    _, docx, pdf = email_message.get_payload()
+    assert docx.get_payload(decode=True).startswith(b'PK')
+    assert not pdf.get_payload()
+
+
+@pytest.mark.django_db
+def test_attachment_texts(message_with_docx, settings, mocker):
+    settings.GMAIL_ATTACHMENT_SIZE_LIMIT = 1024 * 1024
+    messages = [parse_email(message_with_docx), parse_email(message_with_docx)]
+    assert messages[0]['attachments'][0]['kind'] == 'docx'
+    with AttachmentTexts(processes=1) as attachment_texts:
+        attachment_texts(messages)
+    assert messages[0]['attachment_text'] == 'Python developer\nStart: May'
+    assert 'attachments' not in messages[0]
+    assert AttachmentText.objects.get().text == 'Python developer\nStart: May'
+
+    convert = mocker.patch.object(AttachmentTexts, 'convert')
+    message = parse_email(message_with_docx)
+    AttachmentTexts()([message])
+    convert.assert_not_called()
+    assert message['attachment_text'] == 'Python developer\nStart: May'
+
+
+@pytest.mark.django_db
+def test_attachment_texts_broken_attachment(settings):
+    message = MIMEMultipart()
+    attachment = MIMEApplication(b'broken', 'octet-stream')
+    attachment.add_header('Content-Disposition', 'attachment', filename='project.docx')
+    message.attach(attachment)
+    parsed = parse_email(message)
+    parsed['attachments'][0]['kind'] = 'docx'
+    with AttachmentTexts(processes=1) as attachment_texts:
+        attachment_texts([parsed])
+    assert parsed['attachment_text'] == ''
+    assert AttachmentText.objects.get().error
+
+
+@pytest.mark.django_db
+def test_project_description_with_attachment(gmail_api_response_factory):
+    message = parse_message(gmail_api_response_factory('gmail_api_message.json'))
+    message['attachment_text'] = 'Python developer'
+    project_message, = associate_bulk([message])
+    assert project_message.project.original_description.endswith('\n\nPython developer')
+    assert 'Python developer' not in project_message.text
+
+
+@pytest.mark.django_db
+def test_attachment_texts_hung_conversion(message_with_docx, settings, mocker):
+    settings.GMAIL_ATTACHMENT_SIZE_LIMIT = 1024 * 1024
+    settings.GMAIL_ATTACHMENT_TIMEOUT = 0
+    mocker.patch.object(AttachmentTexts, 'timeout_margin', 0.5)
+    # the pool is spawned, the conversion is replaced by a function it can import
+    mocker.patch('crm.attachment_text.to_text', hang)
+    started = time.monotonic()
+    with AttachmentTexts(processes=1) as attachment_texts:
+        message = parse_email(message_with_docx)
+        attachment_texts([message])
+        assert attachment_texts.pool is None
+    assert time.monotonic() - started < 30
+    assert message['attachment_text'] == ''
+    assert not AttachmentText.objects.exists()
+
+    mocker.stopall()
+    message = parse_email(message_with_docx)
+    with AttachmentTexts(processes=1) as attachment_texts:
+        attachment_texts([message])
+    assert message['attachment_text'] == 'Python developer\nStart: May'
+
+
+@pytest.mark.django_db
+def test_attachment_texts_missing_converter(mocker):
+    mocker.patch('crm.attachment_text.to_text', missing_converter)
+    message = MIMEMultipart()
+    attachment = MIMEApplication(b'%PDF', 'pdf')
+    attachment.add_header('Content-Disposition', 'attachment', filename='project.pdf')
+    message.attach(attachment)
+    parsed = parse_email(message)
+    with AttachmentTexts(processes=1) as attachment_texts:
+        attachment_texts([parsed])
+    assert parsed['attachment_text'] == ''
+    assert not AttachmentText.objects.exists()
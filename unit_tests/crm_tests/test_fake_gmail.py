@@ -0,0 +1,176 @@
+import base64
+import email
+import logging
+import os
+from io import BytesIO
+
+import pytest
+from pytest_socket import enable_socket
+
+from crm import benchmark, gmail_utils, sync_profile
+from crm.attachment_text import AttachmentTexts
+from crm.fake_gmail import FakeMailbox
+from crm.models import AttachmentText, Mailbox, Project, ProjectMessage
+
+
+@pytest.mark.django_db
+def test_sync_fake_mailbox(fake_gmail, user_social_auth, settings):
+    settings.GMAIL_BATCH_SIZE = 10
+    assert len(gmail_utils.sync()) == 30
+    assert fake_gmail.calls == {
+        'http': 6,
+        'profile': 1,
+        'labels': 1,
+        'messages.list': 1,
+        'messages.get': 30,
+    }
+    message = ProjectMessage.objects.get(gmail_message_id=fake_gmail.mailbox.message_id(4))
+    assert message.text
+    assert message.gmail_thread_id == fake_gmail.mailbox.message_id(3)
+    assert message.author.email == message.reply_to
+
+
+@pytest.mark.django_db
+def test_sync_fake_mailbox_profile(fake_gmail, user_social_auth, settings, caplog):
+    settings.GMAIL_BATCH_SIZE = 10
+    started = sync_profile.timings.stats()
+    with caplog.at_level(logging.INFO, logger='sync_profile'):
+        gmail_utils.sync()
+    phases = {row['phase']: row for row in sync_profile.report(started, sync_profile.timings.stats())}
+    assert {phase: row['count'] for phase, row in phases.items()} == {
+        'list': 30, 'download': 30, 'parse': 30, 'attachments': 30, 'associate': 30, 'queue_cvs': 30, 'checkpoint': 1,
+    }
+    assert all(row['seconds'] >= 0 for row in phases.values())
+    assert 'sync_phase mailboxes=1 messages=30 phase=parse count=30 seconds=' in caplog.text
+
+
+@pytest.mark.django_db
+def test_sync_fake_mailbox_incremental(fake_gmail, user_social_auth):
+    gmail_utils.sync()
+    fake_gmail.mailbox.add(5)
+    assert len(gmail_utils.sync()) == 5
+    assert fake_gmail.calls['history.list'] == 1
+    assert fake_gmail.calls['messages.list'] == 1
+    assert Mailbox.objects.get().history_id == str(fake_gmail.mailbox.history_id)
+
+
+@pytest.mark.django_db
+def test_sync_fake_mailbox_threads(fake_gmail, user_social_auth, settings):
+    settings.GMAIL_SYNC_MODE = 'threads'
+    settings.GMAIL_BATCH_SIZE = 10
+    settings.GMAIL_ATTACHMENT_SIZE_LIMIT = 0
+    project_messages = gmail_utils.sync()
+    assert len(project_messages) == 30
+    assert fake_gmail.calls == {
+        'http': 4,
+        'profile': 1,
+        'labels': 1,
+        'threads.list': 1,
+        'threads.get': 10,
+    }
+    message = ProjectMessage.objects.get(gmail_message_id=fake_gmail.mailbox.message_id(4))
+    assert message.text
+    assert message.gmail_thread_id == fake_gmail.mailbox.message_id(3)
+    assert message.project == ProjectMessage.objects.get(gmail_message_id=fake_gmail.mailbox.message_id(3)).project
+
+    fake_gmail.mailbox.add(4)
+    assert len(gmail_utils.sync()) == 4
+    assert fake_gmail.calls['history.list'] == 1
+    # the new messages are in two threads, each is loaded once
+    assert fake_gmail.calls['threads.get'] == 12
+
+
+@pytest.mark.django_db
+def test_sync_fake_mailbox_threads_attachments(fake_gmail, user_social_auth, settings, mocker):
+    settings.GMAIL_SYNC_MODE = 'threads'
+    mocker.patch('crm.attachment_text.AttachmentTexts.convert',
+                 side_effect=lambda attachments: {sha256: ('project details', '') for sha256 in attachments})
+    gmail_utils.sync()
+    attachments = sum(fake_gmail.mailbox.kind(index) == 'attachment' for index in range(fake_gmail.mailbox.size))
+    assert fake_gmail.calls['messages.attachments.get'] == attachments
+    assert AttachmentText.objects.count() == attachments
+
+
+def test_thread_message_parsed_like_raw(settings):
+    # gmail leaves the attachment data out of the full format, load_attachments adds it
+    settings.GMAIL_ATTACHMENT_SIZE_LIMIT = 0
+    mailbox = FakeMailbox(10, mime_mix={'attachment': 1}, attachment_size=1024)
+    message_id = mailbox.message_id(1)
+    thread_message = gmail_utils.parse_thread_message(mailbox.get(message_id, 'full'))
+    assert thread_message == gmail_utils.parse_message(mailbox.get(message_id))
+
+
+@pytest.mark.django_db
+def test_send_email_fake_mailbox(fake_gmail, user_social_auth, cv, faker, mocker):
+    mocker.patch.object(cv, 'get_file', return_value=BytesIO(b'test'))
+    user_social_auth.user.email = 'me@example.com'
+    response, _ = gmail_utils.send_email(user_social_auth.user, faker.email(), faker.text(), cv=cv)
+    assert response['labelIds'] == ['SENT']
+    assert len(fake_gmail.mailbox.sent) == 1
+
+
+@pytest.mark.django_db
+def test_send_email_resumable_upload(fake_gmail, user_social_auth, cv, faker, mocker, settings):
+    settings.GMAIL_UPLOAD_THRESHOLD = 100 * 1024
+    mocker.patch.object(gmail_utils, 'UPLOAD_CHUNK_SIZE', 256 * 1024)
+    pdf = os.urandom(500 * 1024)
+    mocker.patch.object(cv, 'get_file', return_value=BytesIO(pdf))
+    user_social_auth.user.email = 'me@example.com'
+    response, _ = gmail_utils.send_email(user_social_auth.user, faker.email(), '<p>hi</p>', cv=cv)
+    assert response['labelIds'] == ['SENT']
+    # the base64 encoded message of about 680 KB goes in 3 chunks
+    assert fake_gmail.calls['messages.send'] == 1
+    assert fake_gmail.calls['upload'] == 3
+    sent, = fake_gmail.mailbox.sent
+    message = email.message_from_bytes(base64.urlsafe_b64decode(sent))
+    html, attachment = message.get_payload()
+    assert html.get_payload() == '<p>hi</p>'
+    assert attachment.get_filename() == cv.get_filename()
+    assert attachment.get_payload(decode=True) == pdf
+
+
+@pytest.mark.django_db
+def test_fake_mailbox_mime_mix():
+    mailbox = FakeMailbox(50, mime_mix={'attachment': 1}, attachment_size=1024)
+    message = gmail_utils.parse_message(mailbox.get(mailbox.message_id(0)))
+    assert message['text']
+    assert message['subject'].startswith('Project 0')
+    with pytest.raises(KeyError):
+        mailbox.get(mailbox.message_id(50))
+
+
+@pytest.mark.django_db
+def test_measure_sync(settings):
+    enable_socket()
+    result = benchmark.measure_sync(20, attachment_size=1024)
+    assert result['synced'] == 20
+    assert result['http_calls'] == result['api_calls']['messages.list'] + 3
+    assert result['peak_memory_mb'] > 0
+    assert result['messages_per_second'] > 0
+    assert set(result['phase_seconds']) >= {'list', 'download', 'parse', 'associate'}
+
+
+@pytest.mark.django_db
+def test_measure_sync_needs_test_database(project, mocker):
+    enable_socket()
+    mocker.patch.dict(benchmark.connection.settings_dict, NAME='freeturn')
+    with pytest.raises(RuntimeError, match='not a test database'):
+        benchmark.measure_sync(20)
+    mocker.stopall()
+    assert Project.objects.exists()
+
+
+@pytest.mark.django_db
+def test_fetch_fake_mailbox_drops_attachment_data(fake_gmail, user_social_auth, settings, mocker):
+    settings.GMAIL_BATCH_SIZE = 10
+    convert = mocker.patch('crm.attachment_text.AttachmentTexts.convert',
+                           side_effect=lambda attachments: {sha256: ('project details', '') for sha256 in attachments})
+    mailbox = Mailbox.objects.create(social_auth=user_social_auth)
+    messages = [message for _, page, _ in gmail_utils.fetch_mailbox(mailbox, attachment_texts=AttachmentTexts())
+                for message in page]
+    assert len(messages) == 30
+    # converted per downloaded batch, the page holds the texts only
+    assert convert.call_count == 3
+    assert not any('attachments' in message for message in messages)
+    attachments = sum(fake_gmail.mailbox.kind(index) == 'attachment' for index in range(fake_gmail.mailbox.size))
+    assert sum(message['attachment_text'] == 'project details' for message in messages) == attachments
@@ -0,0 +1,89 @@
+from datetime import timedelta
+
+import pytest
+from django.urls import reverse
+from django.utils import timezone
+
+from crm import gmail_utils, worker
+from crm.fake_gmail import FakePubSub
+from crm.factories import UserSocialAuthFactory
+from crm.models import Mailbox, ProjectMessage, SyncJob
+
+
+@pytest.fixture
+def pubsub(client, settings):
+    settings.GMAIL_PUSH_TOKEN = 'secret'
+    return FakePubSub(client.post, f'{reverse("gmail_push")}?token=secret')
+
+
+@pytest.mark.django_db
+def test_push_queues_account_sync(pubsub, user_social_auth):
+    response = pubsub.publish(user_social_auth.uid, 100)
+    assert response.status_code == 204
+    job = SyncJob.objects.get()
+    assert job.social_auth == user_social_auth
+    pubsub.publish(user_social_auth.uid, 101)
+    assert SyncJob.objects.get() == job
+
+
+@pytest.mark.django_db
+def test_push_already_synced(pubsub, user_social_auth):
+    Mailbox.objects.create(social_auth=user_social_auth, history_id='100')
+    assert pubsub.publish(user_social_auth.uid, 100).status_code == 204
+    assert not SyncJob.objects.exists()
+
+
+@pytest.mark.django_db
+def test_push_unknown_account(pubsub):
+    assert pubsub.publish('nobody@example.com', 100).status_code == 204
+    assert not SyncJob.objects.exists()
+
+
+@pytest.mark.django_db
+def test_push_wrong_token(pubsub, client, user_social_auth):
+    pubsub.endpoint = f'{reverse("gmail_push")}?token=wrong'
+    assert pubsub.publish(user_social_auth.uid, 100).status_code == 403
+    assert not SyncJob.objects.exists()
+
+
+@pytest.mark.django_db
+def test_push_disabled(pubsub, settings, user_social_auth):
+    settings.GMAIL_PUSH_TOKEN = None
+    assert pubsub.publish(user_social_auth.uid, 100).status_code == 404
+
+
+@pytest.mark.django_db
+def test_push_malformed(pubsub, client):
+    response = client.post(pubsub.endpoint, data='{"message": {}}', content_type='application/json')
+    assert response.status_code == 400
+    assert client.get(pubsub.endpoint).status_code == 405
+
+
+@pytest.mark.django_db
+def test_push_syncs_only_notified_account(pubsub, fake_gmail, user_social_auth):
+    other = UserSocialAuthFactory()
+    Mailbox.objects.create(social_auth=other, history_id='1')
+    pubsub.publish(user_social_auth.uid, fake_gmail.mailbox.history_id)
+    worker.run_queued_jobs()
+    assert ProjectMessage.objects.count() == 30
+    assert fake_gmail.calls['profile'] == 1
+    assert Mailbox.objects.get(social_auth=other).history_id == '1'
+
+
+@pytest.mark.django_db
+def test_queue_sync_all_covers_account(user_social_auth):
+    job = worker.queue_sync()
+    assert worker.queue_sync(social_auth=user_social_auth) == job
+    assert worker.queue_sync() == job
+
+
+@pytest.mark.django_db
+def test_watch_mailboxes(fake_gmail, user_social_auth, settings):
+    settings.GMAIL_PUSH_TOPIC = 'projects/freeturn/topics/gmail'
+    [mailbox] = gmail_utils.watch_mailboxes()
+    assert mailbox.watch_expiration > timezone.now() + timedelta(days=6)
+    assert fake_gmail.mailbox.watched_labels == ['Label_1']
+    assert not mailbox.history_id
+    assert gmail_utils.watch_mailboxes() == []
+    assert gmail_utils.watch_mailboxes(renew_before=timedelta(days=8)) == [mailbox]
+    assert fake_gmail.calls['watch'] == 2
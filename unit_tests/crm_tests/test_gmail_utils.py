@@ -1,20 +1,182 @@
 import base64
 import email
+import time
 from io import BytesIO
 
+import httplib2
 import pytest
+from googleapiclient.errors import HttpError
 
 from crm import gmail_utils
 from crm.factories import UserSocialAuthFactory
-from crm.gmail_utils import send_email, create_message_with_attachment
-from crm.models import CV
+from crm.gmail_utils import send_email, create_message_with_attachment, write_message_with_attachment
+from crm.models import CV, CVRequest, Mailbox
 from crm.models.project_message import ProjectMessage
 from crm.utils import Credentials
 
 
-def test_get_raw_messages(gmail_service):
-    result = gmail_utils.get_raw_messages(gmail_service)
-    assert len(result) == 1
+class FakeBatch:
+    def __init__(self, callback):
+        self.callback = callback
+        self.requests = []
+
+    def add(self, request, request_id):
+        self.requests.append(request_id)
+
+    def execute(self):
+        for request_id in reversed(self.requests):
+            self.callback(request_id, {'id': request_id}, None)
+
+
+LABEL_ID = 'Label_2652846259134449764'
+
+
+@pytest.fixture
+def message_raws_batch(mocker, gmail_api_response_factory):
+    raw_message = gmail_api_response_factory('gmail_api_message.json')
+    return mocker.patch('crm.gmail_utils.get_message_raws_batch',
+                        side_effect=lambda s, ids: [{**raw_message, 'id': message_id} for message_id in ids])
+
+
+def page_ids(pages):
+    return [[message['gmail_message_id'] for message in messages] for messages, _ in pages]
+
+
+@pytest.mark.django_db
+def test_get_message_pages(gmail_service):
+    pages = list(gmail_utils.get_message_pages(gmail_service, label_id=LABEL_ID))
+    assert [len(messages) for messages, _ in pages] == [1]
+    assert pages[-1][1] is None
+
+
+@pytest.mark.django_db
+def test_get_message_pages_paginated(gmail_service, mocker, settings, message_raws_batch):
+    settings.GMAIL_BATCH_SIZE = 2
+    pages = {
+        None: {'messages': [{'id': '0'}, {'id': '1'}, {'id': '2'}], 'nextPageToken': 'next'},
+        'next': {'messages': [{'id': '3'}]},
+    }
+    get_message_ids = mocker.patch('crm.gmail_utils.get_message_ids',
+                                   side_effect=lambda s, label_id, page_token=None: pages[page_token])
+    result = gmail_utils.get_message_pages(gmail_service, label_id=LABEL_ID)
+    messages, cursor = next(result)
+    assert [message['gmail_message_id'] for message in messages] == ['0', '1', '2']
+    assert cursor == {'full': True, 'page_token': 'next'}
+    assert get_message_ids.call_count == 1
+    assert page_ids(result) == [['3']]
+    assert get_message_ids.call_count == 2
+    # the listing continues after the page with its cursor
+    assert page_ids(gmail_utils.get_message_pages(gmail_service, label_id=LABEL_ID, cursor=cursor)) == [['3']]
+
+
+@pytest.mark.django_db
+def test_get_message_pages_batched(gmail_service, mocker, settings, message_raws_batch):
+    settings.GMAIL_BATCH_SIZE = 2
+    mocker.patch('crm.gmail_utils.get_message_ids',
+                 lambda s, label_id, page_token=None: {'messages': [{'id': str(i)} for i in range(5)]})
+    result = gmail_utils.get_message_pages(gmail_service, label_id=LABEL_ID)
+    assert page_ids(result) == [['0', '1', '2', '3', '4']]
+    assert message_raws_batch.call_count == 3
+
+
+@pytest.mark.django_db
+def test_get_message_pages_not_batched(gmail_service, mocker, settings):
+    settings.GMAIL_BATCH_SIZE = 1
+    batch = mocker.patch('crm.gmail_utils.get_message_raws_batch')
+    assert len(page_ids(gmail_utils.get_message_pages(gmail_service, label_id=LABEL_ID))[0]) == 1
+    batch.assert_not_called()
+
+
+def test_get_message_raws_batch(mocker):
+    service = mocker.Mock()
+    service.new_batch_http_request.side_effect = lambda callback: FakeBatch(callback)
+    result = gmail_utils.get_message_raws_batch(service, ['a', 'b', 'c'])
+    assert result == [{'id': 'a'}, {'id': 'b'}, {'id': 'c'}]
+
+
+def http_error(status, content=b'error'):
+    return HttpError(httplib2.Response({'status': status}), content)
+
+
+def test_execute_retries_rate_limits(mocker):
+    sleep = mocker.patch('crm.gmail_utils.time.sleep')
+    service = mocker.Mock()
+    request = mocker.Mock()
+    request.execute.side_effect = [
+        http_error(429),
+        http_error(503),
+        http_error(403, b'{"error": {"errors": [{"reason": "userRateLimitExceeded"}]}}'),
+        {'id': '1'},
+    ]
+    assert gmail_utils.execute(service, request, 5) == {'id': '1'}
+    assert sleep.call_count == 3
+    stats = gmail_utils.services.quota(service).stats()
+    assert stats['requests'] == 4
+    assert stats['units'] == 20
+    assert stats['retries'] == 3
+
+
+def test_execute_gives_up(mocker, settings):
+    settings.GMAIL_MAX_RETRIES = 2
+    mocker.patch('crm.gmail_utils.time.sleep')
+    request = mocker.Mock()
+    request.execute.side_effect = http_error(500)
+    with pytest.raises(HttpError):
+        gmail_utils.execute(mocker.Mock(), request, 1)
+    assert request.execute.call_count == 3
+
+
+@pytest.mark.parametrize('error', [http_error(404), http_error(403, b'forbidden'), ValueError()])
+def test_execute_does_not_retry_other_errors(mocker, error):
+    sleep = mocker.patch('crm.gmail_utils.time.sleep')
+    request = mocker.Mock()
+    request.execute.side_effect = error
+    with pytest.raises(type(error)):
+        gmail_utils.execute(mocker.Mock(), request, 1)
+    assert request.execute.call_count == 1
+    sleep.assert_not_called()
+
+
+def test_quota_throttles(mocker):
+    now = [100.0]
+    mocker.patch('crm.gmail_utils.time.monotonic', side_effect=lambda: now[0])
+    sleep = mocker.patch('crm.gmail_utils.time.sleep')
+    quota = gmail_utils.Quota(units_per_second=100)
+    quota.spend(100)
+    sleep.assert_not_called()
+    now[0] += 0.5
+    quota.spend(100)
+    sleep.assert_called_once_with(0.5)
+    assert quota.stats()['throttled'] == 0.5
+
+
+def test_get_message_raws_batch_retries_failed(mocker):
+    mocker.patch('crm.gmail_utils.time.sleep')
+    failures = {'b': [http_error(429)]}
+
+    class FlakyBatch(FakeBatch):
+        def execute(self):
+            for request_id in self.requests:
+                error = failures.get(request_id) and failures[request_id].pop()
+                self.callback(request_id, None if error else {'id': request_id}, error)
+
+    service = mocker.Mock()
+    service.new_batch_http_request.side_effect = lambda callback: FlakyBatch(callback)
+    result = gmail_utils.get_message_raws_batch(service, ['a', 'b', 'c'])
+    assert result == [{'id': 'a'}, {'id': 'b'}, {'id': 'c'}]
+    assert service.new_batch_http_request.call_count == 2
+    assert gmail_utils.services.quota(service).stats()['units'] == 20
+
+
+def test_get_message_raws_batch_fails(mocker):
+    class FailingBatch(FakeBatch):
+        def execute(self):
+            self.callback(self.requests[0], None, http_error(404))
+
+    service = mocker.Mock()
+    service.new_batch_http_request.side_effect = lambda callback: FailingBatch(callback)
+    with pytest.raises(HttpError):
+        gmail_utils.get_message_raws_batch(service, ['a'])
 
 
 @pytest.mark.django_db
@@ -30,7 +192,163 @@ def test_sync(gmail_service, user_social_auth, default_site):
     assert message.gmail_thread_id
     assert message.message_id
     assert message.reply_to
-    assert CV.objects.filter(project=message.project).exists()
+    assert not CV.objects.filter(project=message.project).exists()
+    assert CVRequest.objects.get().project == message.project
+
+
+@pytest.mark.django_db
+def test_sync_stores_history_id(gmail_service, user_social_auth, default_site):
+    gmail_utils.sync()
+    assert Mailbox.objects.get(social_auth=user_social_auth).history_id == '5347681'
+
+
+@pytest.mark.django_db
+def test_sync_incremental(gmail_service, user_social_auth, default_site, mocker, gmail_api_response_factory):
+    Mailbox.objects.create(social_auth=user_social_auth, history_id='5347000')
+    message = gmail_api_response_factory('gmail_api_message.json')
+    get_history = mocker.patch('crm.gmail_utils.get_history', return_value={
+        'history': [{'messagesAdded': [{'message': {'id': message['id'],
+                                                    'threadId': message['threadId'],
+                                                    'labelIds': message['labelIds']}}]}],
+        'historyId': '5347681'
+    })
+    get_message_ids = mocker.patch('crm.gmail_utils.get_message_ids')
+
+    gmail_utils.sync()
+    assert get_history.call_args[0][2] == '5347000'
+    get_message_ids.assert_not_called()
+    assert ProjectMessage.objects.filter(gmail_message_id=message['id']).exists()
+    assert Mailbox.objects.get(social_auth=user_social_auth).history_id == '5347681'
+
+
+@pytest.fixture
+def paged_mailbox(gmail_service, mocker, settings, gmail_api_response_factory):
+    settings.GMAIL_BATCH_SIZE = 2
+    raw = gmail_api_response_factory('gmail_api_message.json')
+    pages = {
+        None: {'messages': [{'id': '0'}, {'id': '1'}], 'nextPageToken': 'next'},
+        'next': {'messages': [{'id': '2'}]},
+    }
+    get_message_ids = mocker.patch('crm.gmail_utils.get_message_ids',
+                                   side_effect=lambda s, label_id, page_token=None: pages[page_token])
+    batch = mocker.patch('crm.gmail_utils.get_message_raws_batch',
+                         side_effect=lambda s, ids: [{**raw, 'id': message_id} for message_id in ids])
+    return get_message_ids, batch
+
+
+@pytest.mark.django_db
+def test_sync_interrupted_stores_cursor(paged_mailbox, user_social_auth, default_site):
+    get_message_ids, batch = paged_mailbox
+    batch.side_effect = [batch.side_effect(None, ['0', '1']), RuntimeError('boom')]
+    with pytest.raises(RuntimeError):
+        gmail_utils.sync()
+    mailbox = Mailbox.objects.get(social_auth=user_social_auth)
+    assert mailbox.sync_cursor == {'full': True, 'page_token': 'next', 'history_id': '5347681'}
+    assert not mailbox.history_id
+    assert set(ProjectMessage.objects.values_list('gmail_message_id', flat=True)) == {'0', '1'}
+
+
+@pytest.mark.django_db
+def test_sync_resumes_from_cursor(paged_mailbox, user_social_auth, default_site):
+    get_message_ids, batch = paged_mailbox
+    Mailbox.objects.create(social_auth=user_social_auth,
+                           sync_cursor={'full': True, 'page_token': 'next', 'history_id': '5347000'})
+    gmail_utils.sync()
+    get_message_ids.assert_called_once()
+    assert get_message_ids.call_args[0][2] == 'next'
+    batch.assert_called_once()
+    assert batch.call_args[0][1] == ['2']
+    mailbox = Mailbox.objects.get(social_auth=user_social_auth)
+    assert mailbox.history_id == '5347000'
+    assert mailbox.sync_cursor is None
+
+
+@pytest.mark.django_db
+def test_sync_restarts_expired_cursor(paged_mailbox, user_social_auth, default_site):
+    get_message_ids, batch = paged_mailbox
+    list_page = get_message_ids.side_effect
+
+    def get_expiring_message_ids(service, label_id, page_token=None):
+        if page_token == 'expired':
+            raise HttpError(httplib2.Response({'status': 400}), b'Invalid page token')
+        return list_page(service, label_id, page_token)
+
+    get_message_ids.side_effect = get_expiring_message_ids
+    Mailbox.objects.create(social_auth=user_social_auth,
+                           sync_cursor={'full': True, 'page_token': 'expired', 'history_id': '5347000'})
+    gmail_utils.sync()
+    assert ProjectMessage.objects.count() == 3
+    assert Mailbox.objects.get(social_auth=user_social_auth).sync_cursor is None
+
+
+def test_get_message_pages_incremental_skips_archived(gmail_service, mocker):
+    mocker.patch('crm.gmail_utils.get_history', return_value={
+        'history': [{'messagesAdded': [{'message': {'id': '1', 'labelIds': [LABEL_ID]}}]}],
+    })
+    assert not any(page_ids(gmail_utils.get_message_pages(gmail_service, history_id='1', label_id=LABEL_ID)))
+
+
+@pytest.mark.django_db
+def test_get_message_pages_history_expired(gmail_service, mocker):
+    mocker.patch('crm.gmail_utils.get_history',
+                 side_effect=HttpError(httplib2.Response({'status': 404}), b'Not found'))
+    result = gmail_utils.get_message_pages(gmail_service, history_id='1', label_id=LABEL_ID)
+    assert sum(len(messages) for messages in page_ids(result)) == 1
+
+
+@pytest.mark.django_db
+def test_get_message_pages_skips_known(gmail_service, mocker, message_raws_batch, project_message_factory):
+    project_message_factory(gmail_message_id='1')
+    project_message_factory(gmail_message_id='3')
+    mocker.patch('crm.gmail_utils.get_message_ids',
+                 lambda s, label_id, page_token=None: {'messages': [{'id': '1'}, {'id': '2'}, {'id': '3'}]})
+    result = gmail_utils.get_message_pages(gmail_service, label_id=LABEL_ID)
+    assert page_ids(result) == [['2']]
+    message_raws_batch.assert_called_once_with(gmail_service, ['2'])
+
+
+@pytest.mark.django_db
+def test_sync_does_not_download_known_messages(gmail_service, user_social_auth, default_site, mocker):
+    gmail_utils.sync()
+    batch = mocker.patch('crm.gmail_utils.get_message_raws_batch')
+    Mailbox.objects.update(history_id=None)
+    assert gmail_utils.sync() == []
+    batch.assert_not_called()
+
+
+@pytest.mark.django_db
+def test_sync_reuses_service(gmail_service, user_social_auth, default_site, mocker):
+    build = mocker.patch('googleapiclient.discovery.build', return_value=gmail_service)
+    mocker.patch('crm.gmail_utils.get_history', return_value={})
+    gmail_utils.sync()
+    gmail_utils.sync()
+    build.assert_called_once_with('gmail', 'v1', credentials=mocker.ANY,
+                                  static_discovery=True, cache_discovery=False)
+
+
+@pytest.mark.django_db
+def test_service_rebuilt_for_new_refresh_token(gmail_service, user_social_auth, mocker):
+    build = mocker.patch('googleapiclient.discovery.build', side_effect=lambda *args, **kwargs: mocker.Mock())
+    with gmail_utils.services.get(user_social_auth) as service:
+        # a concurrent user gets its own service
+        with gmail_utils.services.get(user_social_auth) as other_service:
+            assert other_service is not service
+    with gmail_utils.services.get(user_social_auth) as reused_service:
+        assert reused_service in (service, other_service)
+    user_social_auth.extra_data['refresh_token'] = 'new'
+    with gmail_utils.services.get(user_social_auth) as new_service:
+        assert new_service not in (service, other_service)
+    assert build.call_count == 3
+
+
+@pytest.mark.django_db
+def test_sync_caches_label_id(gmail_service, user_social_auth, default_site, mocker, gmail_api_response_factory):
+    get_labels = mocker.patch('crm.gmail_utils.get_labels',
+                              return_value=gmail_api_response_factory('gmapi_labels_response.json'))
+    mocker.patch('crm.gmail_utils.get_history', return_value={})
+    gmail_utils.sync()
+    gmail_utils.sync()
+    assert get_labels.call_count == 1
 
 
 @pytest.mark.django_db
@@ -55,6 +373,124 @@ def test_multiple_social_auths(default_site, gmail_service):
     assert ProjectMessage.objects.count() == 1  # because user is the same
 
 
+@pytest.mark.django_db
+def test_sync_parallel(default_site, gmail_service, mocker, settings, gmail_api_response_factory):
+    settings.GMAIL_SYNC_CONCURRENCY = 3
+    usas = UserSocialAuthFactory.create_batch(3)
+    message = gmail_utils.parse_message(gmail_api_response_factory('gmail_api_message.json'))
+    ids = iter(range(100))
+
+    def get_message_pages(service, history_id, label_id, cursor, attachment_texts):
+        return [([{**message, 'gmail_message_id': str(next(ids))} for _ in range(2)], None)]
+
+    mocker.patch('crm.gmail_utils.get_message_pages', side_effect=get_message_pages)
+    project_messages = gmail_utils.sync()
+    assert len(project_messages) == ProjectMessage.objects.count() == 6
+    assert Mailbox.objects.filter(social_auth__in=usas, history_id='5347681').count() == 3
+
+
+@pytest.mark.django_db
+def test_sync_parallel_failed_mailbox(default_site, gmail_service, mocker, settings):
+    settings.GMAIL_SYNC_CONCURRENCY = 2
+    failing, working = UserSocialAuthFactory.create_batch(2)
+    original_fetch_mailbox = gmail_utils.fetch_mailbox
+
+    def fetch_mailbox(mailbox, attachment_texts):
+        if mailbox.social_auth == failing:
+            raise RuntimeError('boom')
+        return original_fetch_mailbox(mailbox, attachment_texts)
+
+    mocker.patch('crm.gmail_utils.fetch_mailbox', side_effect=fetch_mailbox)
+    with pytest.raises(RuntimeError):
+        gmail_utils.sync()
+    assert ProjectMessage.objects.count() == 1
+    assert Mailbox.objects.get(social_auth=working).history_id == '5347681'
+    assert not Mailbox.objects.get(social_auth=failing).history_id
+    assert gmail_utils.SyncLock(Mailbox.objects.get(social_auth=failing)).acquire()
+
+
+@pytest.mark.django_db
+def test_sync_skips_locked_mailbox(default_site, gmail_service, user_social_auth, mocker):
+    mailbox = Mailbox.objects.create(social_auth=user_social_auth)
+    lock = gmail_utils.SyncLock(mailbox)
+    assert lock.acquire()
+    fetch_mailbox = mocker.spy(gmail_utils, 'fetch_mailbox')
+    assert gmail_utils.sync() == []
+    assert not fetch_mailbox.called
+    lock.release()
+    assert len(gmail_utils.sync()) == 1
+
+
+@pytest.mark.django_db
+def test_sync_waits_for_locked_mailbox(default_site, gmail_service, user_social_auth, mocker):
+    mailbox = Mailbox.objects.create(social_auth=user_social_auth)
+    lock = gmail_utils.SyncLock(mailbox)
+    lock.acquire()
+    mocker.patch('crm.gmail_utils.time.sleep', side_effect=lambda seconds: lock.release())
+    assert len(gmail_utils.sync(wait=10)) == 1
+
+
+@pytest.mark.django_db
+def test_sync_keeps_waiting_mailboxes_locked(default_site, gmail_service, mocker, settings):
+    settings.GMAIL_SYNC_CONCURRENCY = 1
+    settings.GMAIL_SYNC_LOCK_LEASE = 60
+    social_auths = UserSocialAuthFactory.create_batch(2)
+    now = [time.time()]
+    mocker.patch('django.core.cache.backends.locmem.time.time', side_effect=lambda: now[0])
+    original_fetch_mailbox = gmail_utils.fetch_mailbox
+
+    def fetch_mailbox(mailbox, attachment_texts):
+        for page in original_fetch_mailbox(mailbox, attachment_texts):
+            now[0] += 40
+            for social_auth in social_auths:
+                assert not gmail_utils.SyncLock(Mailbox.objects.get(social_auth=social_auth)).acquire()
+            yield page
+
+    mocker.patch('crm.gmail_utils.fetch_mailbox', side_effect=fetch_mailbox)
+    assert len(gmail_utils.sync()) == 1
+
+
+@pytest.mark.django_db
+def test_sync_stops_when_lock_is_lost(default_site, gmail_service, user_social_auth, mocker, settings):
+    settings.GMAIL_SYNC_LOCK_LEASE = 60
+    now = [time.time()]
+    mocker.patch('django.core.cache.backends.locmem.time.time', side_effect=lambda: now[0])
+    original_fetch_mailbox = gmail_utils.fetch_mailbox
+
+    def fetch_mailbox(mailbox, attachment_texts):
+        for page in original_fetch_mailbox(mailbox, attachment_texts):
+            # the lease ran out and another process took over the account
+            now[0] += 61
+            assert gmail_utils.SyncLock(mailbox).acquire()
+            yield page
+
+    mocker.patch('crm.gmail_utils.fetch_mailbox', side_effect=fetch_mailbox)
+    with pytest.raises(gmail_utils.LockLost):
+        gmail_utils.sync()
+    assert not ProjectMessage.objects.exists()
+    assert not Mailbox.objects.get().history_id
+
+
+def test_sync_lock_lease_expires(mocker):
+    mailbox = mocker.Mock(social_auth_id=1)
+    assert gmail_utils.SyncLock(mailbox, lease=60).acquire()
+    assert not gmail_utils.SyncLock(mailbox).acquire()
+    # the holder died without releasing, the cache drops the lock once the lease is over
+    mocker.patch('django.core.cache.backends.locmem.time.time', return_value=time.time() + 61)
+    assert gmail_utils.SyncLock(mailbox).acquire()
+
+
+def test_sync_lock_release_keeps_foreign_lock(mocker):
+    mailbox = mocker.Mock(social_auth_id=1)
+    holder, other = gmail_utils.SyncLock(mailbox), gmail_utils.SyncLock(mailbox)
+    assert holder.acquire()
+    other.release()
+    assert not other.acquire()
+    holder.release()
+    assert other.acquire()
+    other.release()
+
+
 def test_create_message_with_pdf_attachment(faker):
     sender = faker.email()
     to = faker.email()
@@ -77,6 +513,21 @@ def test_create_message_with_pdf_attachment(faker):
     assert attachment['content-type'] == 'application/pdf'
 
 
+def test_write_message_with_attachment(faker):
+    kwargs = dict(sender=faker.email(), to=faker.email(), message_text_html='<p>test <b>test</b></p>',
+                  content_type='application/pdf', filename='test.pdf', subject='Test', message_id='<1@example.com>')
+    data = bytes(range(256)) * 1000
+    created = create_message_with_attachment(file=BytesIO(data), **kwargs)
+    written = write_message_with_attachment(BytesIO(), file=BytesIO(data), **kwargs).read()
+    created = email.message_from_bytes(base64.urlsafe_b64decode(created['raw'].encode()))
+    written = email.message_from_bytes(written)
+    # the boundaries are random
+    del written['content-type'], created['content-type']
+    assert written.items() == created.items()
+    assert [part.items() for part in written.get_payload()] == [part.items() for part in created.get_payload()]
+    assert written.get_payload()[1].get_payload(decode=True) == data
+
+
 @pytest.mark.django_db
 def test_send_email(gmail_service, cv, user_social_auth, faker,
                     project_message, mocker):
@@ -1,9 +1,13 @@
+from datetime import timedelta
+
 import pytest
 from django.urls import reverse
+from django.utils import timezone
 from google.auth.exceptions import GoogleAuthError
 
+from crm import worker
 from crm.factories import UserSocialAuthFactory, ProjectMessageFactory
-from crm.models import ProjectMessage
+from crm.models import ProjectMessage, SyncJob
 
 
 @pytest.mark.django_db
@@ -15,14 +19,24 @@ def test_project_message_index(admin_app,
     admin_app.get(url)
 
 
+@pytest.mark.django_db
+def test_project_message_index_does_not_sync(admin_app, mocker):
+    sync = mocker.patch('crm.gmail_utils.sync')
+    url = reverse('crm_projectmessage_modeladmin_index')
+    r = admin_app.get(url)
+    sync.assert_not_called()
+    assert 'Mailbox was never synced' in r.text
+
+
 @pytest.mark.django_db
 def test_project_message_index_google_auth_error(admin_app,
                                                  mocker):
-    mocker.patch('crm.gmail_utils.sync', side_effect=GoogleAuthError)
+    mocker.patch('crm.gmail_utils.sync', side_effect=GoogleAuthError('invalid grant'))
+    worker.run_sync_job(worker.queue_sync())
     url = reverse('crm_projectmessage_modeladmin_index')
     r = admin_app.get(url)
     assert len(r.context['messages']) == 1
-    assert 'Can&#x27;t update messages' in r.text
+    assert 'Can&#x27;t update messages: invalid grant' in r.text
 
 
 @pytest.mark.django_db
@@ -30,8 +44,17 @@ def test_project_message_index_creates_message(default_site, gmail_service, admi
     UserSocialAuthFactory(user=admin_user)
     assert ProjectMessage.objects.count() == 0
     url = reverse('crm_projectmessage_modeladmin_index')
-    admin_app.get(url)
+    r = admin_app.get(url).forms['sync-form'].submit().follow()
+    assert 'Mailbox sync is queued' in r.text
+    assert 'sync-form' not in r.forms
+    assert ProjectMessage.objects.count() == 0
+
+    worker.run_queued_jobs()
+    r = admin_app.get(url)
     assert ProjectMessage.objects.count() == 1
+    assert 'Last synced 0' in r.text
+    assert '1 new projects' in r.text
+    assert SyncJob.objects.get().requested_by == admin_user
 
 
 @pytest.mark.django_db
@@ -47,3 +70,21 @@ def test_project_message_inspect_no_project(admin_app):
     project_message = ProjectMessageFactory(project=None)
     url = reverse('crm_projectmessage_modeladmin_inspect', kwargs={'instance_pk': project_message.pk})
     admin_app.get(url)
+
+
+@pytest.mark.django_db
+def test_project_message_sync_needs_post(admin_app):
+    admin_app.get(reverse('crm_projectmessage_modeladmin_sync'), status=405)
+    assert not SyncJob.objects.exists()
+
+
+@pytest.mark.django_db
+def test_project_message_index_stale_sync(admin_app, settings):
+    settings.GMAIL_SYNC_JOB_TIMEOUT = 600
+    SyncJob.objects.create(state='running', started_at=timezone.now() - timedelta(seconds=601))
+    r = admin_app.get(reverse('crm_projectmessage_modeladmin_index'))
+    assert 'Mailbox sync is running' not in r.text
+    assert 'Worker stopped during the sync' in r.text
+    assert 'sync-form' in r.forms
+    # failed by the worker, viewing the page doesn't write
+    assert SyncJob.objects.get().state == 'running'
@@ -0,0 +1,93 @@
+import mailbox
+from email.mime.multipart import MIMEMultipart
+from email.mime.text import MIMEText
+
+import pytest
+
+from crm import gmail_utils, mail_import
+from crm.models import ProjectMessage
+
+
+def make_message(index, **headers):
+    message = MIMEMultipart('alternative')
+    message.attach(MIMEText(f'Python project {index}\n\n> quoted\n> reply\n>> older'))
+    message.attach(MIMEText(f'<p>Python project {index}</p>', 'html'))
+    message['From'] = 'Darth Vader <darth@vader.com>'
+    message['Subject'] = f'Project {index}'
+    message['Date'] = 'Mon, 05 Jul 2021 10:00:00 +0200'
+    message['Message-ID'] = f'<{index}@vader.com>'
+    for name, value in headers.items():
+        del message[name]
+        message[name] = value
+    return message
+
+
+@pytest.fixture
+def mbox_path(tmp_path):
+    path = tmp_path / 'takeout.mbox'
+    archive = mailbox.mbox(path)
+    for index in range(5):
+        archive.add(make_message(index, **{'X-GM-THRID': '1700000000000000001'}))
+    archive.flush()
+    archive.close()
+    return str(path)
+
+
+def test_parse_raw():
+    message = mail_import.parse_raw(make_message(1, **{'X-GM-THRID': '1700000000000000001'}).as_bytes(), 1024)
+    assert message['gmail_thread_id'] == format(1700000000000000001, 'x')
+    assert message['message_id'] == '<1@vader.com>'
+    assert len(message['gmail_message_id']) <= 50
+    assert message['from_address'] == 'darth@vader.com'
+    assert message['full_name'] == 'Darth Vader'
+    assert message['text'].startswith('Python project 1')
+    assert message['sent_at'].isoformat() == '2021-07-05T10:00:00+02:00'
+
+
+def test_parse_raw_without_headers():
+    email_message = MIMEText('Python project')
+    email_message['From'] = 'darth@vader.com'
+    email_message['In-Reply-To'] = '<1@vader.com>'
+    message = mail_import.parse_raw(email_message.as_bytes(), 1024)
+    assert message['from_address'] == 'darth@vader.com'
+    assert message['message_id'].endswith('@freeturn>')
+    assert message['gmail_thread_id'] == mail_import.short_id('<1@vader.com>')
+    assert message['sent_at']
+
+
+def test_parse_raw_broken(mocker):
+    mocker.patch('crm.mail_import.parse_archived', side_effect=ValueError)
+    assert mail_import.parse_raw(b'', 1024) is None
+
+
+@pytest.mark.django_db(transaction=True)
+def test_import_mbox(mbox_path):
+    assert mail_import.import_mail(mbox_path, processes=2, batch_size=2) == 5
+    assert ProjectMessage.objects.count() == 5
+    # one takeout thread, one project
+    assert ProjectMessage.objects.values('project').distinct().count() == 1
+    assert mail_import.import_mail(mbox_path, processes=2) == 0
+
+
+@pytest.mark.django_db(transaction=True)
+def test_import_eml_directory(tmp_path, project_message):
+    (tmp_path / 'nested').mkdir()
+    for index in range(3):
+        (tmp_path / 'nested' / f'{index}.eml').write_bytes(make_message(index).as_bytes())
+    (tmp_path / 'notes.txt').write_text('not a message')
+    # synced from gmail before
+    (tmp_path / 'synced.eml').write_bytes(make_message(9, **{'Message-ID': project_message.message_id}).as_bytes())
+    assert mail_import.import_mail(str(tmp_path), processes=1) == 3
+    assert ProjectMessage.objects.count() == 4
+
+
+@pytest.mark.django_db(transaction=True)
+def test_import_then_sync(tmp_path, default_site, gmail_service, user_social_auth, gmail_api_response_factory):
+    synced = gmail_utils.parse_message(gmail_api_response_factory('gmail_api_message.json'))
+    (tmp_path / 'synced.eml').write_bytes(make_message(1, **{'Message-ID': synced['message_id']}).as_bytes())
+    assert mail_import.import_mail(str(tmp_path), processes=1) == 1
+    assert gmail_utils.sync() == []
+    assert ProjectMessage.objects.count() == 1
+    project_message = ProjectMessage.objects.get()
+    assert project_message.gmail_message_id == synced['gmail_message_id']
+    assert project_message.gmail_thread_id == synced['gmail_thread_id']
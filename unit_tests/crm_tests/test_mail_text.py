@@ -0,0 +1,65 @@
+import email
+from email.mime.multipart import MIMEMultipart
+from email.mime.text import MIMEText
+
+import pytest
+
+from crm import benchmark
+from crm.gmail_utils import StreamingParser
+from crm.mail_text import extract_text, html_to_text, remove_quotation
+
+
+def test_corpus_texts():
+    results = benchmark.benchmark_text(rounds=1)
+    assert len(results) > 10
+    assert {result['name']: result['failures'] for result in results if result['failures']} == {}
+
+
+@pytest.mark.parametrize('name', ['gmail_reply.eml', 'outlook_web_reply.eml', 'apple_mail_reply.eml',
+                                  'yahoo_reply.eml'])
+def test_html_quotes_removed(name):
+    with open(f'{benchmark.MAIL_CORPUS}/{name}', 'rb') as f:
+        email_message = email.message_from_bytes(f.read())
+    plain, html = email_message.get_payload()
+    text = html_to_text(html.get_payload(decode=True).decode(html.get_content_charset()))
+    # the plain alternative is the text of the message
+    assert text.splitlines()[-1] == extract_text(email_message).splitlines()[-1]
+    assert 'wrote' not in text and 'schrieb' not in text and 'From:' not in text
+
+
+def test_html_to_text_line_breaks():
+    html = '<div>Hi,<div><br></div><div>first line</div><div>second<br></div><p>a&nbsp;b &amp; c</p></div>'
+    assert html_to_text(html) == 'Hi,\n\nfirst line\nsecond\na b & c'
+
+
+def test_html_to_text_broken():
+    assert html_to_text('') == ''
+    assert html_to_text('<p>unclosed <b>tags') == 'unclosed tags'
+
+
+def test_remove_quotation_separator():
+    text = 'Hi,\nthe rate is fine.\n\n-----Original Message-----\nFrom: Jane\n\n> not a reply\nmore text'
+    assert remove_quotation(text) == 'Hi,\nthe rate is fine.'
+
+
+def test_remove_quotation_keeps_inline_answers():
+    text = 'Hi,\n> question?\nanswer\n\nOn Mon, Jane wrote:\n> the whole\n> message'
+    assert remove_quotation(text) == 'Hi,\n> question?\nanswer'
+
+
+def test_extract_text_html_only():
+    message = MIMEMultipart('mixed')
+    message.attach(MIMEText('<p>project <b>description</b></p>', 'html'))
+    note = MIMEText('attached notes', 'plain')
+    note.add_header('Content-Disposition', 'attachment', filename='notes.txt')
+    message.attach(note)
+    assert extract_text(message) == 'project description'
+    email_message = StreamingParser(10 * 1024).parse_bytes(message.as_bytes())
+    assert extract_text(email_message) == 'project description'
+    assert not email_message.get_payload()[1].get_payload()
+
+
+def test_extract_text_unknown_charset():
+    message = MIMEText('some text', 'plain')
+    message.set_param('charset', 'x-unknown')
+    assert extract_text(message) == 'some text'
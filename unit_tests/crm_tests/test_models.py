@@ -1,16 +1,23 @@
+import base64
 import uuid
 from datetime import date
 from datetime import timedelta
 from decimal import Decimal as D
 from email.message import Message as EmailMessage
+from email.mime.application import MIMEApplication
+from email.mime.multipart import MIMEMultipart
+from email.mime.text import MIMEText
 
 import pytest
 from django.conf import settings
 from django.core.exceptions import ValidationError
 from django.utils import timezone
 
-from crm.gmail_utils import parse_message, associate, remove_quotation
+from crm.gmail_utils import parse_message, associate_bulk, StreamingParser, SenderCache
+from crm.mail_text import remove_quotation
+from crm.models.company import Company, normalize_domain
 from crm.models.invoice import Invoice, InvoicePosition, invoice_raw_options, dictify_position_row
+from crm.models.project_message import ProjectMessage
 from home.models.snippets import Technology
 
 
@@ -58,6 +65,40 @@ def test_parse_message(gmail_api_message):
     assert result['gmail_thread_id'] == '1688b00c9ec9d5e7'
 
 
+@pytest.fixture
+def message_with_attachment(gmail_api_message):
+    message = MIMEMultipart()
+    message['from'] = 'Mark Twain <mark@twain.com>'
+    message['subject'] = 'Project'
+    message.attach(MIMEText('project description', 'plain'))
+    message.attach(MIMEText('<p>project description</p>', 'html'))
+    message.attach(MIMEApplication(b'x' * 1024 * 1024, _subtype='pdf'))
+    return {**gmail_api_message, 'raw': base64.urlsafe_b64encode(message.as_bytes()).decode()}
+
+
+@pytest.mark.parametrize('streaming', [True, False])
+def test_parse_message_modes(gmail_api_message, streaming):
+    result = parse_message(gmail_api_message, streaming=streaming)
+    assert result['text'].strip() == 'this is *test *email'
+    assert result['subject'] == 'Test email'
+
+
+def test_streaming_parser_drops_attachments(message_with_attachment):
+    email_message = StreamingParser(size_limit=10 * 1024 * 1024).parse(message_with_attachment['raw'])
+    text, html, attachment = email_message.get_payload()
+    assert text.get_payload(decode=True) == b'project description'
+    assert not html.get_payload()
+    assert attachment.get_content_type() == 'application/pdf'
+    assert not attachment.get_payload()
+
+
+def test_parse_message_size_limit(message_with_attachment, settings):
+    settings.GMAIL_MESSAGE_SIZE_LIMIT = 2048
+    result = parse_message(message_with_attachment)
+    assert result['text'] == 'project description'
+    assert result['from_address'] == 'mark@twain.com'
+
+
 def test_parse_message_text(gmail_api_response_factory):
     result = parse_message(gmail_api_response_factory('gmail_api_message_text.json'))
     assert result
@@ -103,7 +144,7 @@ def parsed_message(gmail_api_message):
 
 @pytest.mark.django_db
 def test_associate_new(parsed_message):
-    message, _ = associate(parsed_message)
+    message, = associate_bulk([parsed_message])
     assert message.sent_at == parsed_message['sent_at']
     assert message.subject == parsed_message['subject']
     assert message.project.name == parsed_message['subject']
@@ -124,7 +165,7 @@ def test_associate_manager_exists(employee,
     parsed_message['from_address'] = employee.email
     parsed_message['full_name'] = employee.full_name
 
-    message, _ = associate(parsed_message)
+    message, = associate_bulk([parsed_message])
     assert message.author == employee
 
 
@@ -134,24 +175,49 @@ def test_associate_manager_same_email_different_name(employee,
     # case with linkedin emails coming from all the same address inmail-hit-reply@linkedin.com
     parsed_message['from_address'] = employee.email
     parsed_message['full_name'] = 'John Dow'
-    message, _ = associate(parsed_message)
+    message, = associate_bulk([parsed_message])
     assert message.author != employee
 
 
 @pytest.mark.django_db
 def test_associate_company_exists(company, parsed_message):
     parsed_message['from_address'] = f'test@{company.domain}'
-    message, _ = associate(parsed_message)
+    message, = associate_bulk([parsed_message])
     assert message.project.manager.company == company
 
 
+@pytest.mark.django_db
+def test_associate_company_subdomain(company_factory, parsed_message):
+    company = company_factory.create(url='https://www.Example.co.uk/jobs')
+    assert company.domain == 'example.co.uk'
+    parsed_message['from_address'] = 'recruiter@mail.example.co.uk'
+    message, = associate_bulk([parsed_message])
+    assert message.author.company == company
+
+
+@pytest.mark.django_db
+def test_associate_company_same_name(company_factory, parsed_message):
+    company = company_factory.create(name='Cheparev', url=None)
+    message, = associate_bulk([parsed_message])
+    assert message.author.company == company
+
+
+@pytest.mark.django_db
+def test_company_backfill_domains(company):
+    Company.objects.update(domain='')
+    assert Company.backfill_domains() == 1
+    assert Company.backfill_domains() == 0
+    company.refresh_from_db()
+    assert company.domain == normalize_domain(company.url)
+
+
 @pytest.mark.django_db
 def test_associate_project_messages_exist(project, project_message_factory, parsed_message):
     existing_message = project_message_factory.create(project=project)
     parsed_message['subject'] = existing_message.subject
     parsed_message['gmail_thread_id'] = existing_message.gmail_thread_id
     parsed_message['from_email'] = f'another_manager@{existing_message.project.manager.company.domain}'
-    message, _ = associate(parsed_message)
+    message, = associate_bulk([parsed_message])
     assert message.project == existing_message.project
     assert message.project.manager.company == existing_message.project.manager.company
 
@@ -161,7 +227,7 @@ def test_associate_project_exists_manager_match(project, parsed_message):
     parsed_message['from_address'] = project.manager.email
     parsed_message['full_name'] = project.manager.full_name
 
-    message, _ = associate(parsed_message)
+    message, = associate_bulk([parsed_message])
     assert message.project == project
 
 
@@ -171,7 +237,7 @@ def test_associate_project_not_exist_manager_exists(employee, parsed_message):
     parsed_message['full_name'] = employee.full_name
 
     assert employee.projects.count() == 0
-    message, _ = associate(parsed_message)
+    message, = associate_bulk([parsed_message])
     assert message.project.manager == employee
     assert message.project.name == parsed_message['subject']
     assert message.project.original_description == parsed_message['text']
@@ -184,7 +250,7 @@ def test_project_exists_inactive(project_factory, parsed_message):
     parsed_message['from_address'] = inactive_project.manager.email
     parsed_message['full_name'] = inactive_project.manager.full_name
 
-    message, _ = associate(parsed_message)
+    message, = associate_bulk([parsed_message])
     assert message.project != inactive_project
     assert message.project.manager == inactive_project.manager
 
@@ -193,8 +259,65 @@ def test_project_exists_inactive(project_factory, parsed_message):
 def test_message_already_processed(project_message, parsed_message):
     parsed_message['gmail_message_id'] = project_message.gmail_message_id
     parsed_message['gmail_thread_id'] = project_message.gmail_thread_id
-    message, _ = associate(parsed_message)
-    assert message, _ == project_message
+    assert associate_bulk([parsed_message]) == []
+    assert ProjectMessage.objects.get() == project_message
+
+
+@pytest.mark.django_db
+def test_associate_bulk(parsed_message, project_message, django_assert_max_num_queries):
+    thread_reply = {**parsed_message, 'gmail_message_id': 'reply'}
+    known = {**parsed_message,
+             'gmail_message_id': project_message.gmail_message_id,
+             'gmail_thread_id': project_message.gmail_thread_id}
+    created = associate_bulk([parsed_message, thread_reply, known, parsed_message])
+    assert [message.gmail_message_id for message in created] == [parsed_message['gmail_message_id'], 'reply']
+    assert created[0].project == created[1].project
+    assert created[0].author == created[1].author
+    assert created[0].project.manager == created[0].author
+
+    # the lookup of known messages plus the savepoint of the transaction
+    with django_assert_max_num_queries(3):
+        assert associate_bulk([parsed_message, thread_reply, known]) == []
+
+
+@pytest.mark.django_db
+def test_associate_bulk_known_thread_and_manager(project_message_factory, project, parsed_message,
+                                                 django_assert_max_num_queries):
+    existing_message = project_message_factory.create(project=project, author=project.manager)
+    messages = [
+        {**parsed_message,
+         'gmail_message_id': str(i),
+         'gmail_thread_id': existing_message.gmail_thread_id,
+         'from_address': project.manager.email.upper(),
+         'full_name': project.manager.full_name}
+        for i in range(10)
+    ]
+    with django_assert_max_num_queries(8):
+        created = associate_bulk(messages)
+    assert len(created) == 10
+    assert {message.project for message in created} == {project}
+    assert {message.author for message in created} == {project.manager}
+
+
+@pytest.mark.django_db
+def test_sender_cache(employee, parsed_message, django_assert_num_queries):
+    parsed_message['from_address'] = employee.email.upper()
+    parsed_message['full_name'] = employee.full_name
+    senders = SenderCache()
+    with django_assert_num_queries(1):
+        senders.prefetch([parsed_message])
+        assert senders.get(parsed_message) == employee
+    with django_assert_num_queries(0):
+        senders.prefetch([parsed_message])
+        assert senders.get({**parsed_message, 'from_address': employee.email}) == employee
+
+
+@pytest.mark.django_db
+def test_sender_cache_creates_manager_once(parsed_message, django_assert_max_num_queries):
+    senders = SenderCache()
+    manager = senders.get(parsed_message)
+    with django_assert_max_num_queries(0):
+        assert senders.get(parsed_message) == manager
 
 
 @pytest.fixture
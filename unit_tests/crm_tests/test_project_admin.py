@@ -1,15 +1,19 @@
 import base64
 import email
 import json
+from io import BytesIO
 from datetime import datetime
 from wagtail.tests.utils.form_data import rich_text
 
 import pytest
-from django.contrib.messages import ERROR
+from django.contrib.messages import SUCCESS
 from django.urls import reverse
+from django.utils import timezone
 from google.api_core.exceptions import GoogleAPIError
 
+from crm import worker
 from crm.factories import CityFactory, ProjectFactory, MessageTemplateFactory, CVFactory, UserSocialAuthFactory
+from crm.models import CV, OutboundMessage
 from utils import get_messages
 
 
@@ -34,7 +38,7 @@ def full_template_data(admin_user, project):
 @pytest.mark.django_db
 def test_state_transition_action(gmail_service,
                                  admin_app,
-                                 project, full_template_data):
+                                 project, full_template_data, mocker):
     url = reverse('crm_project_modeladmin_index')
     r = admin_app.get(url)
     r = r.click('Drop')
@@ -54,10 +58,23 @@ def test_state_transition_action(gmail_service,
     project.refresh_from_db()
     assert project.state == 'stopped'
     assert len(r.context['messages']) == 2
-
+    # the message is sent by the worker
+    gmail_service.users.assert_not_called()
+    outbound_message = OutboundMessage.objects.get()
+    assert outbound_message.state == 'queued'
+    assert outbound_message.to_email == project.manager.email
+
+    mocker.patch.object(CV, 'get_file', return_value=BytesIO(b'test'))
+    gmail_service.users.return_value.messages.return_value.send.return_value.execute.return_value = {'id': 'sent'}
+    worker.send_outbound_messages()
     raw = gmail_service.users.mock_calls[2][2]['body']['raw']
     html = get_html_from_email(raw)
     assert 'test test' in html
+    outbound_message.refresh_from_db()
+    assert outbound_message.state == 'sent'
+
+    r = admin_app.get(reverse('crm_project_modeladmin_inspect', kwargs={'instance_pk': project.pk}))
+    assert f'to {project.manager.email}' in r.text
 
 
 @pytest.mark.django_db
@@ -73,6 +90,7 @@ def test_state_transition_no_social_auth(gmail_service,
     assert len(r.context['messages']) == 1
     r = r.forms[1].submit().follow()
     assert len(r.context['messages']) == 1
+    assert not OutboundMessage.objects.exists()
 
 
 @pytest.mark.django_db
@@ -116,9 +134,13 @@ def test_state_transition_just_change_state_button(gmail_service,
 @pytest.mark.django_db
 def test_state_transition_google_api_error(gmail_service,
                                            admin_app,
+                                           admin_user,
                                            project,
-                                           mocker):
-    mocker.patch('crm.gmail_utils.send_email', side_effect=GoogleAPIError)
+                                           mocker,
+                                           settings):
+    settings.GMAIL_SEND_MAX_ATTEMPTS = 2
+    mocker.patch('crm.gmail_utils.send_email', side_effect=GoogleAPIError('gmail is down'))
+    UserSocialAuthFactory(user=admin_user)
     MessageTemplateFactory(state_transition='drop')
     CVFactory(project=project)
     assert project.state == 'requested'
@@ -127,8 +149,23 @@ def test_state_transition_google_api_error(gmail_service,
     r = r.click('Drop')
     r = r.forms[1].submit(name='change_state', value='Just change state').follow()
     project.refresh_from_db()
+    # the transition doesn't wait for gmail
     assert project.state == 'stopped'
-    assert r.context['messages']._get()[0][0].level == ERROR
+    assert r.context['messages']._get()[0][0].level == SUCCESS
+
+    worker.send_outbound_messages()
+    outbound_message = OutboundMessage.objects.get()
+    assert outbound_message.state == 'queued'
+    assert outbound_message.attempts == 1
+    assert outbound_message.next_attempt_at > timezone.now()
+    r = admin_app.get(reverse('crm_project_modeladmin_inspect', kwargs={'instance_pk': project.pk}))
+    assert 'gmail is down' in r.text
+
+    OutboundMessage.objects.update(next_attempt_at=timezone.now())
+    worker.send_outbound_messages()
+    outbound_message.refresh_from_db()
+    assert outbound_message.state == 'failed'
+    assert outbound_message.attempts == 2
 
 
 @pytest.mark.django_db
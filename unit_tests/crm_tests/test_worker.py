@@ -0,0 +1,255 @@
+import logging
+from datetime import timedelta
+
+import pytest
+from django.utils import timezone
+
+from crm import gmail_utils, worker
+from crm.models import CV, CVRequest, Mailbox, OutboundMessage, ProjectMessage, SyncJob
+
+
+@pytest.mark.django_db
+def test_queue_sync_reuses_queued_job(user):
+    job = worker.queue_sync(user)
+    assert job.state == 'queued'
+    assert worker.queue_sync() == job
+    assert SyncJob.objects.count() == 1
+
+
+@pytest.mark.django_db
+def test_run_sync_job(default_site, gmail_service, user_social_auth):
+    job = worker.run_sync_job(worker.queue_sync())
+    assert job.state == 'finished'
+    assert job.started_at <= job.finished_at
+    assert list(job.project_messages.all()) == list(ProjectMessage.objects.all())
+
+
+@pytest.mark.django_db
+def test_run_sync_job_waits(mocker):
+    sync = mocker.patch('crm.gmail_utils.sync', return_value=[])
+    worker.run_sync_job(worker.queue_sync(), wait=10)
+    sync.assert_called_once_with(social_auth=None, wait=10)
+
+
+@pytest.mark.django_db
+def test_run_sync_job_failed(mocker):
+    mocker.patch('crm.gmail_utils.sync', side_effect=RuntimeError('boom'))
+    job = worker.run_sync_job(worker.queue_sync())
+    assert job.state == 'failed'
+    assert job.error == 'boom'
+    assert job.finished_at
+
+
+@pytest.mark.django_db
+def test_run_sync_job_claimed_once(mocker):
+    sync = mocker.patch('crm.gmail_utils.sync', return_value=[])
+    job = worker.queue_sync()
+    worker.run_sync_job(job)
+    assert worker.run_sync_job(job) is None
+    assert sync.call_count == 1
+
+
+@pytest.mark.django_db
+def test_run_queued_jobs(mocker):
+    sync = mocker.patch('crm.gmail_utils.sync', return_value=[])
+    worker.queue_sync()
+    worker.run_queued_jobs()
+    worker.run_queued_jobs()
+    assert sync.call_count == 1
+    assert SyncJob.objects.get().state == 'finished'
+
+
+@pytest.mark.django_db
+def test_run_queued_jobs_fails_stale_sync(settings):
+    settings.GMAIL_SYNC_JOB_TIMEOUT = 600
+    stale = SyncJob.objects.create(state='running', started_at=timezone.now() - timedelta(seconds=601))
+    running = SyncJob.objects.create(state='running', started_at=timezone.now())
+    worker.run_queued_jobs()
+    stale.refresh_from_db()
+    assert stale.state == 'failed'
+    assert stale.error == SyncJob.stale_error
+    assert SyncJob.objects.get(pk=running.pk).state == 'running'
+
+
+@pytest.mark.django_db
+def test_run_cv_requests(default_site, gmail_service, user_social_auth, caplog):
+    worker.run_sync_job(worker.queue_sync())
+    project = ProjectMessage.objects.first().project
+    assert not project.cvs.exists()
+    with caplog.at_level(logging.INFO, logger='sync_profile'):
+        worker.run_cv_requests()
+    assert 'sync_phase phase=create_cv count=1 seconds=' in caplog.text
+    assert CV.objects.filter(project=project).exists()
+    assert not CVRequest.objects.exists()
+
+
+@pytest.mark.django_db
+def test_run_cv_requests_failed(mocker, project, user, settings):
+    settings.CV_REQUEST_MAX_ATTEMPTS = 2
+    create_cv = mocker.patch('crm.models.Project.create_cv', side_effect=RuntimeError('boom'))
+    CVRequest.objects.create(project=project, user=user)
+    worker.run_cv_requests()
+    cv_request = CVRequest.objects.get()
+    assert cv_request.state == 'queued'
+    assert cv_request.attempts == 1
+    assert cv_request.error == 'boom'
+
+    worker.run_cv_requests()
+    cv_request.refresh_from_db()
+    assert cv_request.state == 'failed'
+    assert cv_request.attempts == 2
+    worker.run_cv_requests()
+    assert create_cv.call_count == 2
+
+
+@pytest.mark.django_db
+def test_run_cv_requests_worker_died(mocker, project, user, settings):
+    settings.CV_REQUEST_TIMEOUT = 600
+    create_cv = mocker.patch('crm.models.Project.create_cv')
+    cv_request = CVRequest.objects.create(project=project, user=user, state='running', attempts=1,
+                                          claimed_at=timezone.now() - timedelta(seconds=60))
+    worker.run_cv_requests()
+    create_cv.assert_not_called()
+
+    CVRequest.objects.filter(pk=cv_request.pk).update(claimed_at=timezone.now() - timedelta(seconds=601))
+    worker.run_cv_requests()
+    create_cv.assert_called_once()
+    assert not CVRequest.objects.exists()
+
+
+@pytest.fixture
+def outbound_message(cv, user):
+    return OutboundMessage.objects.create(project=cv.project, sender=user, cv=cv, to_email='manager@example.com',
+                                          text='hi')
+
+
+@pytest.mark.django_db
+def test_send_outbound_message_claimed_once(mocker, outbound_message):
+    send_email = mocker.patch('crm.gmail_utils.send_email', return_value=({'id': 'sent'}, None))
+    worker.send_outbound_message(outbound_message)
+    assert worker.send_outbound_message(outbound_message) is None
+    assert send_email.call_count == 1
+    outbound_message.refresh_from_db()
+    assert outbound_message.state == 'sent'
+    assert outbound_message.gmail_message_id == 'sent'
+
+
+@pytest.mark.django_db
+def test_send_outbound_message_no_social_auth(outbound_message):
+    worker.send_outbound_messages()
+    outbound_message.refresh_from_db()
+    assert outbound_message.state == 'failed'
+    assert outbound_message.attempts == 1
+
+
+@pytest.mark.django_db
+def test_send_outbound_message_retried(mocker, outbound_message, settings):
+    settings.GMAIL_SEND_RETRY_DELAY = 60
+    mocker.patch('crm.gmail_utils.send_email', side_effect=RuntimeError('boom'))
+    worker.send_outbound_messages()
+    # not due yet
+    worker.send_outbound_messages()
+    outbound_message.refresh_from_db()
+    assert outbound_message.attempts == 1
+    assert outbound_message.error == 'boom'
+    assert outbound_message.next_attempt_at > timezone.now() + timedelta(seconds=50)
+
+
+@pytest.mark.django_db
+def test_send_outbound_message_worker_died(mocker, outbound_message, settings):
+    settings.GMAIL_SEND_TIMEOUT = 600
+    settings.GMAIL_SEND_MAX_ATTEMPTS = 2
+    send_email = mocker.patch('crm.gmail_utils.send_email', side_effect=SystemExit)
+    with pytest.raises(SystemExit):
+        worker.send_outbound_messages()
+    outbound_message.refresh_from_db()
+    assert outbound_message.state == 'sending'
+
+    # still sending for all we know
+    send_email.side_effect = None
+    send_email.return_value = ({'id': 'sent'}, None)
+    worker.send_outbound_messages()
+    assert send_email.call_count == 1
+
+    OutboundMessage.objects.update(claimed_at=timezone.now() - timedelta(seconds=601))
+    worker.send_outbound_messages()
+    outbound_message.refresh_from_db()
+    assert outbound_message.state == 'sent'
+    assert outbound_message.attempts == 2
+
+
+@pytest.mark.django_db
+def test_send_outbound_message_worker_died_out_of_attempts(outbound_message, settings):
+    settings.GMAIL_SEND_MAX_ATTEMPTS = 1
+    OutboundMessage.objects.update(state='sending', attempts=1, claimed_at=timezone.now() - timedelta(days=1))
+    assert OutboundMessage.release_stale() == 1
+    outbound_message.refresh_from_db()
+    assert outbound_message.state == 'failed'
+    assert outbound_message.error
+
+
+@pytest.fixture
+def poll_settings(settings):
+    settings.GMAIL_POLL_MIN_INTERVAL = 60
+    settings.GMAIL_POLL_MAX_INTERVAL = 3600
+    settings.GMAIL_POLL_RATE_WINDOW = 3600
+    return settings
+
+
+@pytest.mark.django_db
+def test_schedule_poll_backs_off_quiet_mailbox(poll_settings, user_social_auth):
+    mailbox = Mailbox.objects.create(social_auth=user_social_auth)
+    intervals = []
+    for _ in range(7):
+        mailbox.schedule_poll(0)
+        intervals.append(mailbox.poll_interval)
+    assert intervals == [120, 240, 480, 960, 1920, 3600, 3600]
+    assert mailbox.next_poll_at == mailbox.polled_at + timedelta(seconds=3600)
+
+
+@pytest.mark.django_db
+def test_schedule_poll_busy_mailbox(poll_settings, user_social_auth):
+    now = timezone.now()
+    mailbox = Mailbox.objects.create(social_auth=user_social_auth, poll_interval=3600,
+                                     polled_at=now - timedelta(minutes=10))
+    mailbox.schedule_poll(10, now)
+    assert mailbox.arrival_rate > 8
+    assert 60 < mailbox.poll_interval < 600
+    mailbox.schedule_poll(100, now + timedelta(minutes=1))
+    assert mailbox.poll_interval == 60
+
+
+@pytest.mark.django_db
+def test_sync_due_mailboxes(default_site, gmail_service, user_social_auth, poll_settings):
+    worker.poll_due_mailboxes()
+    mailbox = Mailbox.objects.get()
+    assert mailbox.history_id
+    assert mailbox.next_poll_at > timezone.now()
+    assert mailbox.poll_interval == 120
+    job = SyncJob.objects.get()
+    assert job.state == 'finished'
+    assert list(job.project_messages.all()) == list(ProjectMessage.objects.all())
+    next_poll_at = mailbox.next_poll_at
+    worker.poll_due_mailboxes()
+    mailbox.refresh_from_db()
+    assert mailbox.next_poll_at == next_poll_at
+    assert SyncJob.objects.count() == 1
+    assert 1 < worker.seconds_to_next_poll() <= 60
+
+
+@pytest.mark.django_db
+def test_poll_failed_mailbox_waits(default_site, gmail_service, user_social_auth, mocker, poll_settings):
+    mocker.patch('crm.gmail_utils.fetch_mailbox', side_effect=RuntimeError('boom'))
+    assert worker.poll_due_mailboxes() == []
+    assert Mailbox.objects.get().next_poll_at > timezone.now()
+    assert SyncJob.objects.get().error == 'boom'
+
+
+@pytest.mark.django_db
+def test_poll_locked_mailbox_waits(default_site, gmail_service, user_social_auth, mocker, poll_settings):
+    mailbox = Mailbox.objects.create(social_auth=user_social_auth)
+    assert gmail_utils.SyncLock(mailbox).acquire()
+    fetch = mocker.patch('crm.gmail_utils.fetch_mailboxes')
+    assert worker.poll_due_mailboxes() == []
+    fetch.assert_not_called()
+    assert 59 < worker.seconds_to_next_poll() <= 60
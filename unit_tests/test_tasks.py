@@ -0,0 +1,28 @@
+import inspect
+
+import pytest
+from invoke import Parser, ParserContext
+
+# invoke 1.4 reads the task signatures with getargspec, gone since python 3.11
+if not hasattr(inspect, 'getargspec'):
+    inspect.getargspec = inspect.getfullargspec
+
+import tasks  # noqa: E402
+
+
+def parse(task, *args):
+    context = ParserContext(name=task.name, args=task.get_arguments())
+    return Parser(contexts=[context]).parse_argv([task.name, *args])[0].as_kwargs
+
+
+@pytest.mark.parametrize('task, args, expected', [
+    (tasks.mail, ['--profile'], {'profile': True, 'wait': 60}),
+    (tasks.mail, [], {'profile': False, 'wait': 60}),
+    (tasks.mail, ['--wait', '5'], {'profile': False, 'wait': 5}),
+    (tasks.import_mail, ['--path', 'archive.mbox', '--processes', '2'],
+     {'path': 'archive.mbox', 'processes': '2', 'batch_size': 500}),
+    (tasks.benchmark_sync, ['--mode', 'threads'],
+     {'sizes': '1000,10000,50000', 'mix': '', 'attachment_size': 50 * 1024, 'throttle': False, 'mode': 'threads'}),
+])
+def test_task_arguments(task, args, expected):
+    assert parse(task, *args) == expected